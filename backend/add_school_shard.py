@@ -0,0 +1,158 @@
+"""
+Onboards a school onto its own database. See tenant_shards.py.
+
+    python add_school_shard.py dalton --prefix DAL [--class-code 4B --class-code 5A]
+        [--database shards/dalton.db] [--batch-size 1000]
+
+Steps, all safe to re-run after an interruption:
+
+1. create the school's database with the full schema;
+2. copy the school's users, all of their rows and the shared daily questions;
+3. write the new shards file and tell the running servers to reload it, so
+   the school's requests go to its own database from then on;
+4. copy the rows written to the default database in the meantime, replacing
+   the shard's copies from step 2 (rows changed after that copy would
+   otherwise keep their stale version there), then delete the school's rows
+   from the default database. The users themselves stay on the default
+   database, which is the login directory.
+
+Run it outside lesson hours: between steps 3 and 4 the newest few seconds of
+the school's activity may be missing from its reads.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine
+
+from db_models import Base, DATABASE_URL, USER_OWNED_MODELS, add_missing_columns_and_indexes
+from search_index import install_search_index
+from shared_state import INVALIDATION_POLL_SECONDS, create_change_counters
+from tenant_shards import DEFAULT_SCHOOL, SHARDS_FILE, TenantMap
+from warm_start import install_change_counters, read_change_counters
+
+DEFAULT_BATCH_SIZE = 1000
+SCHOOL_USERS = "temp.school_users"
+
+
+def create_shard_schema(database: Path, tracked_tables):
+    database.parent.mkdir(parents=True, exist_ok=True)
+    engine = create_engine(f"sqlite:///{database}")
+    with engine.begin() as conn:
+        Base.metadata.create_all(conn)
+        add_missing_columns_and_indexes(conn)
+        install_search_index(conn)
+        install_change_counters(conn, tracked_tables)
+    engine.dispose()
+
+
+def select_school_users(conn, class_codes, prefixes):
+    """(Re)fills a temp table with the ids of the school's users."""
+    conditions = []
+    params = []
+    if class_codes:
+        conditions.append(f"upper(class_code) IN ({', '.join('?' for _ in class_codes)})")
+        params += class_codes
+    for prefix in prefixes:
+        conditions.append("upper(class_code) LIKE ? ESCAPE '\\'")
+        params.append(prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+    conn.exec_driver_sql(f"DROP TABLE IF EXISTS {SCHOOL_USERS}")
+    conn.exec_driver_sql("CREATE TEMP TABLE school_users (id TEXT PRIMARY KEY)")
+    conn.exec_driver_sql(f"INSERT INTO {SCHOOL_USERS} SELECT id FROM main.users WHERE {' OR '.join(conditions)}", tuple(params))
+    conn.commit()
+    return conn.exec_driver_sql(f"SELECT COUNT(*) FROM {SCHOOL_USERS}").scalar()
+
+
+def _columns(conn, schema: str, table: str):
+    return [row[1] for row in conn.exec_driver_sql(f"PRAGMA {schema}.table_info({table})").fetchall()]
+
+
+def _rowid_batches(conn, table: str, batch_size: int):
+    low, high = conn.exec_driver_sql(f"SELECT MIN(rowid), MAX(rowid) FROM main.{table}").fetchone()
+    if low is None:
+        return
+    for start in range(low, high + 1, batch_size):
+        yield start, start + batch_size - 1
+
+
+def copy_rows(conn, table: str, condition: str, batch_size: int, replace: bool = False) -> int:
+    """Copies matching rows to the shard; with replace, rows the shard already has are overwritten."""
+    shard_columns = set(_columns(conn, "shard", table))
+    columns = ", ".join(column for column in _columns(conn, "main", table) if column in shard_columns)
+    copied = 0
+    for start, end in _rowid_batches(conn, table, batch_size):
+        result = conn.exec_driver_sql(
+            f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO shard.{table} ({columns}) SELECT {columns} FROM main.{table} "
+            f"WHERE rowid BETWEEN ? AND ? AND {condition}", (start, end)
+        )
+        conn.commit()
+        copied += max(result.rowcount, 0)
+    print(f"  {table}: {copied} rows copied")
+    return copied
+
+
+def delete_rows(conn, table: str, condition: str, batch_size: int) -> int:
+    deleted = 0
+    for start, end in _rowid_batches(conn, table, batch_size):
+        result = conn.exec_driver_sql(f"DELETE FROM main.{table} WHERE rowid BETWEEN ? AND ? AND {condition}", (start, end))
+        conn.commit()
+        deleted += max(result.rowcount, 0)
+    print(f"  {table}: {deleted} rows removed from the default database")
+    return deleted
+
+
+def copy_school(conn, batch_size: int, replace: bool = False):
+    owned = f"user_id IN (SELECT id FROM {SCHOOL_USERS})"
+    copy_rows(conn, "users", f"id IN (SELECT id FROM {SCHOOL_USERS})", batch_size, replace)
+    copy_rows(conn, "daily_questions", "1", batch_size, replace)
+    for model in USER_OWNED_MODELS:
+        copy_rows(conn, model.__tablename__, owned, batch_size, replace)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move a school onto its own database shard.")
+    parser.add_argument("school")
+    parser.add_argument("--prefix", action="append", default=[], help="Class code prefix of the school (repeatable)")
+    parser.add_argument("--class-code", action="append", default=[], help="Class code of the school (repeatable)")
+    parser.add_argument("--database", default=None, help="Shard database file (default: shards/<school>.db)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.school == DEFAULT_SCHOOL:
+        sys.exit(f"{DEFAULT_SCHOOL!r} is the default database, pick another name")
+    if not args.prefix and not args.class_code:
+        sys.exit("Give at least one --prefix or --class-code")
+    database = Path(args.database or f"shards/{args.school}.db")
+    try:
+        new_map = TenantMap.load().with_school(args.school, str(database), args.class_code, args.prefix)
+    except ValueError as e:
+        sys.exit(str(e))
+    class_codes, prefixes = new_map.class_code_filter(args.school)
+
+    engine = create_engine(DATABASE_URL.replace("+aiosqlite", ""))
+    with engine.connect() as conn:
+        print(f"1. Creating {database}")
+        # The same change counters as the servers installed on the default database (see warm_start.py)
+        create_shard_schema(database, list(read_change_counters(conn)))
+        conn.commit()
+
+        conn.exec_driver_sql("ATTACH DATABASE ? AS shard", (str(database),))
+        print(f"2. Copying {select_school_users(conn, class_codes, prefixes)} users and their rows")
+        copy_school(conn, args.batch_size)
+
+        print(f"3. Routing {args.school} to its shard ({SHARDS_FILE})")
+        new_map.save()
+        create_change_counters().bump("shards")
+        time.sleep(INVALIDATION_POLL_SECONDS * 4)  # Every server has reloaded the map after this
+
+        print("4. Copying late writes and cleaning up the default database")
+        select_school_users(conn, class_codes, prefixes)  # Users created in the meantime too
+        copy_school(conn, args.batch_size, replace=True)
+        for model in USER_OWNED_MODELS:
+            delete_rows(conn, model.__tablename__, f"user_id IN (SELECT id FROM {SCHOOL_USERS})", args.batch_size)
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Durable local job queue for AI analysis of food entries.
+
+Jobs live in a small SQLite file next to the app database, so they survive
+restarts and can be claimed safely by several uvicorn workers. Failed jobs are
+retried with exponential backoff and moved to the "dead" state after
+MAX_ATTEMPTS, where they stay for inspection.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+ANALYSIS_QUEUE_DB = Path(os.environ.get("SNACKCHECK_ANALYSIS_QUEUE_DB", Path(__file__).parent / "analysis_jobs.db"))
+ANALYSIS_WORKERS = int(os.environ.get("SNACKCHECK_ANALYSIS_WORKERS", "2"))
+MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 2.0
+JOB_TIMEOUT_SECONDS = 60.0
+# A running job whose worker has not finished it within this window is handed out again
+LEASE_SECONDS = 300.0
+POLL_INTERVAL_SECONDS = 1.0
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_DEAD = "dead"
+
+
+class AnalysisJobQueue:
+    """SQLite-backed job table. All methods are blocking; call them via asyncio.to_thread."""
+
+    def __init__(self, db_path: Path = ANALYSIS_QUEUE_DB, max_attempts: int = MAX_ATTEMPTS):
+        self.db_path = Path(db_path)
+        self.max_attempts = max_attempts
+        self._init_schema()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA busy_timeout = 30000")
+        return conn
+
+    def _init_schema(self):
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS analysis_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    entry_id TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    run_after REAL NOT NULL,
+                    locked_by TEXT,
+                    locked_at REAL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_jobs_claim ON analysis_jobs (status, run_after)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_jobs_entry ON analysis_jobs (entry_id)")
+
+    def enqueue(self, entry_id: str) -> int:
+        now = time.time()
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "INSERT INTO analysis_jobs (entry_id, status, run_after, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (entry_id, JOB_QUEUED, now, now, now),
+            )
+            return cursor.lastrowid
+
+    def enqueue_missing(self, entry_ids: List[str]) -> int:
+        """Enqueues the entries that have no job at all, in one transaction so concurrent sweeps don't double up."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            added = 0
+            for entry_id in entry_ids:
+                if conn.execute("SELECT 1 FROM analysis_jobs WHERE entry_id = ? LIMIT 1", (entry_id,)).fetchone() is None:
+                    conn.execute(
+                        "INSERT INTO analysis_jobs (entry_id, status, run_after, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                        (entry_id, JOB_QUEUED, now, now, now),
+                    )
+                    added += 1
+            conn.execute("COMMIT")
+            return added
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def claim(self, worker_id: str) -> Optional[Dict]:
+        """
+        Atomically picks the oldest runnable job (or one with an expired lease) and marks it running.
+        An expired lease counts as a failed attempt, so a job that keeps killing or hanging its
+        worker is dead-lettered here once it has used up its attempts.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            expired = conn.execute(
+                """
+                UPDATE analysis_jobs SET status = ?, last_error = ?, locked_by = NULL, updated_at = ?
+                WHERE status = ? AND locked_at < ? AND attempts >= ?
+                """,
+                (JOB_DEAD, f"Lease expired after {self.max_attempts} attempts", now,
+                 JOB_RUNNING, now - LEASE_SECONDS, self.max_attempts),
+            ).rowcount
+            if expired:
+                logging.warning(f"Dead-lettered {expired} analysis job(s) whose last lease expired.")
+            row = conn.execute(
+                """
+                SELECT * FROM analysis_jobs
+                WHERE (status = ? AND run_after <= ?) OR (status = ? AND locked_at < ?)
+                ORDER BY id LIMIT 1
+                """,
+                (JOB_QUEUED, now, JOB_RUNNING, now - LEASE_SECONDS),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE analysis_jobs SET status = ?, attempts = attempts + 1, locked_by = ?, locked_at = ?, updated_at = ? WHERE id = ?",
+                (JOB_RUNNING, worker_id, now, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+            job = dict(row)
+            job["attempts"] += 1
+            return job
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def complete(self, job_id: int):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE analysis_jobs SET status = ?, last_error = NULL, locked_by = NULL, updated_at = ? WHERE id = ?",
+                (JOB_DONE, now, job_id),
+            )
+
+    def fail(self, job_id: int, attempts: int, error: str) -> str:
+        """Schedules a retry with exponential backoff, or dead-letters the job. Returns the new status."""
+        now = time.time()
+        if attempts >= self.max_attempts:
+            new_status, run_after = JOB_DEAD, now
+        else:
+            new_status, run_after = JOB_QUEUED, now + RETRY_BASE_SECONDS * (2 ** (attempts - 1))
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE analysis_jobs SET status = ?, last_error = ?, run_after = ?, locked_by = NULL, updated_at = ? WHERE id = ?",
+                (new_status, error[:2000], run_after, now, job_id),
+            )
+        return new_status
+
+    def status_for_entry(self, entry_id: str) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT id, entry_id, status, attempts, last_error, created_at, updated_at FROM analysis_jobs "
+                "WHERE entry_id = ? ORDER BY id DESC LIMIT 1",
+                (entry_id,),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def dead_jobs(self, limit: int = 100) -> List[Dict]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, entry_id, attempts, last_error, updated_at FROM analysis_jobs WHERE status = ? ORDER BY id DESC LIMIT ?",
+                (JOB_DEAD, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def requeue(self, job_id: int) -> bool:
+        """Puts a dead job back in the queue with a fresh attempt budget."""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "UPDATE analysis_jobs SET status = ?, attempts = 0, run_after = ?, updated_at = ? WHERE id = ? AND status = ?",
+                (JOB_QUEUED, now, now, job_id, JOB_DEAD),
+            )
+            return cursor.rowcount > 0
+
+    def purge_done(self, older_than_seconds: float) -> int:
+        """Deletes finished jobs; dead ones stay for inspection."""
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "DELETE FROM analysis_jobs WHERE status = ? AND updated_at < ?", (JOB_DONE, time.time() - older_than_seconds)
+            )
+            return cursor.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM analysis_jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+
+class AnalysisNotifier:
+    """In-process wakeups for clients waiting on an entry's analysis (used by the SSE endpoint)."""
+
+    def __init__(self):
+        self._events: Dict[str, List[asyncio.Event]] = {}
+
+    def notify(self, entry_id: str):
+        for event in self._events.pop(entry_id, []):
+            event.set()
+
+    async def wait(self, entry_id: str, timeout: float) -> bool:
+        event = asyncio.Event()
+        self._events.setdefault(entry_id, []).append(event)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = self._events.get(entry_id)
+            if waiters and event in waiters:
+                waiters.remove(event)
+                if not waiters:
+                    del self._events[entry_id]
+
+
+class AnalysisWorkerPool:
+    """Runs `handler(entry_id)` for queued jobs on a fixed number of asyncio workers."""
+
+    def __init__(
+        self,
+        queue: AnalysisJobQueue,
+        handler: Callable[[str], Awaitable[None]],
+        notifier: AnalysisNotifier,
+        concurrency: int = ANALYSIS_WORKERS,
+    ):
+        self.queue = queue
+        self.handler = handler
+        self.notifier = notifier
+        self.concurrency = concurrency
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+
+    def wake(self):
+        """Called after enqueue so an idle worker picks the job up without waiting for the next poll."""
+        self._wakeup.set()
+
+    async def _run_worker(self, worker_id: str):
+        while not self._stopping:
+            job = await asyncio.to_thread(self.queue.claim, worker_id)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            try:
+                await asyncio.wait_for(self.handler(job["entry_id"]), JOB_TIMEOUT_SECONDS)
+                await asyncio.to_thread(self.queue.complete, job["id"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                new_status = await asyncio.to_thread(self.queue.fail, job["id"], job["attempts"], repr(e))
+                logging.error(f"Analysis job {job['id']} for entry {job['entry_id']} failed (attempt {job['attempts']}): {e} -> {new_status}")
+            self.notifier.notify(job["entry_id"])
+
+    def start(self):
+        self._stopping = False
+        for _ in range(self.concurrency):
+            worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            self._tasks.append(asyncio.create_task(self._run_worker(worker_id)))
+        logging.info(f"Started {self.concurrency} analysis workers.")
+
+    async def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,103 @@
+"""
+Moves closed school years (or everything older than a cutoff) out of the hot
+history tables into per-year archive databases. See school_archive.py.
+
+    python archive_school_years.py run [--before 2025-08-01] [--only food_entries,chat_messages] [--batch-size 500]
+    python archive_school_years.py status
+
+Without --before, everything before the start of the current school year is
+archived. The job commits after every batch and can be interrupted and re-run
+at any time; running servers keep serving while it works.
+"""
+import argparse
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, event
+
+from db_models import DATABASE_URL
+from school_archive import (
+    ARCHIVE_BATCH_PAUSE_SECONDS, ARCHIVE_BATCH_SIZE, ARCHIVED_TABLES, archive_plan, archive_status,
+    attach_archives, ensure_archive, install_archive_progress, move_batch, school_year_bounds, school_year_of,
+)
+from shared_state import INVALIDATION_POLL_SECONDS, create_change_counters
+
+
+def get_sync_engine():
+    engine = create_engine(DATABASE_URL.replace("+aiosqlite", ""))
+    event.listen(engine, "connect", lambda dbapi_connection, _: attach_archives(dbapi_connection))
+    return engine
+
+
+def selected_tables(only: str):
+    if not only:
+        return list(ARCHIVED_TABLES)
+    names = [name.strip() for name in only.split(",") if name.strip()]
+    unknown = [name for name in names if name not in ARCHIVED_TABLES]
+    if unknown:
+        sys.exit(f"Unknown table(s): {', '.join(unknown)}. Choose from: {', '.join(ARCHIVED_TABLES)}")
+    return names
+
+
+def run(engine, before: datetime, tables, batch_size: int):
+    with engine.begin() as conn:
+        install_archive_progress(conn)
+        plan = archive_plan(conn, before, tables)
+    if not plan:
+        print(f"Nothing older than {before:%Y-%m-%d} left to archive.")
+        return
+
+    with engine.connect() as conn:
+        prepared = set()
+        for table, year in plan:
+            if year not in prepared:
+                created = ensure_archive(conn, year)
+                conn.commit()
+                prepared.add(year)
+                if created:
+                    # Servers attach the new file on their next poll; wait so moved rows never disappear from reads
+                    create_change_counters().bump("archive")
+                    time.sleep(INVALIDATION_POLL_SECONDS * 2)
+            total = 0
+            while True:
+                moved = move_batch(conn, table, year, before, batch_size)
+                conn.commit()
+                if not moved:
+                    break
+                total += moved
+                print(f"  {table} {year}-{year + 1}: {total} rows archived", end="\r")
+                time.sleep(ARCHIVE_BATCH_PAUSE_SECONDS)  # Let the servers' writers in between batches
+            print(f"  {table} {year}-{year + 1}: {total} rows archived")
+
+
+def status(engine):
+    with engine.begin() as conn:
+        install_archive_progress(conn)
+        rows = archive_status(conn)
+    if not rows:
+        print("No school years archived yet.")
+    for row in rows:
+        print(f"  {row['school_year']} {row['table']}: {row['moved']} rows (last batch {row['updated_at']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive closed school years of the SnackCheck history tables.")
+    parser.add_argument("command", choices=["run", "status"])
+    parser.add_argument("--before", type=datetime.fromisoformat, default=None,
+                        help="Archive rows older than this (default: start of the current school year)")
+    parser.add_argument("--only", default="", help="Comma-separated tables (default: all)")
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    args = parser.parse_args()
+
+    engine = get_sync_engine()
+    if args.command == "status":
+        status(engine)
+        return
+    before = args.before or school_year_bounds(school_year_of(datetime.utcnow()))[0]
+    run(engine, before, selected_tables(args.only), args.batch_size)
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
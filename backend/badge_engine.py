@@ -0,0 +1,137 @@
+"""
+Event-driven badge rules.
+
+Badges are declared as data (BADGE_RULES) instead of being checked by ad-hoc
+queries. The server turns every domain change into an event:
+
+    {"type": "food_entry", "user_id": ..., "timestamp": datetime, "category": "fruit"}
+    {"type": "question_response", "user_id": ..., "timestamp": datetime}
+    {"type": "streak", "user_id": ..., "streak_days": 7}
+    {"type": "points", "user_id": ..., "points_before": 480, "points": 505}
+
+Counting rules keep one counter per (user, rule, window), so an event costs one
+counter increment per matching rule no matter how much history a user has.
+Threshold rules (streak, points) need no state at all: they fire when an event
+crosses the threshold. replay() runs the same rules over historical events in
+memory, which is how a newly added rule is backfilled.
+"""
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# kind "count":     `count` events of `event` (optionally only `category`) within `window`
+# kind "streak":    streak_days reaches `days`
+# kind "points":    total points reaches `points`
+# window: "all" (ever), "week" (ISO week), "day"
+BADGE_RULES: List[Dict] = [
+    {"id": "first_entry", "name": "First snack logged", "kind": "count", "event": "food_entry", "count": 1, "window": "all"},
+    {"id": "streak_7", "name": "7-day streak", "kind": "streak", "days": 7},
+    {"id": "streak_30", "name": "30-day streak", "kind": "streak", "days": 30},
+    {"id": "fruit_10_week", "name": "10 fruits this week", "kind": "count", "event": "food_entry", "category": "fruit", "count": 10, "window": "week"},
+    {"id": "vegetable_10_week", "name": "10 vegetables this week", "kind": "count", "event": "food_entry", "category": "vegetable", "count": 10, "window": "week"},
+    {"id": "questions_20", "name": "Answered 20 daily questions", "kind": "count", "event": "question_response", "count": 20, "window": "all"},
+    {"id": "points_500", "name": "500 points", "kind": "points", "points": 500},
+]
+
+RULE_KINDS = ("count", "streak", "points")
+WINDOWS = ("all", "week", "day")
+
+
+def validate_rules(rules: Iterable[Dict]) -> List[Dict]:
+    rules = list(rules)
+    seen = set()
+    for rule in rules:
+        if rule.get("id") in seen:
+            raise ValueError(f"Duplicate badge rule id: {rule.get('id')}")
+        seen.add(rule.get("id"))
+        if rule.get("kind") not in RULE_KINDS:
+            raise ValueError(f"Badge rule {rule.get('id')}: unknown kind {rule.get('kind')!r}")
+        if rule["kind"] == "count" and (rule.get("window", "all") not in WINDOWS or not rule.get("event") or rule.get("count", 0) < 1):
+            raise ValueError(f"Badge rule {rule['id']}: count rules need an event, a count >= 1 and a window in {WINDOWS}")
+    return rules
+
+
+def window_key(window: str, timestamp: datetime) -> str:
+    if window == "week":
+        year, week, _ = timestamp.isocalendar()
+        return f"{year}-W{week:02d}"
+    if window == "day":
+        return timestamp.strftime("%Y-%m-%d")
+    return "all"
+
+
+class BadgeEngine:
+    def __init__(self, rules: Iterable[Dict] = BADGE_RULES):
+        self.rules = validate_rules(rules)
+        self.by_id = {rule["id"]: rule for rule in self.rules}
+        # Event type -> rules that look at it, so an event only touches relevant rules
+        self._rules_for_event: Dict[str, List[Dict]] = {}
+        for rule in self.rules:
+            event_type = rule["event"] if rule["kind"] == "count" else rule["kind"]
+            self._rules_for_event.setdefault(event_type, []).append(rule)
+
+    def counter_updates(self, event: Dict) -> List[Tuple[Dict, str]]:
+        """(rule, window key) for every counting rule this event increments."""
+        updates = []
+        for rule in self._rules_for_event.get(event["type"], ()):
+            if rule["kind"] != "count":
+                continue
+            if rule.get("category") and event.get("category") != rule["category"]:
+                continue
+            updates.append((rule, window_key(rule.get("window", "all"), event.get("timestamp") or datetime.utcnow())))
+        return updates
+
+    def threshold_badges(self, event: Dict) -> List[Dict]:
+        """Stateless rules crossed by this event."""
+        crossed = []
+        for rule in self._rules_for_event.get(event["type"], ()):
+            if rule["kind"] == "streak" and event.get("streak_days") == rule["days"]:
+                crossed.append(rule)
+            elif rule["kind"] == "points" and event.get("points_before", 0) < rule["points"] <= event.get("points", 0):
+                crossed.append(rule)
+        return crossed
+
+    @staticmethod
+    def count_reached(rule: Dict, new_count: int) -> bool:
+        # Counters grow by one, so only the increment that hits the threshold awards the badge
+        return new_count == rule["count"]
+
+
+def replay(engine: BadgeEngine, events: Iterable[Dict], rule_ids: Optional[Iterable[str]] = None) -> Tuple[Dict, Dict]:
+    """
+    Backfill: feeds historical events (sorted by timestamp) through the rules in memory.
+    Streak events are derived from the activity dates the same way award_points counts
+    them. Returns ({(user_id, rule_id, window_key): count}, {user_id: [badge names]}).
+    """
+    wanted = set(rule_ids) if rule_ids is not None else None
+    counters: Dict[Tuple[str, str, str], int] = {}
+    awarded: Dict[str, List[str]] = {}
+    streaks: Dict[str, Tuple[date, int]] = {}
+
+    def award(user_id: str, rule: Dict):
+        names = awarded.setdefault(user_id, [])
+        if rule["name"] not in names:
+            names.append(rule["name"])
+
+    def apply(event: Dict):
+        for rule, key in engine.counter_updates(event):
+            if wanted is not None and rule["id"] not in wanted:
+                continue
+            counter = (event["user_id"], rule["id"], key)
+            counters[counter] = counters.get(counter, 0) + 1
+            if engine.count_reached(rule, counters[counter]):
+                award(event["user_id"], rule)
+        for rule in engine.threshold_badges(event):
+            if wanted is None or rule["id"] in wanted:
+                award(event["user_id"], rule)
+
+    for event in events:
+        apply(event)
+        if event["type"] in ("food_entry", "question_response") and event.get("timestamp"):
+            day = event["timestamp"].date()
+            last_day, streak = streaks.get(event["user_id"], (None, 0))
+            if last_day == day:
+                continue
+            streak = streak + 1 if last_day == day - timedelta(days=1) else 1
+            streaks[event["user_id"]] = (day, streak)
+            apply({"type": "streak", "user_id": event["user_id"], "streak_days": streak})
+    return counters, awarded
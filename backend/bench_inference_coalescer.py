@@ -0,0 +1,95 @@
+"""
+Benchmark for the food analysis path: direct model calls vs InflightCoalescer.
+
+The coalescer is built exactly as server.py builds `food_analysis_calls`
+(same wrapper signature, default max_concurrency), with a stub in place of
+analyze_food_with_huggingface. The stub behaves like the hosted classifier:
+every request takes a fixed round trip, and the service runs only a few
+requests per token at a time, queueing the rest.
+
+A burst of requests draws its food names from `--distinct` names, like a class
+checking the same lunch items. Raise --distinct to see how the gain shrinks
+as fewer concurrent requests overlap.
+
+    python bench_inference_coalescer.py [--requests 200] [--concurrency 50]
+        [--distinct 20] [--call-ms 80] [--remote-slots 4]
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from inference_coalescer import InflightCoalescer
+
+
+class StubHostedClassifier:
+    def __init__(self, call_ms: float, remote_slots: int):
+        self.call_s = call_ms / 1000.0
+        self._remote_slots = asyncio.Semaphore(remote_slots)  # Concurrent requests the service accepts per token
+        self.calls = 0
+
+    async def analyze(self, food_name: str, image_data=None):
+        async with self._remote_slots:
+            self.calls += 1
+            await asyncio.sleep(self.call_s)
+        return {"food_name": food_name, "score": len(food_name) % 10}
+
+
+async def run_burst(analyze, food_names, concurrency: int):
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(food_name: str):
+        async with slots:
+            started = time.perf_counter()
+            await analyze(food_name)
+            latencies.append((time.perf_counter() - started) * 1000.0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(food_name) for food_name in food_names))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "elapsed_s": elapsed,
+        "throughput": len(food_names) / elapsed,
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1],
+    }
+
+
+def print_result(name: str, result, model_calls: int):
+    print(f"{name:10} {result['throughput']:8.1f} req/s   p50 {result['p50_ms']:7.1f} ms   "
+          f"p95 {result['p95_ms']:7.1f} ms   model calls {model_calls}")
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    food_names = [f"food-{rng.randrange(args.distinct)}" for _ in range(args.requests)]
+
+    direct_model = StubHostedClassifier(args.call_ms, args.remote_slots)
+    direct = await run_burst(direct_model.analyze, food_names, args.concurrency)
+
+    coalesced_model = StubHostedClassifier(args.call_ms, args.remote_slots)
+    # Same construction and call shape as food_analysis_calls / analyze_food_coalesced in server.py
+    coalescer = InflightCoalescer(lambda food_name, image_data=None: coalesced_model.analyze(food_name, image_data))
+    coalesced = await run_burst(lambda food_name: coalescer.submit((food_name, None)), food_names, args.concurrency)
+    await coalescer.stop()
+
+    print(f"{args.requests} requests over {len(set(food_names))} distinct foods, {args.concurrency} concurrent, "
+          f"stub model {args.call_ms} ms/call, {args.remote_slots} remote slots")
+    print_result("direct", direct, direct_model.calls)
+    print_result("coalesced", coalesced, coalesced_model.calls)
+    print(f"coalescer: {coalescer.stats()}")
+    print(f"throughput ratio: {coalesced['throughput'] / direct['throughput']:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark coalesced food analysis calls against a stub hosted model.")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--distinct", type=int, default=20)
+    parser.add_argument("--call-ms", type=float, default=80)
+    parser.add_argument("--remote-slots", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,92 @@
+"""
+Login-storm benchmark: event loop responsiveness while a class logs in at once.
+
+A probe task sleeps 10 ms in a loop and records how late it wakes up; that
+lag is what every other request on the worker sees. The same burst of logins
+(a mix of hashed, legacy plain-text and wrong-password attempts) is verified
+on the event loop and then through PasswordHasher's worker pool.
+
+    python bench_login_storm.py [--logins 60] [--profile standard] [--workers 2]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from password_hashing import LEGACY_PREFIX, PasswordHasher
+
+PROBE_INTERVAL_S = 0.010
+
+
+async def probe_lag(stop: asyncio.Event, lags):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL_S)
+        lags.append((time.perf_counter() - started - PROBE_INTERVAL_S) * 1000.0)
+
+
+def make_users(hasher: PasswordHasher, count: int):
+    """(password attempt, stored value) per login: 1/3 hashed, 1/3 legacy, 1/6 wrong password."""
+    stored_hash = hasher.hash_blocking("appel123")
+    users = []
+    for i in range(count):
+        if i % 3 == 0:
+            users.append(("appel123", stored_hash))
+        elif i % 3 == 1:
+            users.append(("appel123", LEGACY_PREFIX + "appel123" if i % 2 else "appel123"))
+        else:
+            users.append(("appel123" if i % 2 else "peer456", stored_hash))
+    return users
+
+
+async def run_storm(verify, users):
+    stop = asyncio.Event()
+    lags = []
+    probe = asyncio.create_task(probe_lag(stop, lags))
+    await asyncio.sleep(0.05)  # Baseline ticks before the storm
+    started = time.perf_counter()
+    results = await asyncio.gather(*(verify(password, stored) for password, stored in users))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    lags.sort()
+    return {
+        "elapsed_s": elapsed,
+        "valid": sum(1 for valid, _ in results if valid),
+        "upgraded": sum(1 for _, new_hash in results if new_hash),
+        "lag_p50_ms": statistics.median(lags),
+        "lag_p99_ms": lags[max(0, int(len(lags) * 0.99) - 1)],
+        "lag_max_ms": lags[-1],
+        "ticks": len(lags),
+    }
+
+
+def print_result(name: str, result):
+    print(f"{name:8} {result['elapsed_s']:6.2f} s   valid {result['valid']:3}   upgraded {result['upgraded']:3}   "
+          f"loop lag p50 {result['lag_p50_ms']:7.1f} ms   p99 {result['lag_p99_ms']:7.1f} ms   "
+          f"max {result['lag_max_ms']:7.1f} ms   probe ticks {result['ticks']}")
+
+
+async def main(args):
+    hasher = PasswordHasher(profile=args.profile, workers=args.workers)
+    users = make_users(hasher, args.logins)
+
+    async def verify_inline(password, stored):
+        return hasher.verify_and_update_blocking(password, stored)
+
+    inline = await run_storm(verify_inline, users)
+    pooled = await run_storm(hasher.verify_and_update, users)
+    hasher.shutdown()
+
+    print(f"{args.logins} concurrent logins, profile {args.profile} ({hasher.context.default_scheme()}), {args.workers} workers")
+    print_result("inline", inline)
+    print_result("pooled", pooled)
+    print(f"hasher: {hasher.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure event loop lag during a burst of logins.")
+    parser.add_argument("--logins", type=int, default=60)
+    parser.add_argument("--profile", default="standard")
+    parser.add_argument("--workers", type=int, default=2)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,109 @@
+"""
+Memory per record for the in-memory representations of users and entries.
+
+Generates a synthetic school as JSON (like users.json / food_entries.json),
+loads it as plain dicts, as compact_records types and, when pydantic is
+installed, as Pydantic models, and reports bytes per record measured with
+tracemalloc.
+
+    python bench_record_memory.py [--users 20000] [--entries 100000]
+"""
+import argparse
+import gc
+import json
+import random
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+from compact_records import AnalysisRecord, EntryColumns, UserRecord
+
+try:
+    from pydantic import BaseModel
+except ImportError:
+    BaseModel = None
+
+FOODS = [("apple", "fruit", "Perfect healthy snack! Rich in fiber and vitamins."),
+         ("pizza", "processed", "Try a salad or fruit instead for better nutrition."),
+         ("carrot", "vegetable", "Great for your eyes and skin. Rich in beta-carotene."),
+         ("chips", "snacks", "Consider nuts, carrot sticks, or air-popped popcorn instead.")]
+
+
+def synthetic_json(users: int, entries: int):
+    random.seed(1)
+    now = datetime(2026, 10, 1)
+    user_list = [{
+        "id": str(uuid.uuid4()), "username": f"student{i}", "password_hash": "UNHASHED_x",
+        "class_code": f"KLAS{i % 40}", "role": "student_class_1", "points": random.randint(0, 900),
+        "level": random.randint(1, 9), "badges": ["7-day streak"] if i % 5 == 0 else [], "streak_days": random.randint(0, 30),
+        "last_entry_date": "2026-09-30", "created_at": now.isoformat(),
+    } for i in range(users)]
+    entry_list = []
+    for i in range(entries):
+        food, category, tips = random.choice(FOODS)
+        entry_list.append({
+            "id": str(uuid.uuid4()), "user_id": user_list[i % users]["id"], "food_name": food, "meal_type": "snack",
+            "quantity": "1", "ai_score": random.randint(1, 10), "ai_feedback": tips, "ai_suggestions": [tips],
+            "calories_estimated": 80.0, "nutrition_info": {"category": category, "detected_food": food},
+            "points_earned": 5, "timestamp": (now - timedelta(minutes=i)).isoformat(),
+        })
+    # Round-trip through JSON so strings are distinct objects, as after load_*()
+    return json.dumps(user_list), json.dumps(entry_list)
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes per in-memory user/entry record.")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--entries", type=int, default=100000)
+    args = parser.parse_args()
+
+    users_json, entries_json = synthetic_json(args.users, args.entries)
+    user_dicts = json.loads(users_json)
+    entry_dicts = json.loads(entries_json)
+
+    rows = []
+    _, size = measure(lambda: json.loads(users_json))
+    rows.append(("users", "dicts (load_users)", size / args.users))
+    _, size = measure(lambda: [UserRecord.from_json(record) for record in json.loads(users_json)])
+    rows.append(("users", "UserRecord (slots)", size / args.users))
+    if BaseModel is not None:
+        class UserModel(BaseModel):
+            id: str
+            username: str
+            class_code: str
+            role: str
+            points: int
+            level: int
+            badges: list
+            streak_days: int
+            last_entry_date: str
+            created_at: datetime
+        _, size = measure(lambda: [UserModel.model_validate(record) for record in json.loads(users_json)])
+        rows.append(("users", "Pydantic User", size / args.users))
+
+    _, size = measure(lambda: json.loads(entries_json))
+    rows.append(("entries", "dicts (load_food_entries)", size / args.entries))
+    _, size = measure(lambda: EntryColumns(json.loads(entries_json)))
+    rows.append(("entries", "EntryColumns (arrays)", size / args.entries))
+    _, size = measure(lambda: [{field: entry.get(field) for field in AnalysisRecord.FIELDS} for entry in json.loads(entries_json)])
+    rows.append(("analyses", "dicts (photo index)", size / args.entries))
+    _, size = measure(lambda: [AnalysisRecord.from_mapping(entry) for entry in json.loads(entries_json)])
+    rows.append(("analyses", "AnalysisRecord (slots)", size / args.entries))
+
+    del user_dicts, entry_dicts
+    print(f"{args.users} users, {args.entries} entries")
+    for kind, representation, per_record in rows:
+        print(f"{kind:9} {representation:26} {per_record:8.0f} bytes/record")
+
+
+if __name__ == "__main__":
+    main()
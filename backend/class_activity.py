@@ -0,0 +1,208 @@
+"""
+Class activity matrix for the teacher dashboard: students x days.
+
+For one class and date window the endpoint pulls a single columnar slice of
+the class's food entries (user id, timestamp, score, calories; see
+EntryColumns) and builds every cell at once with numpy: each entry gets a
+flat cell index student * days + day, and np.bincount sums the entry counts,
+scores and calories per cell. Missing scores and calories (NaN, analysis
+still pending) are left out of the averages.
+
+Built matrices are cached per class and window. A new entry or a finished
+analysis updates the cached cells of this process in place; other workers
+drop their copy of the class when they hear about it over the invalidation
+bus, and every matrix is rebuilt after ACTIVITY_CACHE_TTL_SECONDS anyway.
+"""
+import os
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from compact_records import EntryColumns
+
+ACTIVITY_DEFAULT_DAYS = int(os.environ.get("SNACKCHECK_ACTIVITY_DEFAULT_DAYS", "28"))
+ACTIVITY_MAX_DAYS = int(os.environ.get("SNACKCHECK_ACTIVITY_MAX_DAYS", "92"))
+ACTIVITY_CACHE_SIZE = int(os.environ.get("SNACKCHECK_ACTIVITY_CACHE_SIZE", "64"))
+ACTIVITY_CACHE_TTL_SECONDS = float(os.environ.get("SNACKCHECK_ACTIVITY_CACHE_TTL_SECONDS", "300"))
+
+SECONDS_PER_DAY = 86400
+
+
+def day_origin(day: date) -> float:
+    """Unix seconds of midnight UTC at the start of `day`."""
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp()
+
+
+def _seconds(moment: datetime) -> float:
+    return (moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)).timestamp()
+
+
+class ActivityMatrix:
+    """Per-cell sums for one class and window; averages are derived when serializing."""
+
+    def __init__(self, class_code: str, start: date, end: date, students: List[Tuple[str, str]]):
+        self.class_code = class_code
+        self.start = start
+        self.end = end  # Inclusive
+        self.students = students  # (user id, username), in row order
+        self.row_of: Dict[str, int] = {user_id: row for row, (user_id, _) in enumerate(students)}
+        self.origin = day_origin(start)
+        self.built_at = time.monotonic()
+        shape = (len(students), self.days)
+        self.entries = np.zeros(shape, dtype=np.int64)
+        self.score_sum = np.zeros(shape)
+        self.score_count = np.zeros(shape, dtype=np.int64)
+        self.calorie_sum = np.zeros(shape)
+        self.calorie_count = np.zeros(shape, dtype=np.int64)
+
+    @property
+    def days(self) -> int:
+        return (self.end - self.start).days + 1
+
+    @classmethod
+    def build(cls, class_code: str, start: date, end: date, students: List[Tuple[str, str]],
+              columns: EntryColumns) -> "ActivityMatrix":
+        matrix = cls(class_code, start, end, students)
+        if not len(columns) or not students:
+            return matrix
+        rows = np.fromiter((matrix.row_of.get(user_id, -1) for user_id in columns.user_ids), dtype=np.int64, count=len(columns))
+        timestamps = np.frombuffer(columns.timestamps, dtype=np.float64)
+        days = np.floor((timestamps - matrix.origin) / SECONDS_PER_DAY)
+        # Entries of teachers, of students who left the class and outside the window fall off
+        keep = (rows >= 0) & (days >= 0) & (days < matrix.days)
+        cells = rows[keep] * matrix.days + days[keep].astype(np.int64)
+        size = len(students) * matrix.days
+        scores = np.frombuffer(columns.ai_score, dtype=np.float32)[keep].astype(np.float64)
+        calories = np.frombuffer(columns.calories, dtype=np.float32)[keep].astype(np.float64)
+
+        matrix.entries += np.bincount(cells, minlength=size).reshape(matrix.entries.shape)
+        scored = ~np.isnan(scores)
+        matrix.score_sum += np.bincount(cells[scored], weights=scores[scored], minlength=size).reshape(matrix.entries.shape)
+        matrix.score_count += np.bincount(cells[scored], minlength=size).reshape(matrix.entries.shape)
+        counted = ~np.isnan(calories)
+        matrix.calorie_sum += np.bincount(cells[counted], weights=calories[counted], minlength=size).reshape(matrix.entries.shape)
+        matrix.calorie_count += np.bincount(cells[counted], minlength=size).reshape(matrix.entries.shape)
+        return matrix
+
+    def cell(self, user_id: str, timestamp: datetime) -> Optional[Tuple[int, int]]:
+        row = self.row_of.get(user_id)
+        if row is None:
+            return None
+        day = int((_seconds(timestamp) - self.origin) // SECONDS_PER_DAY)
+        return (row, day) if 0 <= day < self.days else None
+
+    def add_entry(self, user_id: str, timestamp: datetime, ai_score: Optional[float] = None,
+                  calories: Optional[float] = None) -> bool:
+        cell = self.cell(user_id, timestamp)
+        if cell is None:
+            return False
+        self.entries[cell] += 1
+        self.add_analysis(user_id, timestamp, ai_score, calories)
+        return True
+
+    def add_analysis(self, user_id: str, timestamp: datetime, ai_score: Optional[float], calories: Optional[float]):
+        """Adds the score and calories of an entry counted earlier without them."""
+        cell = self.cell(user_id, timestamp)
+        if cell is None:
+            return
+        if ai_score is not None:
+            self.score_sum[cell] += ai_score
+            self.score_count[cell] += 1
+        if calories is not None:
+            self.calorie_sum[cell] += calories
+            self.calorie_count[cell] += 1
+
+    @staticmethod
+    def _averages(sums: np.ndarray, counts: np.ndarray, decimals: int) -> List:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            averages = np.round(sums / counts, decimals)
+        return np.where(counts > 0, averages, None).tolist()
+
+    def to_response(self) -> Dict:
+        return {
+            "class_code": self.class_code,
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+            "days": [(self.start + timedelta(days=offset)).isoformat() for offset in range(self.days)],
+            "students": [{"id": user_id, "username": username} for user_id, username in self.students],
+            "entries": self.entries.tolist(),
+            "avg_score": self._averages(self.score_sum, self.score_count, 2),
+            "avg_calories": self._averages(self.calorie_sum, self.calorie_count, 1),
+            "daily_totals": {
+                "entries": self.entries.sum(axis=0).tolist(),
+                "active_students": (self.entries > 0).sum(axis=0).tolist(),
+                "avg_score": self._averages(self.score_sum.sum(axis=0), self.score_count.sum(axis=0), 2),
+            },
+        }
+
+    def summary(self, top: int = 5) -> Dict:
+        """Class totals over the whole window, as stored in the weekly class reports."""
+        per_student = self.entries.sum(axis=1)
+        most_active = np.argsort(-per_student, kind="stable")[:top]
+        return {
+            "class_code": self.class_code,
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+            "students": len(self.students),
+            "active_students": int((per_student > 0).sum()),
+            "total_entries": int(per_student.sum()),
+            "avg_score": self._averages(self.score_sum.sum(), self.score_count.sum(), 2),
+            "avg_calories": self._averages(self.calorie_sum.sum(), self.calorie_count.sum(), 1),
+            "daily_entries": self.entries.sum(axis=0).tolist(),
+            "most_active": [
+                {"id": self.students[row][0], "username": self.students[row][1], "entries": int(per_student[row])}
+                for row in most_active if per_student[row] > 0
+            ],
+        }
+
+
+class ActivityCache:
+    """Least recently used matrices by (class code, start, end)."""
+
+    def __init__(self, max_size: int = ACTIVITY_CACHE_SIZE, ttl_seconds: float = ACTIVITY_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._matrices: "OrderedDict[Tuple[str, date, date], ActivityMatrix]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, class_code: str, start: date, end: date) -> Optional[ActivityMatrix]:
+        key = (class_code, start, end)
+        matrix = self._matrices.get(key)
+        if matrix is None or time.monotonic() - matrix.built_at > self.ttl_seconds:
+            self._matrices.pop(key, None)
+            self.misses += 1
+            return None
+        self._matrices.move_to_end(key)
+        self.hits += 1
+        return matrix
+
+    def put(self, matrix: ActivityMatrix):
+        self._matrices[(matrix.class_code, matrix.start, matrix.end)] = matrix
+        self._matrices.move_to_end((matrix.class_code, matrix.start, matrix.end))
+        while len(self._matrices) > self.max_size:
+            self._matrices.popitem(last=False)
+
+    def on_new_entry(self, user_id: str, timestamp: datetime, ai_score: Optional[float] = None,
+                     calories: Optional[float] = None):
+        for matrix in self._matrices.values():
+            matrix.add_entry(user_id, timestamp, ai_score, calories)
+
+    def on_analysis(self, user_id: str, timestamp: datetime, ai_score: Optional[float], calories: Optional[float]):
+        for matrix in self._matrices.values():
+            matrix.add_analysis(user_id, timestamp, ai_score, calories)
+
+    def invalidate_class(self, class_code: Optional[str] = None):
+        """Drops one class's matrices, or all of them."""
+        for key in [key for key in self._matrices if class_code is None or key[0] == class_code]:
+            del self._matrices[key]
+
+    def forget_user(self, user_id: str):
+        for key in [key for key, matrix in self._matrices.items() if user_id in matrix.row_of]:
+            del self._matrices[key]
+
+    def stats(self) -> Dict:
+        return {"matrices": len(self._matrices), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,166 @@
+"""
+Compact in-memory record types.
+
+Plain dicts cost a hash table per record, and every copy of "student_class_1"
+or a class code loaded from JSON is its own string object. These types store
+the same data with less overhead:
+
+* UserRecord / AnalysisRecord: __slots__ dataclasses (no per-instance dict),
+  with labels such as class_code, role and repeated AI feedback interned.
+* EntryColumns: one typed array per numeric field (ai_score, calories, points,
+  timestamp) for large collections of entries that are scanned rather than
+  looked up field by field.
+
+Pydantic models are only built at the response boundary: to_response()
+returns the plain dict FastAPI validates against the endpoint's
+response_model, so nothing is converted twice.
+
+bench_record_memory.py measures bytes per user/entry for each representation.
+"""
+import math
+import sys
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, ClassVar, Dict, Iterable, List, Optional, Tuple
+
+
+def intern_label(value):
+    """Shares one string object for values that repeat across many records."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+@dataclass(slots=True)
+class UserRecord:
+    id: str
+    username: str
+    class_code: str
+    role: str
+    points: int = 0
+    level: int = 1
+    streak_days: int = 0
+    badges: Tuple[str, ...] = ()
+    last_entry_date: Optional[str] = None
+    created_at: Any = None
+
+    @classmethod
+    def from_json(cls, record: Dict) -> "UserRecord":
+        """From a users.json record; the password hash is never kept."""
+        return cls(
+            id=record.get("id"),
+            username=record.get("username", ""),
+            class_code=intern_label(record.get("class_code", "")),
+            role=intern_label(record.get("role", "")),
+            points=int(record.get("points") or 0),
+            level=int(record.get("level") or 1),
+            streak_days=int(record.get("streak_days") or 0),
+            badges=tuple(intern_label(badge) for badge in record.get("badges") or ()),
+            last_entry_date=record.get("last_entry_date"),
+            created_at=record.get("created_at"),
+        )
+
+    @classmethod
+    def from_row(cls, row) -> "UserRecord":
+        """From a UserDb instance or a result row with the same column names."""
+        return cls(
+            id=row.id,
+            username=row.username,
+            class_code=intern_label(row.class_code),
+            role=intern_label(row.role),
+            points=row.points or 0,
+            level=row.level or 1,
+            streak_days=row.streak_days or 0,
+            badges=tuple(intern_label(badge) for badge in row.badges or ()),
+            last_entry_date=row.last_entry_date,
+            created_at=row.created_at,
+        )
+
+    def to_response(self) -> Dict:
+        return {
+            "id": self.id,
+            "username": self.username,
+            "class_code": self.class_code,
+            "role": self.role,
+            "points": self.points,
+            "level": self.level,
+            "streak_days": self.streak_days,
+            "badges": list(self.badges),
+            "last_entry_date": self.last_entry_date,
+            "created_at": self.created_at,
+        }
+
+
+@dataclass(slots=True)
+class AnalysisRecord:
+    """The AI analysis fields of a food entry, as kept by the photo dedupe index."""
+    FIELDS: ClassVar[Tuple[str, ...]] = ("ai_score", "ai_feedback", "ai_suggestions", "calories_estimated", "nutrition_info")
+
+    ai_score: Optional[float]
+    ai_feedback: Optional[str] = None
+    ai_suggestions: Tuple[str, ...] = ()
+    calories_estimated: Optional[float] = None
+    nutrition_info: Optional[Dict] = None
+
+    @classmethod
+    def from_mapping(cls, values) -> "AnalysisRecord":
+        """From a dict or any object with the analysis fields as attributes."""
+        get = values.get if isinstance(values, dict) else lambda name: getattr(values, name, None)
+        nutrition_info = get("nutrition_info")
+        if isinstance(nutrition_info, dict):
+            # Category and detected food repeat across thousands of entries
+            nutrition_info = {intern_label(key): intern_label(value) for key, value in nutrition_info.items()}
+        return cls(
+            ai_score=get("ai_score"),
+            # Fallback feedback texts are the same for every entry of a food
+            ai_feedback=intern_label(get("ai_feedback")),
+            ai_suggestions=tuple(intern_label(suggestion) for suggestion in get("ai_suggestions") or ()),
+            calories_estimated=get("calories_estimated"),
+            nutrition_info=nutrition_info,
+        )
+
+    def as_dict(self) -> Dict:
+        return {
+            "ai_score": self.ai_score,
+            "ai_feedback": self.ai_feedback,
+            "ai_suggestions": list(self.ai_suggestions),
+            "calories_estimated": self.calories_estimated,
+            "nutrition_info": dict(self.nutrition_info) if self.nutrition_info is not None else None,
+        }
+
+
+class EntryColumns:
+    """Column store for food entries; a missing ai_score/calories value is stored as NaN."""
+
+    def __init__(self, records: Iterable[Dict] = ()):
+        self.ids: List[str] = []
+        self.user_ids: List[str] = []
+        self.ai_score = array("f")
+        self.calories = array("f")
+        self.points = array("l")
+        self.timestamps = array("d")  # Unix seconds
+        for record in records:
+            self.append(record)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @staticmethod
+    def _number(value) -> float:
+        return math.nan if value is None else float(value)
+
+    @staticmethod
+    def _seconds(value) -> float:
+        if isinstance(value, str) and value:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if isinstance(value, datetime):
+            # Naive timestamps are UTC, like everywhere in the database
+            return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+        return math.nan
+
+    def append(self, record: Dict):
+        self.ids.append(record.get("id"))
+        self.user_ids.append(intern_label(record.get("user_id")))  # One string per user, not per entry
+        self.ai_score.append(self._number(record.get("ai_score")))
+        self.calories.append(self._number(record.get("calories_estimated")))
+        self.points.append(int(record.get("points_earned") or 0))
+        self.timestamps.append(self._seconds(record.get("timestamp")))
@@ -0,0 +1,234 @@
+"""
+The SQLAlchemy models, their indexes and the database location.
+
+Kept apart from server.py so scripts (migrations, shard onboarding, archiving,
+the query-plan check) can import the schema without starting the app.
+"""
+import logging
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import JSON as SAJson, Boolean, DateTime, Float, ForeignKey, Index, Integer, String, Text  # Renamed JSON to SAJson to avoid conflict with 'import json'
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+DATABASE_URL = "sqlite+aiosqlite:///./snackcheck_local.db"  # Local SQLite file, ensure aiosqlite is in requirements.txt
+
+Base = declarative_base()
+
+# User Roles
+USER_ROLES = {
+    "STUDENT_CLASS_1": "student_class_1",
+    "STUDENT_CLASS_2": "student_class_2", 
+    "STUDENT_CLASS_3": "student_class_3",
+    "TEACHER": "teacher",
+    "ADMIN": "admin"
+}
+
+# --- SQLAlchemy Database Models ---
+class UserDb(Base):
+    __tablename__ = "users"
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    username: Mapped[str] = mapped_column(String(100), index=True)
+    password_hash: Mapped[str] = mapped_column(String(256))
+    class_code: Mapped[str] = mapped_column(String(50), index=True)
+    role: Mapped[str] = mapped_column(String(50))
+    points: Mapped[int] = mapped_column(Integer, default=0)
+    level: Mapped[int] = mapped_column(Integer, default=1)
+    badges: Mapped[List[str]] = mapped_column(SAJson, default=lambda: []) # Use lambda for default mutable list
+    streak_days: Mapped[int] = mapped_column(Integer, default=0)
+    last_entry_date: Mapped[Optional[str]] = mapped_column(String(10), nullable=True) # Format YYYY-MM-DD
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    daily_calorie_goal_override: Mapped[Optional[float]] = mapped_column(Float, nullable=True)  # None: DEFAULT_CALORIE_GOAL
+    daily_protein_goal_override: Mapped[Optional[float]] = mapped_column(Float, nullable=True)  # None: DEFAULT_PROTEIN_GOAL
+
+class FoodEntryDb(Base):
+    __tablename__ = "food_entries"
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
+    food_name: Mapped[str] = mapped_column(String(255))
+    meal_type: Mapped[str] = mapped_column(String(50))
+    quantity: Mapped[str] = mapped_column(String(100))
+    quantity_grams: Mapped[Optional[float]] = mapped_column(Float, nullable=True)  # quantity parsed once on insert (see nutrition_ledger.py)
+    image_data: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # Base64 encoded image
+    image_url: Mapped[Optional[str]] = mapped_column(String(512), nullable=True)
+    image_sha256: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, index=True)  # Set by streaming uploads
+    image_phash: Mapped[Optional[str]] = mapped_column(String(16), nullable=True)  # dHash (hex) for near-duplicate lookup
+    ai_score: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    ai_feedback: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    ai_suggestions: Mapped[Optional[List[str]]] = mapped_column(SAJson, nullable=True)
+    calories_estimated: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    nutrition_info: Mapped[Optional[Dict]] = mapped_column(SAJson, nullable=True)
+    points_earned: Mapped[int] = mapped_column(Integer, default=0)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+class CalorieCheckDb(Base):
+    __tablename__ = "calorie_checks"
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
+    food_name: Mapped[str] = mapped_column(String(255))
+    quantity: Mapped[str] = mapped_column(String(100))
+    calories_per_100g: Mapped[float] = mapped_column(Float)
+    estimated_calories: Mapped[float] = mapped_column(Float)
+    nutrition_breakdown: Mapped[Optional[Dict]] = mapped_column(SAJson, nullable=True)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class FoodComparisonDb(Base):
+    __tablename__ = "food_comparisons"
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
+    food_1: Mapped[str] = mapped_column(String(255))
+    food_2: Mapped[str] = mapped_column(String(255))
+    comparison_result: Mapped[Dict] = mapped_column(SAJson)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class ChatMessageDb(Base):
+    __tablename__ = "chat_messages"
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
+    username: Mapped[str] = mapped_column(String(100))
+    message: Mapped[str] = mapped_column(Text)
+    is_admin: Mapped[bool] = mapped_column(Boolean, default=False)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+class DailyQuestionDb(Base):
+    __tablename__ = "daily_questions"
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    question: Mapped[str] = mapped_column(Text)
+    options: Mapped[List[str]] = mapped_column(SAJson)
+    date: Mapped[str] = mapped_column(String(10), index=True)  # YYYY-MM-DD
+    active: Mapped[bool] = mapped_column(Boolean, default=True)
+    points_reward: Mapped[int] = mapped_column(Integer, default=5)
+
+class QuestionResponseDb(Base):
+    __tablename__ = "question_responses"
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
+    question_id: Mapped[str] = mapped_column(String(36), ForeignKey("daily_questions.id"), index=True)
+    answer: Mapped[str] = mapped_column(Text)
+    points_earned: Mapped[int] = mapped_column(Integer, default=0)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)  # Export ranges
+
+class GalleryDb(Base):
+    __tablename__ = "gallery_items"
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
+    username: Mapped[str] = mapped_column(String(100))
+    food_name: Mapped[str] = mapped_column(String(255))
+    image_data: Mapped[str] = mapped_column(Text)  # Base64 encoded image ("" when image_url is used)
+    image_url: Mapped[Optional[str]] = mapped_column(String(512), nullable=True)  # Streaming uploads
+    ai_score: Mapped[float] = mapped_column(Float)
+    likes: Mapped[int] = mapped_column(Integer, default=0)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+class GalleryLikeDb(Base):
+    """Who liked which gallery item, so a user's like counts once; GalleryDb.likes is the running total."""
+    __tablename__ = "gallery_likes"
+
+    item_id: Mapped[str] = mapped_column(String(36), ForeignKey("gallery_items.id"), primary_key=True)
+    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), primary_key=True, index=True)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class PointsLedgerDb(Base):
+    """Append-only log of every points award; users.points is the running total."""
+    __tablename__ = "points_ledger"
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
+    points: Mapped[int] = mapped_column(Integer)
+    reason: Mapped[str] = mapped_column(String(50))  # food_entry, daily_question, class_award, ...
+    source_id: Mapped[Optional[str]] = mapped_column(String(36), nullable=True)  # Entry/response id that caused the award
+    awarded_by: Mapped[Optional[str]] = mapped_column(String(36), nullable=True)  # Teacher/admin id for manual awards
+    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+class FeedbackDb(Base):
+    __tablename__ = "feedback_items"
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
+    username: Mapped[str] = mapped_column(String(100))
+    feedback_text: Mapped[str] = mapped_column(Text)
+    category: Mapped[Optional[str]] = mapped_column(String(50), nullable=True)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+class SyncMutationDb(Base):
+    """Outcome of each /api/sync mutation, so a retried batch is not applied twice."""
+    __tablename__ = "sync_mutations"
+
+    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), primary_key=True)
+    idempotency_key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    status_code: Mapped[int] = mapped_column(Integer, default=0)  # 0 while the mutation is being applied
+    result: Mapped[Optional[Dict]] = mapped_column(SAJson, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+class BadgeCounterDb(Base):
+    """Running count per user, badge rule and window (see badge_engine.py)."""
+    __tablename__ = "badge_counters"
+
+    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), primary_key=True)
+    rule_id: Mapped[str] = mapped_column(String(50), primary_key=True)
+    window_key: Mapped[str] = mapped_column(String(10), primary_key=True)  # "all", "2026-W42", "2026-10-19"
+    count: Mapped[int] = mapped_column(Integer, default=0)
+
+class NutritionLedgerDb(Base):
+    """Running nutrition totals per user and UTC day (see nutrition_ledger.py)."""
+    __tablename__ = "nutrition_ledger"
+
+    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), primary_key=True)
+    day: Mapped[str] = mapped_column(String(10), primary_key=True)  # YYYY-MM-DD
+    entries: Mapped[int] = mapped_column(Integer, default=0)
+    analyzed: Mapped[int] = mapped_column(Integer, default=0)  # Entries whose calories are counted
+    grams: Mapped[float] = mapped_column(Float, default=0.0)
+    calories: Mapped[float] = mapped_column(Float, default=0.0)
+    protein: Mapped[float] = mapped_column(Float, default=0.0)
+
+class WeeklyClassReportDb(Base):
+    """A class's activity over one ISO week, generated by the scheduler on Monday night."""
+    __tablename__ = "weekly_class_reports"
+
+    class_code: Mapped[str] = mapped_column(String(50), primary_key=True)
+    week: Mapped[str] = mapped_column(String(10), primary_key=True)  # "2026-W42"
+    report: Mapped[Dict] = mapped_column(SAJson)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+# Composite indexes for the hot queries: filter by user then range/sort by time,
+# filter by class then sort by points. tests/test_query_plans.py verifies they are used.
+Index("ix_food_entries_user_id_timestamp", FoodEntryDb.user_id, FoodEntryDb.timestamp)
+Index("ix_users_class_code_points", UserDb.class_code, UserDb.points.desc())
+Index("uq_question_responses_question_id_user_id", QuestionResponseDb.question_id, QuestionResponseDb.user_id, unique=True)
+Index("ix_points_ledger_user_id_timestamp", PointsLedgerDb.user_id, PointsLedgerDb.timestamp)
+
+# Tables whose rows belong to one user; they live on that user's school database
+USER_OWNED_MODELS = (FoodEntryDb, ChatMessageDb, QuestionResponseDb, GalleryDb, CalorieCheckDb, FoodComparisonDb, PointsLedgerDb, BadgeCounterDb, FeedbackDb, SyncMutationDb, NutritionLedgerDb, GalleryLikeDb)
+
+
+def add_missing_columns_and_indexes(sync_conn):
+    """
+    create_all() only creates missing tables. For tables that already exist in the
+    local SQLite file, add columns and indexes that were added to the models later.
+    """
+    inspector = sa_inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=sync_conn.dialect)
+                sync_conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                logging.info(f"Added missing column {table.name}.{column.name}")
+        for index in table.indexes:
+            try:
+                index.create(sync_conn, checkfirst=True)
+            except Exception as e:
+                # e.g. a unique index over data that still has duplicates
+                logging.error(f"Could not create index {index.name}: {e}")
@@ -0,0 +1,226 @@
+"""
+Statements of the hot endpoint queries.
+
+server.py builds these queries here, and tests/test_query_plans.py runs
+EXPLAIN QUERY PLAN on the very same statements, so the tests break when an
+endpoint query changes in a way its indexes don't cover. `entries` and
+`responses` arguments are the model or a with_archives() alias of it.
+"""
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import Column, MetaData, Table, distinct, func, or_, select, union_all, update
+from sqlalchemy.orm import aliased
+
+from db_models import ChatMessageDb, DailyQuestionDb, GalleryDb, NutritionLedgerDb, PointsLedgerDb, QuestionResponseDb, USER_ROLES, UserDb
+from school_archive import archive_schema
+
+STAFF_ROLES = (USER_ROLES["TEACHER"], USER_ROLES["ADMIN"])
+GALLERY_SUMMARY_COLUMNS = (GalleryDb.id, GalleryDb.user_id, GalleryDb.username, GalleryDb.food_name, GalleryDb.ai_score, GalleryDb.likes, GalleryDb.timestamp)
+LEDGER_COLUMNS = (NutritionLedgerDb.day, NutritionLedgerDb.entries, NutritionLedgerDb.analyzed,
+                  NutritionLedgerDb.grams, NutritionLedgerDb.calories, NutritionLedgerDb.protein)
+
+
+def time_range_filters(column, start: Optional[datetime], end: Optional[datetime]) -> List:
+    filters = []
+    if start:
+        filters.append(column >= start)
+    if end:
+        filters.append(column < end)
+    return filters
+
+
+# Archive copies of the hot tables (see school_archive.py), one Table per attached school year
+archive_metadata = MetaData()
+
+
+def archive_table(table, year: int) -> Table:
+    schema = archive_schema(year)
+    key = f"{schema}.{table.name}"
+    if key not in archive_metadata.tables:
+        Table(table.name, archive_metadata, *[Column(column.name, column.type) for column in table.columns], schema=schema)
+    return archive_metadata.tables[key]
+
+
+def with_archives(model, years: Iterable[int]):
+    """The model itself, or an alias of it over the hot table plus the archives of `years`."""
+    years = list(years)
+    if not years:
+        return model
+    table = model.__table__
+    combined = union_all(select(table), *[select(archive_table(table, year)) for year in years])
+    return aliased(model, combined.subquery(table.name))
+
+
+def user_by_id(user_id: str):
+    return select(UserDb).where(UserDb.id == user_id)
+
+
+def class_students(class_code: str, *columns):
+    """The students of a class (no teachers or admins), by username."""
+    return (
+        select(*columns)
+        .where(UserDb.class_code == class_code, UserDb.role.not_in(STAFF_ROLES))
+        .order_by(UserDb.username)
+    )
+
+
+def _chat_messages(class_code: Optional[str]):
+    stmt = select(ChatMessageDb, UserDb.class_code).join(UserDb, ChatMessageDb.user_id == UserDb.id)
+    return stmt.where(UserDb.class_code == class_code) if class_code else stmt
+
+
+def recent_chat_messages(class_code: Optional[str], limit: int):
+    """Newest first; class_code None means every class (admins)."""
+    return _chat_messages(class_code).order_by(ChatMessageDb.timestamp.desc()).limit(limit)
+
+
+def chat_messages_after(class_code: Optional[str], since: datetime, limit: int, after_id: str = ""):
+    """
+    Oldest first, for sync deltas. Pages on (timestamp, id), so messages sharing the
+    timestamp of the last one sent are not skipped; after_id "" keeps all of them.
+    """
+    return (
+        _chat_messages(class_code)
+        # The >= keeps the timestamp index range; the OR only drops rows at `since` itself
+        .where(ChatMessageDb.timestamp >= since, or_(ChatMessageDb.timestamp > since, ChatMessageDb.id > after_id))
+        .order_by(ChatMessageDb.timestamp.asc(), ChatMessageDb.id.asc()).limit(limit)
+    )
+
+
+def question_responses(question_id: str):
+    return (
+        select(QuestionResponseDb, UserDb.username, UserDb.class_code)
+        .outerjoin(UserDb, QuestionResponseDb.user_id == UserDb.id)
+        .where(QuestionResponseDb.question_id == question_id)
+        .order_by(QuestionResponseDb.timestamp)
+    )
+
+
+def _class_gallery(class_code: str):
+    return select(*GALLERY_SUMMARY_COLUMNS).join(UserDb, GalleryDb.user_id == UserDb.id).where(UserDb.class_code == class_code)
+
+
+def gallery_newest(class_code: str, limit: int):
+    return _class_gallery(class_code).order_by(GalleryDb.timestamp.desc()).limit(limit)
+
+
+def gallery_top(class_code: str, since: datetime, limit: int):
+    return _class_gallery(class_code).where(GalleryDb.timestamp >= since).order_by(GalleryDb.likes.desc()).limit(limit)
+
+
+def user_entries(entries, user_id: str):
+    return select(entries).where(entries.user_id == user_id)
+
+
+def class_entries(entries, class_code: str, start: Optional[datetime], end: Optional[datetime]):
+    """Columns of a class's entries in [start, end), for the activity matrix."""
+    return (
+        select(entries.user_id, entries.timestamp, entries.ai_score, entries.calories_estimated)
+        .join(UserDb, entries.user_id == UserDb.id)
+        .where(UserDb.class_code == class_code, *time_range_filters(entries.timestamp, start, end))
+    )
+
+
+def class_summary(entries, start: Optional[datetime], end: Optional[datetime]):
+    return (
+        select(
+            UserDb.class_code,
+            func.count(entries.id).label("total_entries"),
+            func.avg(entries.ai_score).label("avg_score"),
+            func.sum(entries.points_earned).label("total_points_from_entries"),
+            func.avg(entries.calories_estimated).label("avg_calories"),
+            func.count(distinct(entries.user_id)).label("active_users")
+        )
+        .join(UserDb, entries.user_id == UserDb.id)
+        .where(*time_range_filters(entries.timestamp, start, end))
+        .group_by(UserDb.class_code)
+        .order_by(UserDb.class_code)
+    )
+
+
+def leaderboard(class_code: str, limit: int = 20):
+    return (
+        select(UserDb.id, UserDb.username, UserDb.points, UserDb.level, UserDb.badges, UserDb.class_code, UserDb.role, UserDb.streak_days, UserDb.last_entry_date, UserDb.created_at) # Explicitly list fields for Pydantic User model
+        .where(UserDb.class_code == class_code)
+        .order_by(UserDb.points.desc())
+        .limit(limit)
+    )
+
+
+def class_award_update(class_code: str, values: Dict):
+    """One UPDATE for every student of the class; returns their new totals."""
+    return (
+        update(UserDb)
+        .where(UserDb.class_code == class_code)
+        .where(UserDb.role.not_in(STAFF_ROLES))
+        .values(**values)
+        .returning(UserDb.id, UserDb.points, UserDb.level)
+    )
+
+
+def points_ledger(user_id: str, limit: int = 100):
+    return (
+        select(PointsLedgerDb)
+        .where(PointsLedgerDb.user_id == user_id)
+        .order_by(PointsLedgerDb.timestamp.desc())
+        .limit(limit)
+    )
+
+
+def class_nutrition_rows(class_code: str, first_day: str, last_day: str):
+    return (
+        select(NutritionLedgerDb.user_id, *LEDGER_COLUMNS)
+        .join(UserDb, NutritionLedgerDb.user_id == UserDb.id)
+        .where(UserDb.class_code == class_code, NutritionLedgerDb.day.between(first_day, last_day))
+    )
+
+
+def export_food_entries(entries, class_code: Optional[str], start: Optional[datetime], end: Optional[datetime]):
+    stmt = (
+        select(
+            entries.id, entries.user_id, UserDb.username, UserDb.class_code, entries.food_name,
+            entries.meal_type, entries.quantity, entries.ai_score, entries.calories_estimated,
+            entries.points_earned, entries.timestamp
+        )
+        .join(UserDb, entries.user_id == UserDb.id)
+        .where(*time_range_filters(entries.timestamp, start, end))
+        .order_by(entries.timestamp)
+    )
+    return stmt.where(UserDb.class_code == class_code) if class_code else stmt
+
+
+def export_question_responses(responses, class_code: Optional[str], start: Optional[datetime], end: Optional[datetime]):
+    stmt = (
+        select(
+            responses.id, responses.question_id, DailyQuestionDb.question, DailyQuestionDb.date.label("question_date"),
+            responses.user_id, UserDb.username, UserDb.class_code, responses.answer,
+            responses.points_earned, responses.timestamp
+        )
+        .join(UserDb, responses.user_id == UserDb.id)
+        .outerjoin(DailyQuestionDb, responses.question_id == DailyQuestionDb.id)
+        .where(*time_range_filters(responses.timestamp, start, end))
+        .order_by(responses.timestamp)
+    )
+    return stmt.where(UserDb.class_code == class_code) if class_code else stmt
+
+
+def export_class_summaries(entries, class_code: Optional[str], start: Optional[datetime], end: Optional[datetime]):
+    """One row per class per day, with the same figures as class_summary()."""
+    day = func.date(entries.timestamp)
+    stmt = (
+        select(
+            UserDb.class_code,
+            day.label("date"),
+            func.count(entries.id).label("total_entries"),
+            func.round(func.avg(entries.ai_score), 2).label("avg_score"),
+            func.coalesce(func.sum(entries.points_earned), 0).label("total_points_from_entries"),
+            func.round(func.avg(entries.calories_estimated), 1).label("avg_calories"),
+            func.count(distinct(entries.user_id)).label("active_users")
+        )
+        .join(UserDb, entries.user_id == UserDb.id)
+        .where(*time_range_filters(entries.timestamp, start, end))
+        .group_by(UserDb.class_code, day)
+        .order_by(UserDb.class_code, day)
+    )
+    return stmt.where(UserDb.class_code == class_code) if class_code else stmt
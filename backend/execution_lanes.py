@@ -0,0 +1,207 @@
+"""
+Execution lanes, so heavy admin/analytics work can't starve student requests.
+
+* Request lanes: every request is assigned a lane by method and path. The
+  "interactive" lane is unrestricted; the "heavy" lane runs at most a few
+  requests at a time and rejects new ones once its queue is full, so a burst
+  of teacher exports or deletes can only ever occupy a bounded share of the
+  event loop.
+* Work pools: blocking I/O (JSON store rewrites) goes to a bounded thread
+  pool and CPU-heavy work (image decoding and hashing) to a process pool,
+  each with a queue-depth limit, instead of running on the event loop.
+
+Every lane and pool keeps metrics: in flight, queued, completed, rejected and
+time spent waiting and running.
+"""
+import asyncio
+import functools
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+HEAVY_LANE_CONCURRENCY = int(os.environ.get("SNACKCHECK_HEAVY_LANE_CONCURRENCY", "2"))
+HEAVY_LANE_MAX_QUEUE = int(os.environ.get("SNACKCHECK_HEAVY_LANE_MAX_QUEUE", "8"))
+IO_POOL_WORKERS = int(os.environ.get("SNACKCHECK_IO_POOL_WORKERS", "4"))
+IO_POOL_MAX_QUEUE = int(os.environ.get("SNACKCHECK_IO_POOL_MAX_QUEUE", "64"))
+CPU_POOL_WORKERS = int(os.environ.get("SNACKCHECK_CPU_POOL_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+CPU_POOL_MAX_QUEUE = int(os.environ.get("SNACKCHECK_CPU_POOL_MAX_QUEUE", "32"))
+
+
+class LaneFull(Exception):
+    def __init__(self, lane: str):
+        super().__init__(f"Lane {lane} is full")
+        self.lane = lane
+
+
+class _LaneMetrics:
+    def __init__(self):
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.wait_ms = 0.0
+        self.run_ms = 0.0
+
+    def as_dict(self) -> Dict:
+        done = self.completed + self.failed
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.wait_ms / done, 2) if done else 0.0,
+            "avg_run_ms": round(self.run_ms / done, 2) if done else 0.0,
+        }
+
+
+class RequestLane:
+    """Concurrency cap plus bounded queue for requests on the event loop (None = no cap)."""
+
+    def __init__(self, name: str, max_concurrency: Optional[int] = None, max_queue: int = 0):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._slots = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self.metrics = _LaneMetrics()
+
+    async def acquire(self) -> Callable[..., None]:
+        """
+        Waits for a slot and returns the function that gives it back, called once
+        the work is done (with failed=True after an error). Further calls are no-ops.
+        """
+        metrics = self.metrics
+        if self._slots is not None and self._slots.locked() and metrics.queued >= self.max_queue:
+            metrics.rejected += 1
+            raise LaneFull(self.name)
+        queued_at = time.monotonic()
+        metrics.queued += 1
+        try:
+            if self._slots is not None:
+                await self._slots.acquire()
+        finally:
+            metrics.queued -= 1
+        started = time.monotonic()
+        metrics.wait_ms += (started - queued_at) * 1000.0
+        metrics.in_flight += 1
+        released = False
+
+        def release(failed: bool = False):
+            nonlocal released
+            if released:
+                return
+            released = True
+            if failed:
+                metrics.failed += 1
+            else:
+                metrics.completed += 1
+            metrics.in_flight -= 1
+            metrics.run_ms += (time.monotonic() - started) * 1000.0
+            if self._slots is not None:
+                self._slots.release()
+
+        return release
+
+    async def run(self, call: Callable):
+        release = await self.acquire()
+        try:
+            result = await call()
+        except BaseException:
+            release(failed=True)
+            raise
+        release()
+        return result
+
+
+class WorkPool:
+    """An executor with a queue-depth limit; the executor is created on first use."""
+
+    def __init__(self, name: str, executor_factory: Callable, workers: int, max_queue: int):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor_factory = executor_factory
+        self._executor = None
+        self.metrics = _LaneMetrics()
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        metrics = self.metrics
+        if metrics.in_flight >= self.workers + self.max_queue:
+            metrics.rejected += 1
+            raise LaneFull(self.name)
+        if self._executor is None:
+            self._executor = self._executor_factory(max_workers=self.workers)
+        submitted = time.monotonic()
+        timing = {}
+
+        def timed_call():
+            # Runs in the worker, so the time until this starts is queue wait
+            timing["started"] = time.monotonic()
+            return fn(*args, **kwargs)
+
+        metrics.in_flight += 1
+        loop = asyncio.get_running_loop()
+        try:
+            if isinstance(self._executor, ProcessPoolExecutor):
+                # Closures can't be pickled; a process pool only reports total time
+                result = await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+            else:
+                result = await loop.run_in_executor(self._executor, timed_call)
+            metrics.completed += 1
+            return result
+        except BaseException:
+            metrics.failed += 1
+            raise
+        finally:
+            metrics.in_flight -= 1
+            finished = time.monotonic()
+            started = timing.get("started", submitted)
+            metrics.wait_ms += (started - submitted) * 1000.0
+            metrics.run_ms += (finished - started) * 1000.0
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class ExecutionLanes:
+    def __init__(self, route_lanes: List[Tuple[str, str, str]]):
+        """route_lanes: (method, path regex, lane name); unmatched requests use "interactive"."""
+        self.request_lanes: Dict[str, RequestLane] = {
+            "interactive": RequestLane("interactive"),
+            "heavy": RequestLane("heavy", HEAVY_LANE_CONCURRENCY, HEAVY_LANE_MAX_QUEUE),
+        }
+        self.io = WorkPool("io", ThreadPoolExecutor, IO_POOL_WORKERS, IO_POOL_MAX_QUEUE)
+        self.cpu = WorkPool("cpu", ProcessPoolExecutor, CPU_POOL_WORKERS, CPU_POOL_MAX_QUEUE)
+        self._routes = [(method.upper(), re.compile(pattern), lane) for method, pattern, lane in route_lanes]
+        unknown = {lane for _, _, lane in self._routes} - set(self.request_lanes)
+        if unknown:
+            raise ValueError(f"Unknown request lane(s): {', '.join(sorted(unknown))}")
+
+    def lane_for(self, method: str, path: str) -> RequestLane:
+        for route_method, pattern, lane in self._routes:
+            if route_method == method and pattern.match(path):
+                return self.request_lanes[lane]
+        return self.request_lanes["interactive"]
+
+    async def run_blocking(self, fn: Callable, *args, **kwargs):
+        return await self.io.run(fn, *args, **kwargs)
+
+    async def run_cpu(self, fn: Callable, *args, **kwargs):
+        """fn and its arguments must be picklable (module-level function, plain data)."""
+        return await self.cpu.run(fn, *args, **kwargs)
+
+    def stats(self) -> Dict:
+        lanes = {name: lane.metrics.as_dict() for name, lane in self.request_lanes.items()}
+        for pool in (self.io, self.cpu):
+            queued = max(0, pool.metrics.in_flight - pool.workers)
+            lanes[pool.name] = {**pool.metrics.as_dict(), "queued": queued, "workers": pool.workers, "max_queue": pool.max_queue}
+        return lanes
+
+    def shutdown(self):
+        self.io.shutdown()
+        self.cpu.shutdown()
@@ -0,0 +1,87 @@
+"""
+Streaming CSV / NDJSON encoding for the export endpoints.
+
+Rows come from an async iterator (a server-side cursor) and are encoded into
+chunks of roughly CHUNK_BYTES, optionally gzip-compressed on the fly, so
+memory stays constant no matter how many rows an export has.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime
+from typing import AsyncIterator, Dict, Sequence
+
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+CHUNK_BYTES = 64 * 1024
+# A spreadsheet runs a cell that starts with one of these as a formula
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _plain(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _csv_cell(value):
+    """Text that a spreadsheet would evaluate (food names, chat text) is quoted with a leading '."""
+    value = _plain(value)
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+class _Gzipper:
+    def __init__(self):
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+
+    def feed(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+async def encode_rows(rows: AsyncIterator[Dict], fields: Sequence[str], fmt: str, gzip: bool = False) -> AsyncIterator[bytes]:
+    """Yields the encoded export: a CSV header line plus one line per row, or one JSON object per line."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}")
+    gzipper = _Gzipper() if gzip else None
+    text_buffer = io.StringIO()
+    csv_writer = csv.writer(text_buffer, lineterminator="\n") if fmt == "csv" else None
+    if csv_writer:
+        csv_writer.writerow(fields)
+
+    def take_chunk() -> bytes:
+        data = text_buffer.getvalue().encode("utf-8")
+        text_buffer.seek(0)
+        text_buffer.truncate()
+        return gzipper.feed(data) if gzipper else data
+
+    async for row in rows:
+        if csv_writer:
+            csv_writer.writerow([_csv_cell(row.get(field)) for field in fields])
+        else:
+            text_buffer.write(json.dumps({field: _plain(row.get(field)) for field in fields}, default=str))
+            text_buffer.write("\n")
+        if text_buffer.tell() >= CHUNK_BYTES:
+            chunk = take_chunk()
+            if chunk:  # The compressor may hold data back until it has a full block
+                yield chunk
+
+    chunk = take_chunk()
+    if gzipper:
+        chunk += gzipper.finish()
+    if chunk:
+        yield chunk
+
+
+def export_media_type(fmt: str, gzip: bool) -> str:
+    # Gzip is a .gz download, not transparent transport compression
+    return "application/gzip" if gzip else EXPORT_FORMATS[fmt]
+
+
+def export_headers(name: str, fmt: str, gzip: bool) -> Dict[str, str]:
+    filename = f"{name}.{fmt}" + (".gz" if gzip else "")
+    return {"Content-Disposition": f'attachment; filename="{filename}"'}
@@ -0,0 +1,190 @@
+"""
+Gallery feed: batched like counters, per-class feed indexes and a page cache.
+
+Likes are counted in sharded in-memory counters and flushed to the database
+in one batch every few seconds, instead of one row update per click. Each
+class keeps a precomputed "newest" and "top this week" list of lightweight
+item summaries (no image data), and serialized feed pages are cached until a
+new post or a like flush changes them.
+"""
+import json
+import threading
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+LIKE_SHARDS = 16
+LIKE_FLUSH_SECONDS = 5.0
+FEED_PAGE_SIZE = 20
+MAX_CACHED_PAGES = 2000  # Page numbers come from clients; the cache must not grow with them
+NEWEST_INDEX_SIZE = 200
+TOP_WINDOW_DAYS = 7
+FEED_KINDS = ("newest", "top_week")
+
+
+class ShardedLikeCounter:
+    """Pending like deltas, spread over shards so concurrent likes rarely contend on one lock."""
+
+    def __init__(self, shards: int = LIKE_SHARDS):
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+
+    def _shard(self, item_id: str) -> Tuple[Dict[str, int], threading.Lock]:
+        return self._shards[zlib.crc32(item_id.encode()) % len(self._shards)]
+
+    def add(self, item_id: str, delta: int = 1):
+        counts, lock = self._shard(item_id)
+        with lock:
+            counts[item_id] = counts.get(item_id, 0) + delta
+
+    def pending(self, item_id: str) -> int:
+        counts, lock = self._shard(item_id)
+        with lock:
+            return counts.get(item_id, 0)
+
+    def drain(self) -> Dict[str, int]:
+        """Takes all pending deltas, leaving the counters empty."""
+        drained: Dict[str, int] = {}
+        for counts, lock in self._shards:
+            with lock:
+                drained.update(counts)
+                counts.clear()
+        return drained
+
+    def restore(self, deltas: Dict[str, int]):
+        """Puts deltas back after a failed flush so they are retried next time."""
+        for item_id, delta in deltas.items():
+            self.add(item_id, delta)
+
+
+def rank_key(summary: Dict):
+    return (summary.get("likes", 0), summary.get("ai_score") or 0, summary.get("timestamp", ""))
+
+
+class ClassFeedIndex:
+    """Precomputed feeds for one class. Summaries are plain dicts without image data."""
+
+    def __init__(self, newest: List[Dict], recent_for_top: List[Dict]):
+        # Both lists share one summary object per item, so like updates show up in both feeds
+        self.by_id: Dict[str, Dict] = {}
+        for item in newest + recent_for_top:
+            self.by_id.setdefault(item["id"], item)
+        self.newest = [self.by_id[item["id"]] for item in newest[:NEWEST_INDEX_SIZE]]
+        self._week_ids = [item["id"] for item in recent_for_top]
+        self.top_week: List[Dict] = []
+        self.rerank()
+
+    def rerank(self):
+        cutoff = (datetime.utcnow() - timedelta(days=TOP_WINDOW_DAYS)).isoformat()
+        self._week_ids = [item_id for item_id in self._week_ids if self.by_id[item_id]["timestamp"] >= cutoff]
+        self.top_week = sorted((self.by_id[item_id] for item_id in self._week_ids), key=rank_key, reverse=True)
+
+    def add_post(self, summary: Dict):
+        self.by_id[summary["id"]] = summary
+        self.newest.insert(0, summary)
+        del self.newest[NEWEST_INDEX_SIZE:]
+        self._week_ids.append(summary["id"])
+        self.rerank()
+
+    def apply_likes(self, deltas: Dict[str, int]) -> bool:
+        changed = False
+        for item_id, delta in deltas.items():
+            summary = self.by_id.get(item_id)
+            if summary is not None:
+                summary["likes"] = summary.get("likes", 0) + delta
+                changed = True
+        if changed:
+            self.rerank()
+        return changed
+
+    def items(self, kind: str) -> List[Dict]:
+        return self.top_week if kind == "top_week" else self.newest
+
+    def export(self) -> Dict[str, List[Dict]]:
+        """Copies of the summaries, in the shape set_index() takes."""
+        return {
+            "newest": [dict(item) for item in self.newest],
+            "recent_for_top": [dict(self.by_id[item_id]) for item_id in self._week_ids],
+        }
+
+
+class GalleryFeed:
+    """Holds the per-class indexes and the serialized page cache."""
+
+    def __init__(self, page_size: int = FEED_PAGE_SIZE):
+        self.page_size = page_size
+        self.likes = ShardedLikeCounter()
+        self._indexes: Dict[str, ClassFeedIndex] = {}
+        self._pages: Dict[Tuple[str, str, int], bytes] = {}
+        self._lock = threading.Lock()
+
+    def has_index(self, class_code: str) -> bool:
+        return class_code in self._indexes
+
+    def set_index(self, class_code: str, newest: List[Dict], recent_for_top: List[Dict]):
+        with self._lock:
+            self._indexes[class_code] = ClassFeedIndex(newest, recent_for_top)
+            self._invalidate(class_code)
+
+    def _invalidate(self, class_code: str, kinds=FEED_KINDS):
+        for key in [key for key in self._pages if key[0] == class_code and key[1] in kinds]:
+            del self._pages[key]
+
+    def export_indexes(self) -> Dict[str, Dict[str, List[Dict]]]:
+        with self._lock:
+            return {class_code: index.export() for class_code, index in self._indexes.items()}
+
+    def invalidate_class(self, class_code: Optional[str] = None):
+        """Drops the index and cached pages of one class, or of all classes."""
+        with self._lock:
+            if class_code is None:
+                self._indexes.clear()
+                self._pages.clear()
+            else:
+                self._indexes.pop(class_code, None)
+                self._invalidate(class_code)
+
+    def on_new_post(self, class_code: str, summary: Dict):
+        with self._lock:
+            index = self._indexes.get(class_code)
+            if index is not None:
+                index.add_post(summary)
+            self._invalidate(class_code)
+
+    def apply_flushed_likes(self, deltas: Dict[str, int]):
+        with self._lock:
+            for class_code, index in self._indexes.items():
+                if index.apply_likes(deltas):
+                    self._invalidate(class_code)
+
+    def get_page(self, class_code: str, kind: str, page: int) -> Optional[bytes]:
+        """Returns a serialized page, or None if the class index has not been loaded yet."""
+        key = (class_code, kind, page)
+        with self._lock:
+            cached = self._pages.get(key)
+            if cached is not None:
+                return cached
+            index = self._indexes.get(class_code)
+            if index is None:
+                return None
+            items = index.items(kind)
+            start = page * self.page_size
+            page_items = items[start:start + self.page_size]
+            body = json.dumps({
+                "kind": kind,
+                "page": page,
+                "has_more": len(items) > start + self.page_size,
+                "items": page_items,
+            }).encode("utf-8")
+            if page_items or page == 0:  # Pages past the end aren't kept, or any page number would grow the cache
+                if len(self._pages) >= MAX_CACHED_PAGES:
+                    del self._pages[next(iter(self._pages))]  # Oldest first
+                self._pages[key] = body
+            return body
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "class_indexes": len(self._indexes),
+                "cached_pages": len(self._pages),
+                "cached_page_bytes": sum(len(body) for body in self._pages.values()),
+            }
@@ -0,0 +1,57 @@
+"""
+Coalescing of concurrent model inference calls.
+
+The hosted HuggingFace image classifier takes one input per request, so the
+server does not batch analyses. Instead, concurrent calls with identical
+arguments (a class looking up the same food, or retried uploads of the same
+photo) share one request. Every caller resumes as soon as that request
+finishes, and at most `max_concurrency` requests run at a time.
+
+bench_inference_coalescer.py measures this path against direct calls.
+"""
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict
+
+INFERENCE_MAX_CONCURRENCY = int(os.environ.get("SNACKCHECK_INFERENCE_CONCURRENCY", "4"))
+
+
+class InflightCoalescer:
+    """Runs `single_fn(*args)` once per distinct set of in-flight args; callers await `submit(args)`."""
+
+    def __init__(self, single_fn: Callable[..., Awaitable], max_concurrency: int = INFERENCE_MAX_CONCURRENCY):
+        self.single_fn = single_fn
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    async def submit(self, args: tuple):
+        future = self._inflight.get(args)
+        if future is None:
+            future = asyncio.ensure_future(self._call(args))
+            self._inflight[args] = future
+            future.add_done_callback(lambda _: self._inflight.pop(args, None))
+        else:
+            self.coalesced += 1
+        # Shielded: one caller giving up must not cancel the request the others wait for
+        return await asyncio.shield(future)
+
+    async def _call(self, args: tuple):
+        async with self._slots:
+            self.calls += 1
+            try:
+                return await self.single_fn(*args)
+            except Exception:
+                self.failed += 1
+                raise
+
+    def stats(self) -> Dict:
+        return {"calls": self.calls, "coalesced": self.coalesced, "failed": self.failed, "in_flight": len(self._inflight)}
+
+    async def stop(self):
+        futures = list(self._inflight.values())
+        for future in futures:
+            future.cancel()
+        await asyncio.gather(*futures, return_exceptions=True)
@@ -0,0 +1,324 @@
+"""
+Helpers for moving the JSON stores into the SQLAlchemy tables.
+
+* iter_json_array(): streams the items of a (possibly nested) JSON array one at
+  a time, so memory use does not grow with the file size.
+* NORMALIZERS: map the field names that drifted between the JSON files and
+  versions of the backend (userId vs user_id, content vs message,
+  response_text vs answer, created_at vs timestamp, ...) onto the columns of
+  the SQL models.
+* diff_rows(): field-by-field comparison used by the consistency checker and
+  by the dual-read mode in server.py.
+* JSON_STORE_FILES: the file of each collection, shared by server.py and
+  migrate_json_to_sqlite.py.
+"""
+import json
+import re
+from datetime import date, datetime, timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+READ_CHUNK_SIZE = 64 * 1024
+_NUMBER_CONTINUATION = frozenset("0123456789.eE+-")
+
+
+def iter_json_array(path, array_key: Optional[str] = None, chunk_size: int = READ_CHUNK_SIZE) -> Iterator:
+    """
+    Yields the items of the top-level array in `path`, or of the array stored under
+    `array_key` (or the first array value) when the top level is an object.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf = f.read(chunk_size)
+        eof = not buf
+
+        # Find the opening bracket of the array we want
+        stripped = buf.lstrip()
+        if stripped.startswith("["):
+            pos = buf.index("[") + 1
+        else:
+            key_pattern = re.compile(r'"%s"\s*:\s*\[' % re.escape(array_key) if array_key else r':\s*\[')
+            match = key_pattern.search(buf)
+            while match is None and not eof:
+                more = f.read(chunk_size)
+                eof = not more
+                buf += more
+                match = key_pattern.search(buf)
+            if match is None:
+                return
+            pos = match.end()
+
+        while True:
+            # Skip separators between items
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n,":
+                    pos += 1
+                if pos < len(buf) or eof:
+                    break
+                buf, pos = f.read(chunk_size), 0
+                eof = not buf
+            if pos >= len(buf) or buf[pos] == "]":
+                return
+
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+                # A bare number cut by the chunk boundary decodes too early: "12" of "125",
+                # "1" of "1.5" or "1e3"; it is complete only when a delimiter follows it
+                if not eof and isinstance(item, (int, float)) and not isinstance(item, bool) \
+                        and (end == len(buf) or buf[end] in _NUMBER_CONTINUATION):
+                    raise ValueError("number may be truncated")
+                if end == len(buf) and not eof:
+                    raise ValueError("item may be truncated")
+            except ValueError:
+                if eof:
+                    raise
+                more = f.read(chunk_size)
+                eof = not more
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+
+            yield item
+            buf, pos = buf[end:], 0
+
+
+def parse_timestamp(value) -> datetime:
+    """ISO strings (with or without Z / offset) -> naive UTC datetime, like datetime.utcnow()."""
+    if isinstance(value, datetime):
+        parsed = value
+    elif isinstance(value, str) and value:
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return datetime.utcnow()
+    else:
+        return datetime.utcnow()
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _first(record: Dict, *keys, default=None):
+    for key in keys:
+        if record.get(key) is not None:
+            return record[key]
+    return default
+
+
+def _str_id(value) -> Optional[str]:
+    return None if value is None else str(value)
+
+
+def _date_str(value) -> Optional[str]:
+    if isinstance(value, (date, datetime)):
+        return value.strftime("%Y-%m-%d")
+    return value[:10] if isinstance(value, str) and value else None
+
+
+def normalize_user(record: Dict) -> Dict:
+    return {
+        "id": _str_id(record.get("id")),
+        "username": record.get("username", ""),
+        "password_hash": _first(record, "password_hash", "password", default=""),
+        "class_code": record.get("class_code", ""),
+        "role": record.get("role", "student"),
+        "points": int(record.get("points") or 0),
+        "level": int(record.get("level") or 1),
+        "badges": record.get("badges") or [],
+        "streak_days": int(_first(record, "streak_days", "streak", default=0)),
+        "last_entry_date": _date_str(record.get("last_entry_date")),
+        "created_at": parse_timestamp(record.get("created_at")),
+        "daily_calorie_goal_override": record.get("daily_calorie_goal_override"),
+        "daily_protein_goal_override": record.get("daily_protein_goal_override"),
+    }
+
+
+def normalize_food_entry(record: Dict) -> Dict:
+    analysis = record.get("ai_analysis_result") or {}
+    return {
+        "id": _str_id(record.get("id")),
+        "user_id": _str_id(_first(record, "user_id", "userId")),
+        "food_name": record.get("food_name", ""),
+        "meal_type": record.get("meal_type", ""),
+        "quantity": str(_first(record, "quantity", default="")),
+        "image_data": record.get("image_data"),
+        "image_url": record.get("image_url"),
+        "ai_score": _first(record, "ai_score", default=analysis.get("ai_score")),
+        "ai_feedback": _first(record, "ai_feedback", default=analysis.get("ai_feedback")),
+        "ai_suggestions": _first(record, "ai_suggestions", default=analysis.get("ai_suggestions")),
+        "calories_estimated": _first(record, "calories_estimated", default=analysis.get("calories_estimated")),
+        "nutrition_info": _first(record, "nutrition_info", default=analysis.get("nutrition_info")),
+        "points_earned": int(_first(record, "points_earned", default=analysis.get("points_earned") or 0)),
+        "timestamp": parse_timestamp(_first(record, "timestamp", "created_at")),
+    }
+
+
+def normalize_chat_message(record: Dict) -> Dict:
+    return {
+        "id": _str_id(record.get("id")),
+        "user_id": _str_id(_first(record, "user_id", "userId")),
+        "username": record.get("username", ""),
+        "message": _first(record, "message", "content", default=""),
+        "is_admin": bool(_first(record, "is_admin", default=record.get("sender") == "admin")),
+        "timestamp": parse_timestamp(_first(record, "timestamp", "created_at")),
+    }
+
+
+def _option_text(option) -> str:
+    return option.get("text", "") if isinstance(option, dict) else str(option)
+
+
+def normalize_daily_question(record: Dict) -> Dict:
+    return {
+        "id": _str_id(record.get("id")),
+        "question": _first(record, "question", "question_text", default=""),
+        "options": [_option_text(option) for option in record.get("options") or []],
+        "date": _date_str(record.get("date")) or "",
+        "active": bool(_first(record, "active", "is_active", default=False)),
+        "points_reward": int(_first(record, "points_reward", "points", default=5)),
+    }
+
+
+def normalize_question_response(record: Dict) -> Dict:
+    return {
+        "id": _str_id(record.get("id")),
+        "user_id": _str_id(_first(record, "user_id", "userId")),
+        "question_id": _str_id(_first(record, "question_id", "questionId")),
+        "answer": _first(record, "answer", "response_text", default=""),
+        "points_earned": int(record.get("points_earned") or 0),
+        "timestamp": parse_timestamp(_first(record, "timestamp", "created_at")),
+    }
+
+
+def normalize_gallery_item(record: Dict) -> Dict:
+    return {
+        "id": _str_id(record.get("id")),
+        "user_id": _str_id(_first(record, "user_id", "userId")),
+        "username": record.get("username", ""),
+        "food_name": record.get("food_name", ""),
+        "image_data": record.get("image_data") or "",
+        "image_url": record.get("image_url"),
+        "ai_score": float(record.get("ai_score") or 0),
+        "likes": int(record.get("likes") or 0),
+        "timestamp": parse_timestamp(_first(record, "timestamp", "created_at")),
+    }
+
+
+def normalize_calorie_check(record: Dict) -> Dict:
+    result = record.get("result") or {}
+    return {
+        "id": _str_id(record.get("id")),
+        "user_id": _str_id(_first(record, "user_id", "userId")),
+        "food_name": _first(record, "food_name", "food_item", default=""),
+        "quantity": str(record.get("quantity") or ""),
+        "calories_per_100g": float(_first(record, "calories_per_100g", default=result.get("calories_per_100g") or 0)),
+        "estimated_calories": float(_first(record, "estimated_calories", default=result.get("estimated_calories") or 0)),
+        "nutrition_breakdown": _first(record, "nutrition_breakdown", "result"),
+        "timestamp": parse_timestamp(_first(record, "timestamp", "created_at")),
+    }
+
+
+def normalize_feedback_item(record: Dict) -> Dict:
+    return {
+        "id": _str_id(record.get("id")),
+        "user_id": _str_id(_first(record, "user_id", "userId")),
+        "username": record.get("username", ""),
+        "feedback_text": _first(record, "feedback_text", "text", "message", default=""),
+        "category": record.get("category"),
+        "timestamp": parse_timestamp(_first(record, "timestamp", "created_at")),
+    }
+
+
+def normalize_food_comparison(record: Dict) -> Dict:
+    return {
+        "id": _str_id(record.get("id")),
+        "user_id": _str_id(_first(record, "user_id", "userId")),
+        "food_1": _first(record, "food_1", "food_1_name", default=""),
+        "food_2": _first(record, "food_2", "food_2_name", default=""),
+        "comparison_result": _first(record, "comparison_result", default={
+            key: record.get(key) for key in ("food_1_analysis", "food_2_analysis", "comparison_summary")
+        }),
+        "timestamp": parse_timestamp(_first(record, "timestamp", "created_at")),
+    }
+
+
+# collection name -> JSON store file in the backend directory, read and written by server.py
+JSON_STORE_FILES: Dict[str, str] = {
+    "users": "users.json",
+    "daily_questions": "questions.json",
+    "food_entries": "food_entries.json",
+    "chat_messages": "chat_messages.json",
+    "question_responses": "question_responses.json",
+    "gallery_items": "gallery_items.json",
+    "calorie_checks": "calorie_checks.json",
+    "food_comparisons": "food_comparisons.json",
+    "feedback_items": "feedback_items.json",
+}
+
+# collection name -> (table name, normalizer, fields compared by the consistency checker)
+NORMALIZERS: Dict[str, tuple] = {
+    "users": ("users", normalize_user, ("username", "class_code", "role")),
+    "food_entries": ("food_entries", normalize_food_entry, ("user_id", "food_name", "ai_score", "points_earned")),
+    "chat_messages": ("chat_messages", normalize_chat_message, ("user_id", "message")),
+    "daily_questions": ("daily_questions", normalize_daily_question, ("question", "date", "active")),
+    "question_responses": ("question_responses", normalize_question_response, ("user_id", "question_id", "answer", "points_earned")),
+    "gallery_items": ("gallery_items", normalize_gallery_item, ("user_id", "food_name", "ai_score")),
+    "calorie_checks": ("calorie_checks", normalize_calorie_check, ("user_id", "food_name")),
+    "food_comparisons": ("food_comparisons", normalize_food_comparison, ("user_id", "food_1", "food_2")),
+    "feedback_items": ("feedback_items", normalize_feedback_item, ("user_id", "feedback_text")),
+}
+
+# Columns that SQL owns once a row exists: points and streaks are awarded with atomic
+# SQL updates and likes are flushed to SQL, so the JSON copies of these go stale.
+# Mirroring a JSON update never overwrites them and the consistency check skips them.
+SQL_OWNED_FIELDS: Dict[str, tuple] = {
+    "users": ("points", "level", "streak_days", "badges", "last_entry_date"),
+    "gallery_items": ("likes",),
+}
+
+
+def diff_rows(json_rows: Iterable[Dict], sql_rows: Iterable[Dict], fields, limit: int = 20) -> Dict:
+    """Compares normalized JSON rows with SQL rows (both dicts keyed by column) by id."""
+    sql_by_id = {row["id"]: row for row in sql_rows}
+    seen_ids = set()
+    missing_in_sql: List[str] = []
+    mismatches: List[Dict] = []
+    json_count = 0
+    for json_row in json_rows:
+        json_count += 1
+        row_id = json_row["id"]
+        seen_ids.add(row_id)
+        sql_row = sql_by_id.get(row_id)
+        if sql_row is None:
+            if len(missing_in_sql) < limit:
+                missing_in_sql.append(row_id)
+            continue
+        for field in fields:
+            if json_row.get(field) != sql_row.get(field) and len(mismatches) < limit:
+                mismatches.append({"id": row_id, "field": field, "json": json_row.get(field), "sql": sql_row.get(field)})
+    missing_in_json = [row_id for row_id in sql_by_id if row_id not in seen_ids][:limit]
+    return {
+        "json_count": json_count,
+        "sql_count": len(sql_by_id),
+        "missing_in_sql": missing_in_sql,
+        "missing_in_json": missing_in_json,
+        "mismatches": mismatches,
+        "consistent": not (missing_in_sql or missing_in_json or mismatches),
+    }
+
+
+def batched(items: Iterable, size: int) -> Iterator[List]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def normalized_records(path, normalizer: Callable[[Dict], Dict], array_key: Optional[str] = None) -> Iterator[Dict]:
+    """Streams a JSON store and yields normalized rows, skipping records without an id."""
+    for record in iter_json_array(path, array_key):
+        if isinstance(record, dict) and record.get("id") is not None:
+            yield normalizer(record)
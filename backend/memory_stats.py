@@ -0,0 +1,155 @@
+"""
+Live memory statistics for long-running workers.
+
+Reports the process RSS, the size of every registered in-process cache and,
+when tracemalloc is on (SNACKCHECK_TRACEMALLOC_FRAMES > 0), the top
+allocating source lines and what grew since a baseline. Tracing costs CPU
+and memory, so it is off by default; turn it on for a soak test or while
+chasing a leak in production. A full collection plus a count of every
+tracked object pauses the worker as long as walking the whole heap, so the
+report only does that when asked for (full_gc).
+
+Admins read it from GET /api/admin/memory and reset the baseline with
+POST /api/admin/memory/baseline; soak_test.py uses both.
+"""
+import gc
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+TRACEMALLOC_FRAMES = int(os.environ.get("SNACKCHECK_TRACEMALLOC_FRAMES", "0"))  # 0: off
+DEFAULT_TOP_ALLOCATORS = 20
+GROUP_BY_OPTIONS = ("lineno", "filename", "traceback")
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+# Allocations made by tracemalloc and the import system are noise in the top list
+_TRACE_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def rss_bytes() -> int:
+    """Current resident set size; falls back to the peak where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux reports KiB
+
+
+def _location(traceback, group_by: str) -> str:
+    """Newest frame first; "traceback" grouping shows up to four frames."""
+    frames = list(reversed(traceback))[:4 if group_by == "traceback" else 1]
+    return " <- ".join(frame.filename if group_by == "filename" else f"{frame.filename}:{frame.lineno}" for frame in frames)
+
+
+def _statistic(stat, group_by: str) -> Dict:
+    return {"location": _location(stat.traceback, group_by), "size_bytes": stat.size, "count": stat.count}
+
+
+def _difference(stat, group_by: str) -> Dict:
+    return {
+        "location": _location(stat.traceback, group_by),
+        "size_diff_bytes": stat.size_diff,
+        "count_diff": stat.count_diff,
+        "size_bytes": stat.size,
+    }
+
+
+class AllocationStats:
+    """
+    Memory report of this process. snapshot() is blocking; call it via
+    asyncio.to_thread with cache sizes read on the event loop, since the
+    caches are not meant to be read from other threads.
+    """
+
+    def __init__(self, frames: int = TRACEMALLOC_FRAMES):
+        self.frames = frames
+        self.started_at = time.time()
+        self._caches: Dict[str, Callable[[], object]] = {}
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._baseline_traced = 0
+        self._baseline_rss = 0
+        self._baseline_at = self.started_at
+
+    def start(self):
+        if self.frames > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.reset_baseline()
+
+    def stop(self):
+        if self.frames > 0 and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def track(self, name: str, size: Callable[[], object]):
+        """Registers a cache; size() returns its entry count or a small dict of counters."""
+        self._caches[name] = size
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def reset_baseline(self):
+        gc.collect()
+        self._baseline = tracemalloc.take_snapshot().filter_traces(_TRACE_FILTERS) if self.tracing else None
+        self._baseline_traced = tracemalloc.get_traced_memory()[0] if self.tracing else 0
+        self._baseline_rss = rss_bytes()
+        self._baseline_at = time.time()
+
+    def cache_sizes(self) -> Dict:
+        sizes = {}
+        for name, size in self._caches.items():
+            try:
+                sizes[name] = size()
+            except Exception as e:
+                sizes[name] = f"error: {e}"
+        return sizes
+
+    def snapshot(self, limit: int = DEFAULT_TOP_ALLOCATORS, group_by: str = "lineno",
+                 caches: Optional[Dict] = None, full_gc: bool = False) -> Dict:
+        if group_by not in GROUP_BY_OPTIONS:
+            raise ValueError(f"group_by must be one of: {', '.join(GROUP_BY_OPTIONS)}")
+        if full_gc:
+            gc.collect()  # Garbage that is merely uncollected yet is not growth
+        now = time.time()
+        rss = rss_bytes()
+        report = {
+            "pid": os.getpid(),
+            "uptime_s": round(now - self.started_at, 1),
+            "rss_bytes": rss,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "rss_growth_bytes": rss - self._baseline_rss,
+            "baseline_age_s": round(now - self._baseline_at, 1),
+            "gc_counts": list(gc.get_count()),
+            "caches": self.cache_sizes() if caches is None else caches,
+            "tracemalloc": {"tracing": self.tracing, "frames": self.frames},
+        }
+        if full_gc:
+            report["gc_tracked_objects"] = len(gc.get_objects())
+        if not self.tracing:
+            return report
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(_TRACE_FILTERS)
+        top: List[Dict] = [_statistic(stat, group_by) for stat in snapshot.statistics(group_by)[:limit]]
+        report["tracemalloc"].update({
+            "traced_bytes": current,
+            "traced_peak_bytes": peak,
+            "traced_growth_bytes": current - self._baseline_traced,
+            "overhead_bytes": tracemalloc.get_tracemalloc_memory(),
+            "top_allocators": top,
+        })
+        if self._baseline is not None:
+            growth = snapshot.compare_to(self._baseline, group_by)
+            report["tracemalloc"]["top_growth"] = [_difference(stat, group_by) for stat in growth[:limit] if stat.size_diff > 0]
+        return report
@@ -0,0 +1,112 @@
+"""
+Moves the JSON stores that server.py reads and writes (users.json,
+questions.json, chat_messages.json, ...; see JSON_STORE_FILES in
+json_migration.py) into the SQLite database used by the SQLAlchemy models,
+and checks that both agree.
+
+    python migrate_json_to_sqlite.py migrate [--only users,chat_messages] [--batch-size 500]
+    python migrate_json_to_sqlite.py check [--only users]
+
+Each file is streamed item by item (constant memory) and inserted in batched
+transactions with INSERT OR IGNORE, so the migration can be re-run safely
+after an interruption. Run `check` before switching SNACKCHECK_READ_MODE from
+"dual" to "sql".
+"""
+import argparse
+import os
+import sys
+
+from sqlalchemy import create_engine, func, insert, select
+
+from db_models import Base, DATABASE_URL, add_missing_columns_and_indexes
+from json_migration import JSON_STORE_FILES, NORMALIZERS, batched, diff_rows, normalized_records
+from search_index import install_search_index
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def get_sync_engine():
+    return create_engine(DATABASE_URL.replace("+aiosqlite", ""))
+
+
+def selected_collections(only: str):
+    if not only:
+        return list(JSON_STORE_FILES)
+    names = [name.strip() for name in only.split(",") if name.strip()]
+    unknown = [name for name in names if name not in JSON_STORE_FILES]
+    if unknown:
+        sys.exit(f"Unknown collection(s): {', '.join(unknown)}. Choose from: {', '.join(JSON_STORE_FILES)}")
+    return names
+
+
+def migrate_collection(engine, collection: str, path: str, batch_size: int):
+    table_name, normalizer, _ = NORMALIZERS[collection]
+    table = Base.metadata.tables[table_name]
+    stmt = insert(table).prefix_with("OR IGNORE")  # Already-migrated ids are skipped on re-runs
+    total = 0
+    for batch in batched(normalized_records(path, normalizer), batch_size):
+        with engine.begin() as conn:
+            conn.execute(stmt, batch)
+        total += len(batch)
+        print(f"  {collection}: {total} records processed", end="\r")
+    print(f"  {collection}: {total} records processed")
+
+
+def check_collection(engine, collection: str, path: str, batch_size: int) -> bool:
+    table_name, normalizer, fields = NORMALIZERS[collection]
+    table = Base.metadata.tables[table_name]
+    columns = [table.c.id] + [table.c[field] for field in fields]
+
+    missing_in_sql, mismatches, json_count = [], [], 0
+    with engine.connect() as conn:
+        for batch in batched(normalized_records(path, normalizer), batch_size):
+            ids = [row["id"] for row in batch]
+            sql_rows = [dict(row._mapping) for row in conn.execute(select(*columns).where(table.c.id.in_(ids)))]
+            report = diff_rows(batch, sql_rows, fields)
+            json_count += report["json_count"]
+            missing_in_sql += report["missing_in_sql"]
+            mismatches += report["mismatches"]
+        sql_count = conn.execute(select(func.count()).select_from(table)).scalar()
+
+    consistent = not missing_in_sql and not mismatches and sql_count == json_count
+    print(f"  {collection}: json={json_count} sql={sql_count} missing_in_sql={len(missing_in_sql)} mismatches={len(mismatches)}"
+          f" -> {'OK' if consistent else 'INCONSISTENT'}")
+    for row_id in missing_in_sql[:10]:
+        print(f"    missing in SQL: {row_id}")
+    for mismatch in mismatches[:10]:
+        print(f"    {mismatch['id']}.{mismatch['field']}: json={mismatch['json']!r} sql={mismatch['sql']!r}")
+    return consistent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate SnackCheck JSON stores into SQLite.")
+    parser.add_argument("command", choices=["migrate", "check"])
+    parser.add_argument("--only", default="", help="Comma-separated collections (default: all)")
+    parser.add_argument("--data-dir", default=".", help="Directory containing the JSON files")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    engine = get_sync_engine()
+    with engine.begin() as conn:
+        Base.metadata.create_all(conn)
+        add_missing_columns_and_indexes(conn)
+        install_search_index(conn)  # Triggers keep the full-text index in step with the inserts below
+
+    all_consistent = True
+    for collection in selected_collections(args.only):
+        path = os.path.join(args.data_dir, JSON_STORE_FILES[collection])
+        if not os.path.exists(path):
+            print(f"  {collection}: {path} not found, skipping")
+            continue
+        if args.command == "migrate":
+            migrate_collection(engine, collection, path, args.batch_size)
+        else:
+            all_consistent = check_collection(engine, collection, path, args.batch_size) and all_consistent
+
+    if args.command == "check" and not all_consistent:
+        sys.exit(1)
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
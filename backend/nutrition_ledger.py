@@ -0,0 +1,233 @@
+"""
+Per-user per-day nutrition ledger: "how am I doing today against my goal".
+
+Every food entry adds to one ledger row (user, UTC day): the entry count and
+its weight in grams when it is saved, its calories and protein once the
+analysis has the food's calories per 100 g. The free-text quantity ("150 g",
+"2 plakjes", "1 large apple", "een glas") is parsed into grams once, when the
+entry is saved (FoodEntryDb.quantity_grams), so progress for today or a week
+is a primary-key read of one to seven ledger rows, never a scan of entries.
+
+Goals come from the user's daily_calorie_goal_override and
+daily_protein_goal_override, or the school-wide defaults below. The calorie
+goal is a daily limit (met when a logged day stays at or under it), the
+protein goal a daily target (met when a logged day reaches it). Class goal
+attainment is rolled up from the same ledger rows.
+
+A nightly job rebuilds the recent days from the entries themselves, which
+backfills the ledger and corrects it after entries are removed by other means
+than the app (a user's rows are deleted together with the user).
+"""
+import os
+import re
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_CALORIE_GOAL = float(os.environ.get("SNACKCHECK_DEFAULT_CALORIE_GOAL", "2000"))
+DEFAULT_PROTEIN_GOAL = float(os.environ.get("SNACKCHECK_DEFAULT_PROTEIN_GOAL", "50"))
+DEFAULT_PORTION_GRAMS = float(os.environ.get("SNACKCHECK_DEFAULT_PORTION_GRAMS", "100"))
+LEDGER_RECONCILE_DAYS = int(os.environ.get("SNACKCHECK_LEDGER_RECONCILE_DAYS", "8"))
+MAX_ENTRY_GRAMS = 5000.0  # A typo like "1500 kg" must not swamp the day
+MAX_BARE_PIECES = 10  # A bare number above this is a weight ("100" of rice), not a piece count
+LEDGER_MAX_DAYS = 31
+
+# Grams (or millilitres, taken as grams) per unit; Dutch and English spellings
+UNIT_GRAMS: Dict[str, float] = {
+    "g": 1, "gr": 1, "gram": 1, "grams": 1, "mg": 0.001, "kg": 1000, "kilo": 1000,
+    "ml": 1, "cl": 10, "dl": 100, "l": 1000, "liter": 1000, "litre": 1000,
+    "plak": 30, "plakje": 30, "plakjes": 30, "plakken": 30, "slice": 30, "snee": 30, "sneetje": 30, "sneetjes": 30,
+    "glas": 200, "glazen": 200, "glass": 200, "beker": 200, "cup": 200, "kop": 150, "kopje": 150,
+    "blik": 330, "blikje": 330, "can": 330, "flesje": 330, "fles": 500, "bottle": 500,
+    "kom": 250, "kommetje": 250, "bowl": 250, "bord": 350, "plate": 350,
+    "eetlepel": 15, "el": 15, "tbsp": 15, "tablespoon": 15, "theelepel": 5, "tl": 5, "tsp": 5, "teaspoon": 5,
+    "handje": 25, "handful": 25, "reep": 50, "bar": 50, "zakje": 40, "bag": 40, "packet": 40,
+    "portie": DEFAULT_PORTION_GRAMS, "porties": DEFAULT_PORTION_GRAMS, "portion": DEFAULT_PORTION_GRAMS,
+    "serving": DEFAULT_PORTION_GRAMS,
+}
+PIECE_UNITS = {"stuk", "stuks", "stuk(s)", "piece", "pc", "pcs", "x", "st"}
+MULTIPLIERS = {"x", "×"}  # "2 x 50 g": two times the amount that follows
+SIZE_FACTORS = {"small": 0.7, "klein": 0.7, "kleine": 0.7, "medium": 1.0, "middel": 1.0, "normaal": 1.0,
+                "large": 1.5, "big": 1.5, "groot": 1.5, "grote": 1.5}
+NUMBER_WORDS = {"half": 0.5, "halve": 0.5, "a": 1, "an": 1, "one": 1, "een": 1, "één": 1,
+                "two": 2, "twee": 2, "three": 3, "drie": 3}
+# Weight of one piece of the foods in NUTRITION_DATA that are counted in pieces
+PIECE_GRAMS = {"apple": 150, "banana": 120, "orange": 140, "carrot": 60, "egg": 55, "sandwich": 150,
+               "burger": 200, "bread": 35, "pizza": 120, "candy": 10, "chocolate": 25}
+
+# Rough protein content per category, for analyses that report calories only
+PROTEIN_PER_100G_BY_CATEGORY = {
+    "fruit": 0.8, "vegetable": 2.5, "dairy": 6.0, "grains": 8.0, "protein": 20.0, "sweets": 5.0,
+    "snacks": 6.0, "drinks": 0.5, "fast_food": 12.0, "processed": 11.0, "meal": 10.0,
+}
+
+_TOKEN = re.compile(r"\d+(?:[.,]\d+)?(?:\s*/\s*\d+)?|[^\W\d_]+(?:\(s\))?|×")
+
+
+def _amount(token: str) -> Optional[float]:
+    if token in NUMBER_WORDS:
+        return NUMBER_WORDS[token]
+    if not token[0].isdigit():
+        return None
+    if "/" in token:
+        numerator, denominator = (float(part) for part in token.split("/"))
+        return numerator / denominator if denominator else None
+    return float(token.replace(",", "."))
+
+
+def _unit_grams(token: str, food_name: str) -> Optional[float]:
+    for candidate in (token, token.rstrip("s")):
+        if candidate in UNIT_GRAMS:
+            return UNIT_GRAMS[candidate]
+        if candidate in PIECE_UNITS:
+            return piece_grams(food_name)
+    return None
+
+
+def piece_grams(food_name: str) -> float:
+    words = re.findall(r"[^\W\d_]+", (food_name or "").lower())
+    for word in words:
+        for candidate in (word, word.rstrip("s")):
+            if candidate in PIECE_GRAMS:
+                return PIECE_GRAMS[candidate]
+    return DEFAULT_PORTION_GRAMS
+
+
+def parse_quantity_grams(quantity: Optional[str], food_name: str = "") -> float:
+    """
+    Weight of an entry from its free-text quantity. A small amount without a
+    known unit counts pieces or portions of the food, a larger one is grams;
+    no amount at all is one. "2 x 50 g" multiplies the amounts.
+    """
+    tokens = _TOKEN.findall((quantity or "").lower())
+    amount = None
+    factor = 1.0
+    unit = None
+    multiply = False
+    for index, token in enumerate(tokens):
+        value = _amount(token)
+        if value is not None and (amount is None or multiply):
+            amount = value if amount is None else amount * value
+            multiply = False
+        elif (token in MULTIPLIERS and amount is not None and index + 1 < len(tokens)
+              and tokens[index + 1][0].isdigit()):
+            multiply = True
+        elif token in SIZE_FACTORS:
+            factor = SIZE_FACTORS[token]
+        elif unit is None and _unit_grams(token, food_name) is not None:
+            unit = _unit_grams(token, food_name)
+            break
+    if unit is None:
+        unit = 1.0 if amount is not None and amount > MAX_BARE_PIECES else piece_grams(food_name)
+    grams = (1.0 if amount is None else amount) * unit * factor
+    return round(min(max(grams, 0.0), MAX_ENTRY_GRAMS), 1)
+
+
+def entry_nutrition(grams: Optional[float], nutrition_info: Optional[Dict]) -> Optional[Tuple[float, float]]:
+    """(calories, protein grams) of an analyzed entry; None while the calories per 100 g are unknown."""
+    info = nutrition_info or {}
+    calories_per_100g = info.get("calories_per_100g")
+    if grams is None or calories_per_100g is None:
+        return None
+    protein_per_100g = info.get("protein_per_100g")
+    if protein_per_100g is None:
+        protein_per_100g = PROTEIN_PER_100G_BY_CATEGORY.get(info.get("category"), 0.0)
+    return round(grams * float(calories_per_100g) / 100, 1), round(grams * float(protein_per_100g) / 100, 1)
+
+
+def ledger_day(timestamp: datetime) -> str:
+    """Ledger key of an entry: its UTC day (timestamps are stored as naive UTC)."""
+    return timestamp.date().isoformat()
+
+
+def week_days(day: date) -> List[date]:
+    """Monday to Sunday of the ISO week that contains `day`."""
+    monday = day - timedelta(days=day.weekday())
+    return [monday + timedelta(days=offset) for offset in range(7)]
+
+
+def goals_for(calorie_override: Optional[float], protein_override: Optional[float]) -> Dict[str, float]:
+    return {
+        "calories": calorie_override if calorie_override is not None else DEFAULT_CALORIE_GOAL,
+        "protein": protein_override if protein_override is not None else DEFAULT_PROTEIN_GOAL,
+    }
+
+
+def _percent(value: float, goal: float) -> Optional[float]:
+    return round(100 * value / goal, 1) if goal else None
+
+
+def day_progress(day: str, row: Optional[Dict], goals: Dict[str, float]) -> Dict:
+    """One day of a user's ledger against the goals; `row` is None for a day without entries."""
+    row = row or {}
+    entries = row.get("entries", 0)
+    calories = round(row.get("calories", 0.0), 1)
+    protein = round(row.get("protein", 0.0), 1)
+    return {
+        "day": day,
+        "entries": entries,
+        "pending_analysis": max(entries - row.get("analyzed", 0), 0),
+        "grams": round(row.get("grams", 0.0), 1),
+        "calories": calories,
+        "protein": protein,
+        "calorie_goal": goals["calories"],
+        "protein_goal": goals["protein"],
+        "calories_remaining": round(goals["calories"] - calories, 1),
+        "protein_remaining": round(max(goals["protein"] - protein, 0.0), 1),
+        "calories_percent": _percent(calories, goals["calories"]),
+        "protein_percent": _percent(protein, goals["protein"]),
+        "calorie_goal_met": entries > 0 and calories <= goals["calories"],
+        "protein_goal_met": entries > 0 and protein >= goals["protein"],
+    }
+
+
+def week_progress(days: List[date], rows: Dict[str, Dict], goals: Dict[str, float]) -> Dict:
+    progress = [day_progress(day.isoformat(), rows.get(day.isoformat()), goals) for day in days]
+    logged = [day for day in progress if day["entries"]]
+    return {
+        "start": days[0].isoformat(),
+        "end": days[-1].isoformat(),
+        "goals": goals,
+        "days": progress,
+        "totals": {
+            "entries": sum(day["entries"] for day in progress),
+            "calories": round(sum(day["calories"] for day in progress), 1),
+            "protein": round(sum(day["protein"] for day in progress), 1),
+            "logged_days": len(logged),
+            "avg_calories_per_logged_day": round(sum(day["calories"] for day in logged) / len(logged), 1) if logged else None,
+            "calorie_goal_days": sum(day["calorie_goal_met"] for day in progress),
+            "protein_goal_days": sum(day["protein_goal_met"] for day in progress),
+        },
+    }
+
+
+def class_attainment(class_code: str, days: List[date], students: Iterable[Dict], rows: Iterable[Dict]) -> Dict:
+    """
+    Goal attainment of a class per day and per student. `students` carry their
+    id, username and goal overrides; `rows` are their ledger rows in the window.
+    """
+    students = list(students)
+    by_cell = {(row["user_id"], row["day"]): row for row in rows}
+    keys = [day.isoformat() for day in days]
+    per_day = {key: {"day": key, "logged": 0, "calorie_goal_met": 0, "protein_goal_met": 0} for key in keys}
+    per_student = []
+    for student in students:
+        goals = goals_for(student.get("daily_calorie_goal_override"), student.get("daily_protein_goal_override"))
+        met = {"logged": 0, "calorie_goal_met": 0, "protein_goal_met": 0}
+        for key in keys:
+            progress = day_progress(key, by_cell.get((student["id"], key)), goals)
+            for field, hit in (("logged", progress["entries"] > 0), ("calorie_goal_met", progress["calorie_goal_met"]),
+                               ("protein_goal_met", progress["protein_goal_met"])):
+                met[field] += hit
+                per_day[key][field] += hit
+        per_student.append({"id": student["id"], "username": student["username"], "goals": goals, **met})
+    for day in per_day.values():
+        day["calorie_goal_rate"] = round(day["calorie_goal_met"] / day["logged"], 3) if day["logged"] else None
+        day["protein_goal_rate"] = round(day["protein_goal_met"] / day["logged"], 3) if day["logged"] else None
+    return {
+        "class_code": class_code,
+        "start": keys[0],
+        "end": keys[-1],
+        "students": len(students),
+        "days": list(per_day.values()),
+        "per_student": per_student,
+    }
@@ -0,0 +1,100 @@
+"""
+Password hashing off the event loop.
+
+An argon2/bcrypt hash costs 100+ ms of CPU by design, and a whole class logs in
+within the same minute. Hashing and verification therefore run in a small,
+bounded thread pool (both libraries release the GIL while hashing), so the
+event loop keeps serving other requests during a login storm. When the queue
+is full, LaneFull is raised and the caller can answer 503 instead of piling up.
+
+Cost is set by a named profile (SNACKCHECK_PASSWORD_HASH_PROFILE). Hashes made
+with an older profile or scheme, and legacy records that store the password
+as plain text or as "UNHASHED_<password>" (see create_initial_admin.py), are
+upgraded on the next successful login: verify_and_update() returns the new
+hash for the caller to store.
+
+bench_login_storm.py measures event loop lag during concurrent logins.
+"""
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from passlib.context import CryptContext
+
+from execution_lanes import WorkPool
+
+# Per profile: bcrypt rounds (log2) and argon2id time cost / memory (KiB) / lanes
+PASSWORD_HASH_PROFILES = {
+    "fast": {"bcrypt__rounds": 10, "argon2__time_cost": 2, "argon2__memory_cost": 19456, "argon2__parallelism": 1},
+    "standard": {"bcrypt__rounds": 12, "argon2__time_cost": 3, "argon2__memory_cost": 65536, "argon2__parallelism": 1},
+    "strong": {"bcrypt__rounds": 13, "argon2__time_cost": 4, "argon2__memory_cost": 131072, "argon2__parallelism": 2},
+}
+PASSWORD_HASH_PROFILE = os.environ.get("SNACKCHECK_PASSWORD_HASH_PROFILE", "standard")
+PASSWORD_HASH_WORKERS = int(os.environ.get("SNACKCHECK_PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get("SNACKCHECK_PASSWORD_HASH_MAX_QUEUE", "256"))
+LEGACY_PREFIX = "UNHASHED_"
+
+
+def build_context(profile: str = PASSWORD_HASH_PROFILE) -> CryptContext:
+    if profile not in PASSWORD_HASH_PROFILES:
+        raise ValueError(f"Unknown password hash profile {profile!r}")
+    settings = {**PASSWORD_HASH_PROFILES[profile], "argon2__type": "ID"}
+    # New hashes are argon2id (argon2-cffi); bcrypt only verifies existing hashes.
+    # deprecated="auto": everything but the first scheme, and hashes with other
+    # cost settings, are reported as needing an update
+    return CryptContext(schemes=["argon2", "bcrypt"], deprecated="auto", **settings)
+
+
+class PasswordHasher:
+    def __init__(self, profile: str = PASSWORD_HASH_PROFILE, workers: int = PASSWORD_HASH_WORKERS,
+                 max_queue: int = PASSWORD_HASH_MAX_QUEUE):
+        self.profile = profile
+        self.context = build_context(profile)
+        self.pool = WorkPool("password_hashing", ThreadPoolExecutor, workers, max_queue)
+        # Verified when the user doesn't exist, so unknown usernames take as long as wrong passwords
+        self._dummy_hash = self.context.hash(os.urandom(16).hex())
+        self.upgraded = 0
+
+    def is_legacy(self, stored: Optional[str]) -> bool:
+        """Plain-text or UNHASHED_ records, i.e. anything passlib doesn't recognise as a hash."""
+        return bool(stored) and self.context.identify(stored, required=False) is None
+
+    def hash_blocking(self, password: str) -> str:
+        return self.context.hash(password)
+
+    def verify_and_update_blocking(self, password: str, stored: Optional[str]) -> Tuple[bool, Optional[str]]:
+        """Returns (valid, new hash to store or None)."""
+        if not stored:
+            self.context.verify(password, self._dummy_hash)
+            return False, None
+        if self.is_legacy(stored):
+            plain = stored[len(LEGACY_PREFIX):] if stored.startswith(LEGACY_PREFIX) else stored
+            if not hmac.compare_digest(password.encode("utf-8"), plain.encode("utf-8")):
+                return False, None
+            return True, self.context.hash(password)
+        return self.context.verify_and_update(password, stored)
+
+    async def hash(self, password: str) -> str:
+        return await self.pool.run(self.hash_blocking, password)
+
+    async def verify_and_update(self, password: str, stored: Optional[str]) -> Tuple[bool, Optional[str]]:
+        valid, new_hash = await self.pool.run(self.verify_and_update_blocking, password, stored)
+        if new_hash is not None:
+            self.upgraded += 1
+        return valid, new_hash
+
+    def stats(self) -> Dict:
+        queued = max(0, self.pool.metrics.in_flight - self.pool.workers)
+        return {
+            "profile": self.profile,
+            "default_scheme": self.context.default_scheme(),
+            "upgraded": self.upgraded,
+            **self.pool.metrics.as_dict(),
+            "queued": queued,
+            "workers": self.pool.workers,
+            "max_queue": self.pool.max_queue,
+        }
+
+    def shutdown(self):
+        self.pool.shutdown()
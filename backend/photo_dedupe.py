@@ -0,0 +1,133 @@
+"""
+Near-duplicate detection for food photos.
+
+Each analyzed photo gets a 64-bit difference hash (dHash). Hashes are kept in
+a BK-tree keyed by Hamming distance, so a new upload can be matched against
+all earlier photos in roughly logarithmic time. When a close enough match is
+found, its AI analysis is reused instead of calling HuggingFace again.
+"""
+import io
+import os
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 8  # 8x8 comparisons -> 64-bit hash
+# Max differing bits for two photos to count as the same meal
+DUPLICATE_MAX_DISTANCE = int(os.environ.get("SNACKCHECK_DUPLICATE_MAX_DISTANCE", "6"))
+
+
+def dhash_image(image: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """Difference hash: compares each pixel with its right neighbour on a tiny grayscale thumbnail."""
+    thumbnail = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def dhash_bytes(image_bytes: bytes) -> int:
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft("L", (64, 64))  # Lets JPEG decode at reduced size, much faster for big photos
+        return dhash_image(image)
+
+
+def hash_to_hex(value: int) -> str:
+    return f"{value:016x}"
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes with Hamming distance."""
+
+    def __init__(self):
+        # Node: [hash, payload, {distance: child_node}]
+        self._root: Optional[list] = None
+        self.size = 0
+
+    def add(self, value: int, payload):
+        if self._root is None:
+            self._root = [value, payload, {}]
+            self.size = 1
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1] = payload  # Same hash: keep the latest analysis
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, payload, {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, int, object]]:
+        """Returns (distance, hash, payload) for all hashes within max_distance, closest first."""
+        if self._root is None:
+            return []
+        matches = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[0], node[1]))
+            # Triangle inequality: only children within [d - r, d + r] can contain matches
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+    def items(self) -> List[Tuple[int, object]]:
+        """All (hash, payload) pairs, parents before children so re-adding rebuilds the same tree."""
+        if self._root is None:
+            return []
+        result = []
+        queue = deque([self._root])
+        while queue:
+            node = queue.popleft()
+            result.append((node[0], node[1]))
+            queue.extend(node[2].values())
+        return result
+
+
+class PhotoAnalysisIndex:
+    """Maps photo hashes to the AI analysis fields of the entry they came from."""
+
+    def __init__(self, max_distance: int = DUPLICATE_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.tree = BKTree()
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, photo_hash: int, analysis: Dict):
+        self.tree.add(photo_hash, analysis)
+
+    def lookup(self, photo_hash: int) -> Optional[Dict]:
+        matches = self.tree.search(photo_hash, self.max_distance)
+        if matches:
+            self.hits += 1
+            return matches[0][2]
+        self.misses += 1
+        return None
+
+    def export_items(self) -> List[Tuple[int, Dict]]:
+        return self.tree.items()
+
+    def load_items(self, items: List[Tuple[int, Dict]]):
+        tree = BKTree()
+        for photo_hash, analysis in items:
+            tree.add(photo_hash, analysis)
+        self.tree = tree
+        self.loaded = True
+
+    def stats(self) -> Dict:
+        return {"indexed_photos": self.tree.size, "hits": self.hits, "misses": self.misses, "max_distance": self.max_distance}
@@ -0,0 +1,119 @@
+"""
+Streaming photo uploads for food entries.
+
+Uploaded photos are copied to disk in fixed-size chunks while the SHA-256 is
+computed on the fly, so memory use does not depend on the image size. Files
+are stored content-addressed (``<sha256><ext>``), which makes retries of the
+same photo free.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional
+
+UPLOAD_DIR = Path(__file__).parent / "static" / "uploads"
+# Photos are served by an authenticated route in server.py, never as public static files
+UPLOAD_URL_PREFIX = "/api/uploads"
+# image_url values stored before that route existed
+LEGACY_UPLOAD_URL_PREFIX = "/static/uploads"
+UPLOAD_NAME_PATTERN = re.compile(r"^[0-9a-f]{64}\.(jpg|png|gif|webp)$")
+MAX_UPLOAD_BYTES = int(float(os.environ.get("SNACKCHECK_MAX_UPLOAD_MB", "8")) * 1024 * 1024)
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# Room for the other multipart fields and boundaries when checking Content-Length up front
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UnsupportedImage(Exception):
+    pass
+
+
+def detect_image_extension(head: bytes) -> Optional[str]:
+    """Returns the file extension for a known image signature, or None."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if head.startswith(b"GIF87a") or head.startswith(b"GIF89a"):
+        return ".gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+
+def content_length_too_large(content_length: Optional[str], max_bytes: int = MAX_UPLOAD_BYTES) -> bool:
+    """Cheap early check on the Content-Length header, before the body is parsed."""
+    if not content_length:
+        return False
+    try:
+        return int(content_length) > max_bytes + MULTIPART_OVERHEAD_BYTES
+    except ValueError:
+        return False
+
+
+async def spool_upload(upload, max_bytes: int = MAX_UPLOAD_BYTES, upload_dir: Path = UPLOAD_DIR) -> Dict:
+    """
+    Copies an UploadFile to disk chunk by chunk, hashing as it goes.
+    Raises UploadTooLarge / UnsupportedImage; partial files are removed on error.
+    """
+    upload_dir.mkdir(parents=True, exist_ok=True)
+    temp_path = upload_dir / f".{uuid.uuid4()}.part"
+    sha256 = hashlib.sha256()
+    size_bytes = 0
+    extension = None
+
+    try:
+        with open(temp_path, "wb") as out_file:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if extension is None:
+                    extension = detect_image_extension(chunk[:16])
+                    if extension is None:
+                        raise UnsupportedImage("Only JPEG, PNG, GIF and WebP images are supported")
+                size_bytes += len(chunk)
+                if size_bytes > max_bytes:
+                    raise UploadTooLarge(f"Image exceeds the {max_bytes // (1024 * 1024)} MB limit")
+                sha256.update(chunk)
+                await asyncio.to_thread(out_file.write, chunk)
+
+        if size_bytes == 0:
+            raise UnsupportedImage("Uploaded image is empty")
+
+        digest = sha256.hexdigest()
+        final_name = f"{digest}{extension}"
+        final_path = upload_dir / final_name
+        os.replace(temp_path, final_path)  # Same content -> same name, so duplicates just overwrite
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+    return {
+        "path": str(final_path),
+        "url": f"{UPLOAD_URL_PREFIX}/{final_name}",
+        "sha256": digest,
+        "size_bytes": size_bytes,
+    }
+
+
+def path_for_upload_url(image_url: str, upload_dir: Path = UPLOAD_DIR) -> Optional[Path]:
+    """Maps an image_url produced by spool_upload back to its file on disk."""
+    if not image_url:
+        return None
+    if not (image_url.startswith(UPLOAD_URL_PREFIX + "/") or image_url.startswith(LEGACY_UPLOAD_URL_PREFIX + "/")):
+        return None
+    return upload_dir / os.path.basename(image_url)
+
+
+def urls_for_upload_name(file_name: str) -> List[str]:
+    """The image_url values that can point at an uploaded file, or [] for names spool_upload never produces."""
+    if not UPLOAD_NAME_PATTERN.match(file_name):
+        return []
+    return [f"{UPLOAD_URL_PREFIX}/{file_name}", f"{LEGACY_UPLOAD_URL_PREFIX}/{file_name}"]
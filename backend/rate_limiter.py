@@ -0,0 +1,206 @@
+"""
+Token-bucket admission control for the AI-backed endpoints.
+
+Every request takes tokens from two buckets at once: one per user and one per
+class, so a single student can't use up the HuggingFace quota and a whole
+class can't crowd out the rest of the school. Buckets live in the shared
+state (SQLite next to the invalidation counters, or Redis when
+SNACKCHECK_REDIS_URL is set), so the limits hold across uvicorn workers.
+
+A request that doesn't get its tokens waits briefly when they will be back
+soon (up to RATE_LIMIT_MAX_QUEUE_SECONDS), otherwise it is rejected with the
+time after which a retry will succeed. A cost above a bucket's burst could
+never be granted, so rate_limited() refuses such a cost when the routes are
+defined.
+
+The admitted/queued/rejected counters in stats() are kept per worker process
+and labelled with its pid; the buckets themselves are shared.
+"""
+import asyncio
+import logging
+import math
+import os
+import sqlite3
+import time
+from collections import defaultdict
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from shared_state import REDIS_URL, SHARED_STATE_DIR, redis
+
+RATE_LIMIT_DB = SHARED_STATE_DIR / "rate_limits.db"
+# Capacity (burst) and refill rate (tokens per second) per bucket kind
+USER_BUCKET_CAPACITY = float(os.environ.get("SNACKCHECK_RATE_LIMIT_USER_BURST", "6"))
+USER_BUCKET_RATE = float(os.environ.get("SNACKCHECK_RATE_LIMIT_USER_PER_MINUTE", "12")) / 60.0
+CLASS_BUCKET_CAPACITY = float(os.environ.get("SNACKCHECK_RATE_LIMIT_CLASS_BURST", "40"))
+CLASS_BUCKET_RATE = float(os.environ.get("SNACKCHECK_RATE_LIMIT_CLASS_PER_MINUTE", "120")) / 60.0
+RATE_LIMIT_MAX_QUEUE_SECONDS = float(os.environ.get("SNACKCHECK_RATE_LIMIT_MAX_QUEUE_SECONDS", "2"))
+
+# (key, capacity, refill tokens per second)
+BucketSpec = Tuple[str, float, float]
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limited, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class SqliteTokenBuckets:
+    """Token buckets in a shared SQLite file; one IMMEDIATE transaction per attempt."""
+
+    def __init__(self, db_path: Path = RATE_LIMIT_DB):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS token_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA busy_timeout = 30000")
+        return conn
+
+    def take(self, buckets: List[BucketSpec], cost: float = 1.0) -> float:
+        """
+        Takes `cost` tokens from every bucket, or from none of them. Returns 0 when
+        granted, otherwise the seconds until all buckets will have enough tokens.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            levels = []
+            wait = 0.0
+            for key, capacity, rate in buckets:
+                row = conn.execute("SELECT tokens, updated_at FROM token_buckets WHERE key = ?", (key,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+                levels.append((key, tokens))
+                if tokens < cost:
+                    wait = max(wait, (cost - tokens) / rate)
+            granted = wait == 0.0
+            conn.executemany(
+                "INSERT INTO token_buckets (key, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                [(key, tokens - cost if granted else tokens, now) for key, tokens in levels],
+            )
+            conn.execute("COMMIT")
+            return wait
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+
+class RedisTokenBuckets:
+    """Same interface as SqliteTokenBuckets; a Lua script keeps take() atomic."""
+
+    KEY_PREFIX = "snackcheck:bucket:"
+    TAKE_SCRIPT = """
+    local now = tonumber(ARGV[1])
+    local cost = tonumber(ARGV[2])
+    local wait = 0
+    local levels = {}
+    for i, key in ipairs(KEYS) do
+        local capacity = tonumber(ARGV[1 + i * 2])
+        local rate = tonumber(ARGV[2 + i * 2])
+        local state = redis.call('HMGET', key, 'tokens', 'updated_at')
+        local tokens = capacity
+        if state[1] then
+            tokens = math.min(capacity, tonumber(state[1]) + (now - tonumber(state[2])) * rate)
+        end
+        levels[i] = tokens
+        if tokens < cost then
+            wait = math.max(wait, (cost - tokens) / rate)
+        end
+    end
+    for i, key in ipairs(KEYS) do
+        local tokens = levels[i]
+        if wait == 0 then tokens = tokens - cost end
+        redis.call('HSET', key, 'tokens', tokens, 'updated_at', now)
+        redis.call('EXPIRE', key, 3600)
+    end
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        self.client = redis.Redis.from_url(url)
+        self._take = self.client.register_script(self.TAKE_SCRIPT)
+
+    def take(self, buckets: List[BucketSpec], cost: float = 1.0) -> float:
+        args = [time.time(), cost]
+        for _, capacity, rate in buckets:
+            args += [capacity, rate]
+        return float(self._take(keys=[self.KEY_PREFIX + key for key, _, _ in buckets], args=args))
+
+
+def create_token_buckets():
+    if REDIS_URL:
+        if redis is not None:
+            return RedisTokenBuckets(REDIS_URL)
+        logging.warning("SNACKCHECK_REDIS_URL is set but the redis package is not installed; using SQLite token buckets.")
+    return SqliteTokenBuckets()
+
+
+class AdmissionController:
+    def __init__(self, buckets=None, max_queue_seconds: float = RATE_LIMIT_MAX_QUEUE_SECONDS):
+        self.buckets = buckets or create_token_buckets()
+        self.max_queue_seconds = max_queue_seconds
+        self.metrics: Dict[str, Dict[str, float]] = defaultdict(lambda: {"admitted": 0, "queued": 0, "rejected": 0, "queue_wait_ms": 0.0})
+
+    @staticmethod
+    def check_cost(endpoint: str, cost: float):
+        """Raises ValueError for a cost that a full bucket could never pay."""
+        burst = min(USER_BUCKET_CAPACITY, CLASS_BUCKET_CAPACITY)
+        if cost > burst:
+            raise ValueError(
+                f"{endpoint} costs {cost:g} tokens but the smallest burst is {burst:g}; raise "
+                "SNACKCHECK_RATE_LIMIT_USER_BURST / SNACKCHECK_RATE_LIMIT_CLASS_BURST"
+            )
+
+    @staticmethod
+    def buckets_for(user_id: str, class_code: str) -> List[BucketSpec]:
+        return [
+            (f"user:{user_id}", USER_BUCKET_CAPACITY, USER_BUCKET_RATE),
+            (f"class:{class_code}", CLASS_BUCKET_CAPACITY, CLASS_BUCKET_RATE),
+        ]
+
+    async def admit(self, endpoint: str, user_id: str, class_code: str, cost: float = 1.0):
+        """Returns once the request may run; raises RateLimited if that would take too long."""
+        metrics = self.metrics[endpoint]
+        buckets = self.buckets_for(user_id, class_code)
+        started = time.monotonic()
+        queued = False
+        while True:
+            wait = await asyncio.to_thread(self.buckets.take, buckets, cost)
+            if wait == 0.0:
+                metrics["admitted"] += 1
+                if queued:
+                    metrics["queue_wait_ms"] += (time.monotonic() - started) * 1000.0
+                return
+            waited = time.monotonic() - started
+            if waited + wait > self.max_queue_seconds:
+                metrics["rejected"] += 1
+                raise RateLimited(max(wait, 1.0))
+            if not queued:
+                metrics["queued"] += 1
+                queued = True
+            # Other requests may take the refilled tokens first; then we loop and re-check the deadline
+            await asyncio.sleep(wait)
+
+    def stats(self) -> Dict:
+        return {
+            "pid": os.getpid(),
+            "limits": {
+                "user": {"burst": USER_BUCKET_CAPACITY, "per_minute": USER_BUCKET_RATE * 60},
+                "class": {"burst": CLASS_BUCKET_CAPACITY, "per_minute": CLASS_BUCKET_RATE * 60},
+                "max_queue_seconds": self.max_queue_seconds,
+            },
+            "endpoints": {endpoint: dict(values) for endpoint, values in self.metrics.items()},
+        }
+
+
+def retry_after_header(retry_after: float) -> str:
+    return str(math.ceil(retry_after))
@@ -0,0 +1,227 @@
+"""
+Opt-in slow-request profiler for the SnackCheck backend.
+
+One background thread per process samples the stack of the thread that runs
+the event loop and credits each sample to the request whose asyncio task is
+running at that moment. A request's tasks are found through a context
+variable: the middleware sets it, and every task created while it is set
+(call_next's task, tasks the endpoint spawns) is registered to that request by
+a task factory. Samples taken while the loop waits for I/O or runs another
+request's task are not counted, so a profile shows the request's own time on
+the event loop, even when many requests are profiled at once ("all" mode).
+
+Requests slower than the configured threshold keep their samples in a bounded
+ring, which admins can download in the "collapsed stack" format understood by
+flamegraph.pl, speedscope and inferno.
+"""
+import asyncio
+import contextvars
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Optional, Set
+
+# "off": never profile, "header": only admin requests carrying PROFILE_HEADER, "all": every request
+PROFILING_MODE = os.environ.get("SNACKCHECK_PROFILING", "header").lower()
+PROFILE_HEADER = "x-snackcheck-profile"
+PROFILE_THRESHOLD_MS = float(os.environ.get("SNACKCHECK_PROFILE_THRESHOLD_MS", "500"))
+PROFILE_RING_SIZE = int(os.environ.get("SNACKCHECK_PROFILE_RING_SIZE", "20"))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.environ.get("SNACKCHECK_PROFILE_INTERVAL_MS", "5"))
+MAX_STACK_DEPTH = 64
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class RequestSamples:
+    """The collapsed stacks sampled for one profiled request."""
+
+    def __init__(self):
+        self.stacks: Counter = Counter()
+        self.sample_count = 0
+        self.tasks: Set[asyncio.Task] = set()
+        self.context_token: Optional[contextvars.Token] = None
+
+
+# The profiled request the current code runs for; inherited by the tasks it creates
+_current_request: contextvars.ContextVar[Optional[RequestSamples]] = contextvars.ContextVar(
+    "snackcheck_profiled_request", default=None
+)
+
+
+class StackSampler:
+    """
+    Samples the event-loop thread at a fixed interval while any request is being
+    profiled, and credits each sample to the request owning the running task.
+    """
+
+    def __init__(self, interval_s: float):
+        self.interval_s = interval_s
+        self._owners: Dict[asyncio.Task, RequestSamples] = {}
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+
+    def _bind_loop(self):
+        # Called on the loop thread; the process normally has one loop, tests may start new ones
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        previous_factory = loop.get_task_factory()
+
+        def task_factory(loop, coro, **kwargs):
+            if previous_factory is not None:
+                task = previous_factory(loop, coro, **kwargs)
+            else:
+                task = asyncio.Task(coro, loop=loop, **kwargs)
+            owner = _current_request.get()
+            if owner is not None:
+                self._register(task, owner)
+            return task
+
+        loop.set_task_factory(task_factory)
+
+    def _register(self, task: asyncio.Task, owner: RequestSamples):
+        owner.tasks.add(task)
+        self._owners[task] = owner
+        task.add_done_callback(self._unregister_task)
+
+    def _unregister_task(self, task: asyncio.Task):
+        owner = self._owners.pop(task, None)
+        if owner is not None:
+            owner.tasks.discard(task)
+
+    def begin(self) -> RequestSamples:
+        """Starts crediting samples of the current task, and of tasks it creates, to a new request."""
+        self._bind_loop()
+        owner = RequestSamples()
+        owner.context_token = _current_request.set(owner)
+        self._register(asyncio.current_task(), owner)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="snackcheck-profiler", daemon=True)
+            self._thread.start()
+        self._active.set()
+        return owner
+
+    def end(self, owner: RequestSamples):
+        _current_request.reset(owner.context_token)
+        for task in list(owner.tasks):
+            self._owners.pop(task, None)
+        owner.tasks.clear()
+        if not self._owners:
+            self._active.clear()
+
+    def _sample_once(self):
+        loop = self._loop
+        task = asyncio.current_task(loop) if loop is not None else None
+        owner = self._owners.get(task) if task is not None else None
+        if owner is None:
+            return  # The loop is idle or runs a request that is not being profiled
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None or asyncio.current_task(loop) is not task:
+            return  # The loop switched tasks while the stack was read
+        labels = []
+        while frame is not None and len(labels) < MAX_STACK_DEPTH:
+            labels.append(_frame_label(frame))
+            frame = frame.f_back
+        if labels:
+            labels.reverse()  # Collapsed format is root-first
+            with self._lock:
+                owner.stacks[";".join(labels)] += 1
+                owner.sample_count += 1
+
+    def snapshot(self, owner: RequestSamples):
+        with self._lock:
+            return dict(owner.stacks), owner.sample_count
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            time.sleep(self.interval_s)
+            self._sample_once()
+
+
+class SlowRequestProfiler:
+    """Keeps the last N slow-request profiles in memory."""
+
+    def __init__(
+        self,
+        threshold_ms: float = PROFILE_THRESHOLD_MS,
+        max_profiles: int = PROFILE_RING_SIZE,
+        interval_ms: float = PROFILE_SAMPLE_INTERVAL_MS,
+    ):
+        self.threshold_ms = threshold_ms
+        self.interval_s = interval_ms / 1000.0
+        self._sampler = StackSampler(self.interval_s)
+        self._profiles: Deque[Dict] = deque(maxlen=max_profiles)
+        self._lock = threading.Lock()
+
+    def should_profile(self, header_value: Optional[str], is_admin: bool) -> bool:
+        if PROFILING_MODE == "all":
+            return True
+        if PROFILING_MODE == "header":
+            return is_admin and header_value is not None and header_value.lower() in ("1", "true", "yes")
+        return False
+
+    def begin(self) -> RequestSamples:
+        """Starts profiling the request running in the current task; call finish() in the same context."""
+        return self._sampler.begin()
+
+    def finish(self, request_samples: RequestSamples, method: str, path: str, status_code: int, duration_ms: float) -> Optional[str]:
+        """Stops crediting samples to the request and stores its profile if it was slow. Returns the profile id."""
+        self._sampler.end(request_samples)
+        stacks, sample_count = self._sampler.snapshot(request_samples)
+        if duration_ms < self.threshold_ms or sample_count == 0:
+            return None
+
+        profile_id = str(uuid.uuid4())
+        profile = {
+            "id": profile_id,
+            "method": method,
+            "path": path,
+            "status_code": status_code,
+            "duration_ms": round(duration_ms, 1),
+            "sample_count": sample_count,
+            "interval_ms": self.interval_s * 1000.0,
+            "captured_at": datetime.now(timezone.utc).isoformat(),
+            "stacks": stacks,
+        }
+        with self._lock:
+            self._profiles.append(profile)
+        return profile_id
+
+    def list_profiles(self) -> List[Dict]:
+        """Returns profile metadata (without stacks), newest first."""
+        with self._lock:
+            profiles = list(self._profiles)
+        return [
+            {key: value for key, value in profile.items() if key != "stacks"}
+            for profile in reversed(profiles)
+        ]
+
+    def get_collapsed(self, profile_id: str) -> Optional[str]:
+        """Returns a profile as collapsed stacks ("frame;frame;frame count" per line)."""
+        with self._lock:
+            profile = next((p for p in self._profiles if p["id"] == profile_id), None)
+        if profile is None:
+            return None
+        lines = [f"{stack} {count}" for stack, count in sorted(profile["stacks"].items())]
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
+
+
+def monotonic_ms() -> float:
+    return time.perf_counter() * 1000.0
@@ -0,0 +1,265 @@
+"""
+In-process job scheduler for nightly and weekly maintenance.
+
+Every worker process runs a JobScheduler, but only the leader runs jobs: a
+lease row in a small shared SQLite file (next to the invalidation counters)
+that the leader renews every few seconds. If the leader dies its lease
+expires and another worker takes over.
+
+Schedules are wall-clock times in UTC, the clock the streaks, the nutrition
+ledger and the activity matrix count days in. For every job the scheduler
+stores the last occurrence it ran, so a restart never runs a job twice, and
+an occurrence missed while no worker was up is run once on start-up. Jobs
+that should only run off-peak set catch_up_hours: a missed occurrence older
+than that is skipped until the next one.
+
+Jobs are plain async callables that get the occurrence they run for.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+import traceback
+import uuid
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from shared_state import SHARED_STATE_DIR
+
+SCHEDULER_DB = Path(os.environ.get("SNACKCHECK_SCHEDULER_DB", SHARED_STATE_DIR / "scheduler.db"))
+SCHEDULER_ENABLED = os.environ.get("SNACKCHECK_SCHEDULER", "on").lower() != "off"
+SCHEDULER_TICK_SECONDS = 15.0
+LEADER_LEASE_SECONDS = 60.0
+
+RUN_OK = "ok"
+RUN_FAILED = "failed"
+RUN_SKIPPED = "skipped"
+
+
+@dataclass(frozen=True)
+class Daily:
+    hour: int
+    minute: int = 0
+
+    def previous(self, now: datetime) -> datetime:
+        """The latest occurrence at or before now."""
+        due = now.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+        return due if due <= now else due - timedelta(days=1)
+
+    def following(self, now: datetime) -> datetime:
+        return self.previous(now) + timedelta(days=1)
+
+    def describe(self) -> str:
+        return f"daily at {self.hour:02d}:{self.minute:02d}"
+
+
+@dataclass(frozen=True)
+class Weekly:
+    weekday: int  # Monday is 0
+    hour: int
+    minute: int = 0
+
+    def previous(self, now: datetime) -> datetime:
+        due = now.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+        due -= timedelta(days=(now.weekday() - self.weekday) % 7)
+        return due if due <= now else due - timedelta(days=7)
+
+    def following(self, now: datetime) -> datetime:
+        return self.previous(now) + timedelta(days=7)
+
+    def describe(self) -> str:
+        day = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"][self.weekday]
+        return f"weekly on {day} at {self.hour:02d}:{self.minute:02d}"
+
+
+@dataclass
+class Job:
+    name: str
+    schedule: object  # Daily or Weekly
+    run: Callable[[datetime], Awaitable]
+    catch_up_hours: Optional[float] = None  # None: always run a missed occurrence
+    description: str = ""
+
+
+class SchedulerState:
+    """Leader lease and last runs in SQLite. All methods are blocking; call them via asyncio.to_thread."""
+
+    def __init__(self, db_path: Path = SCHEDULER_DB):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS scheduler_leader (id INTEGER PRIMARY KEY CHECK (id = 1), owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS scheduler_runs (
+                    job TEXT PRIMARY KEY,
+                    last_due TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    started_at REAL,
+                    duration_s REAL,
+                    result TEXT,
+                    runs INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA busy_timeout = 30000")
+        return conn
+
+    def acquire_lease(self, owner: str, lease_seconds: float = LEADER_LEASE_SECONDS) -> bool:
+        """Takes or renews the leader lease; False while another live worker holds it."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT owner, expires_at FROM scheduler_leader WHERE id = 1").fetchone()
+            if row is not None and row["owner"] != owner and row["expires_at"] > now:
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                "INSERT INTO scheduler_leader (id, owner, expires_at) VALUES (1, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at",
+                (owner, now + lease_seconds),
+            )
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def release_lease(self, owner: str):
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM scheduler_leader WHERE id = 1 AND owner = ?", (owner,))
+
+    def leader(self) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT owner, expires_at FROM scheduler_leader WHERE id = 1 AND expires_at > ?", (time.time(),)).fetchone()
+        return dict(row) if row else None
+
+    def last_due(self, job: str) -> Optional[datetime]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT last_due FROM scheduler_runs WHERE job = ?", (job,)).fetchone()
+        return datetime.fromisoformat(row["last_due"]) if row else None
+
+    def record(self, job: str, due: datetime, status: str, started_at: float, duration_s: float, result: str):
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO scheduler_runs (job, last_due, status, started_at, duration_s, result, runs) VALUES (?, ?, ?, ?, ?, ?, 1) "
+                "ON CONFLICT(job) DO UPDATE SET last_due = excluded.last_due, status = excluded.status, started_at = excluded.started_at, "
+                "duration_s = excluded.duration_s, result = excluded.result, runs = runs + 1",
+                (job, due.isoformat(), status, started_at, duration_s, result[:2000]),
+            )
+
+    def runs(self) -> Dict[str, Dict]:
+        with closing(self._connect()) as conn:
+            return {row["job"]: dict(row) for row in conn.execute("SELECT * FROM scheduler_runs").fetchall()}
+
+
+class JobScheduler:
+    def __init__(self, jobs: List[Job], state: Optional[SchedulerState] = None,
+                 tick_seconds: float = SCHEDULER_TICK_SECONDS, clock: Callable[[], datetime] = datetime.utcnow):
+        self.jobs = {job.name: job for job in jobs}
+        self.state = state or SchedulerState()
+        self.tick_seconds = tick_seconds
+        self.clock = clock
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self.running: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def due_occurrence(self, job: Job, now: datetime, last_due: Optional[datetime]) -> Optional[datetime]:
+        """The occurrence to run now, if the job has not run for its latest one."""
+        due = job.schedule.previous(now)
+        if last_due is not None and last_due >= due:
+            return None
+        return due
+
+    async def run_job(self, job: Job, due: datetime, now: datetime) -> str:
+        started_at = time.time()
+        if job.catch_up_hours is not None and now - due > timedelta(hours=job.catch_up_hours):
+            status, result = RUN_SKIPPED, f"missed by more than {job.catch_up_hours:g} h; waiting for the next occurrence"
+        else:
+            logging.info(f"Scheduler: running {job.name} for {due:%Y-%m-%d %H:%M}")
+            try:
+                status, result = RUN_OK, str(await job.run(due) or "")
+            except Exception as e:
+                status, result = RUN_FAILED, f"{e}\n{traceback.format_exc(limit=5)}"
+                logging.error(f"Scheduled job {job.name} failed: {e}")
+        # A failed run is recorded too: it is retried at the next occurrence, not every tick
+        await asyncio.to_thread(self.state.record, job.name, due, status, started_at, time.time() - started_at, result)
+        return status
+
+    async def tick(self):
+        self.is_leader = await asyncio.to_thread(self.state.acquire_lease, self.owner)
+        if not self.is_leader:
+            return
+        for job in self.jobs.values():
+            now = self.clock()
+            due = self.due_occurrence(job, now, await asyncio.to_thread(self.state.last_due, job.name))
+            if due is None:
+                continue
+            self.running = job.name
+            heartbeat = asyncio.create_task(self._keep_lease())  # A long job must not let the lease lapse
+            try:
+                await self.run_job(job, due, now)
+            finally:
+                heartbeat.cancel()
+                self.running = None
+
+    async def _keep_lease(self):
+        while True:
+            await asyncio.sleep(LEADER_LEASE_SECONDS / 3)
+            try:
+                await asyncio.to_thread(self.state.acquire_lease, self.owner)
+            except Exception as e:
+                logging.error(f"Scheduler could not renew its lease: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                logging.error(f"Scheduler tick failed: {e}")
+            await asyncio.sleep(self.tick_seconds)
+
+    def start(self):
+        if SCHEDULER_ENABLED and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.is_leader:
+            await asyncio.to_thread(self.state.release_lease, self.owner)
+            self.is_leader = False
+
+    async def status(self) -> Dict:
+        runs = await asyncio.to_thread(self.state.runs)
+        leader = await asyncio.to_thread(self.state.leader)
+        now = self.clock()
+        return {
+            "enabled": SCHEDULER_ENABLED,
+            "leader": leader["owner"] if leader else None,
+            "this_worker": self.owner,
+            "running": self.running,
+            "jobs": [
+                {
+                    "name": job.name,
+                    "description": job.description,
+                    "schedule": job.schedule.describe(),
+                    "next_run": job.schedule.following(now).isoformat(),
+                    "last_run": runs.get(job.name),
+                }
+                for job in self.jobs.values()
+            ],
+        }
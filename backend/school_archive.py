@@ -0,0 +1,221 @@
+"""
+School-year archives for the history tables that only ever grow.
+
+Rows of food_entries, chat_messages, question_responses and calorie_checks
+from closed school years are moved out of the hot tables into one SQLite file
+per school year (ARCHIVE_DIR/snackcheck_sy2024.db holds 2024-08-01 up to
+2025-08-01), which every connection attaches as schema "sy2024". The hot
+tables, their indexes and every aggregate over them then cover the current
+year only.
+
+Rows are moved in small batches: copy into the archive (INSERT OR REPLACE by
+id), then delete the same ids from the hot table. A job can be stopped at any
+point and simply run again; a batch interrupted between the two steps is
+finished by the next run. Moved counts are kept in archive_progress.
+
+Reads that may need old rows call overlapping_years() with their time range
+and union only those archives (see archived_source() in server.py).
+"""
+import os
+import re
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+ARCHIVE_DIR = Path(os.environ.get("SNACKCHECK_ARCHIVE_DIR", Path(__file__).parent / "archive"))
+SCHOOL_YEAR_START_MONTH = int(os.environ.get("SNACKCHECK_SCHOOL_YEAR_START_MONTH", "8"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("SNACKCHECK_ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_BATCH_PAUSE_SECONDS = float(os.environ.get("SNACKCHECK_ARCHIVE_BATCH_PAUSE_SECONDS", "0.05"))
+# SQLite attaches at most 10 databases per connection by default; older archives stay on disk unattached
+MAX_ATTACHED_ARCHIVES = 10
+
+# table -> timestamp column that decides its school year
+ARCHIVED_TABLES = {
+    "food_entries": "timestamp",
+    "chat_messages": "timestamp",
+    "question_responses": "timestamp",
+    "calorie_checks": "timestamp",
+}
+_ARCHIVE_FILE = re.compile(r"^snackcheck_sy(\d{4})\.db$")
+
+
+def school_year_of(moment: datetime) -> int:
+    """The calendar year in which the moment's school year started."""
+    return moment.year if moment.month >= SCHOOL_YEAR_START_MONTH else moment.year - 1
+
+
+def school_year_bounds(year: int) -> Tuple[datetime, datetime]:
+    return datetime(year, SCHOOL_YEAR_START_MONTH, 1), datetime(year + 1, SCHOOL_YEAR_START_MONTH, 1)
+
+
+def archive_schema(year: int) -> str:
+    return f"sy{year}"
+
+
+def archive_path(year: int) -> Path:
+    return ARCHIVE_DIR / f"snackcheck_{archive_schema(year)}.db"
+
+
+def archived_years() -> List[int]:
+    """Years that have an archive file, newest MAX_ATTACHED_ARCHIVES only."""
+    if not ARCHIVE_DIR.is_dir():
+        return []
+    years = sorted(int(match.group(1)) for match in map(_ARCHIVE_FILE.match, os.listdir(ARCHIVE_DIR)) if match)
+    return years[-MAX_ATTACHED_ARCHIVES:]
+
+
+def overlapping_years(years: Iterable[int], start: Optional[datetime], end: Optional[datetime]) -> List[int]:
+    """The archived years with rows in [start, end); None means unbounded on that side."""
+    overlapping = []
+    for year in years:
+        year_start, year_end = school_year_bounds(year)
+        if (start is None or _naive(start) < year_end) and (end is None or _naive(end) > year_start):
+            overlapping.append(year)
+    return overlapping
+
+
+def _naive(moment: datetime) -> datetime:
+    # Timestamps are stored as naive UTC
+    return moment.replace(tzinfo=None) if moment.tzinfo else moment
+
+
+def _sql_timestamp(moment: datetime) -> str:
+    # Same text format SQLAlchemy's DateTime uses on SQLite, so comparisons are lexicographic
+    return _naive(moment).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def attach_archives(dbapi_connection):
+    """For the engine's "connect" event: attaches every archive file to a new connection."""
+    cursor = dbapi_connection.cursor()
+    try:
+        for year in archived_years():
+            cursor.execute(f"ATTACH DATABASE ? AS {archive_schema(year)}", (str(archive_path(year)),))
+    finally:
+        cursor.close()
+
+
+def _attached_schemas(sync_conn) -> List[str]:
+    return [row[1] for row in sync_conn.exec_driver_sql("PRAGMA database_list").fetchall()]
+
+
+def _columns(sync_conn, schema: str, table: str) -> List[Tuple[str, str]]:
+    return [(row[1], row[2]) for row in sync_conn.exec_driver_sql(f"PRAGMA {schema}.table_info({table})").fetchall()]
+
+
+def sync_archive_table(sync_conn, schema: str, table: str):
+    """Creates the archive copy of a hot table, or adds the columns the hot table gained since."""
+    hot_columns = _columns(sync_conn, "main", table)
+    archive_columns = {name for name, _ in _columns(sync_conn, schema, table)}
+    if not archive_columns:
+        sync_conn.exec_driver_sql(f"CREATE TABLE {schema}.{table} AS SELECT * FROM main.{table} WHERE 0")
+        sync_conn.exec_driver_sql(f"CREATE UNIQUE INDEX IF NOT EXISTS {schema}.uq_{table}_id ON {table} (id)")
+        ts_column = ARCHIVED_TABLES[table]
+        sync_conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {schema}.ix_{table}_{ts_column} ON {table} ({ts_column})")
+        if any(name == "user_id" for name, _ in hot_columns):
+            sync_conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {schema}.ix_{table}_user_id ON {table} (user_id)")
+        return
+    for name, column_type in hot_columns:
+        if name not in archive_columns:
+            sync_conn.exec_driver_sql(f"ALTER TABLE {schema}.{table} ADD COLUMN {name} {column_type}")
+
+
+def ensure_archive(sync_conn, year: int) -> bool:
+    """
+    Attaches (creating if needed) the archive of a school year on this connection and
+    brings its tables up to date. Must run outside a transaction. Returns True if
+    the archive file is new.
+    """
+    schema = archive_schema(year)
+    path = archive_path(year)
+    created = not path.exists()
+    if schema not in _attached_schemas(sync_conn):
+        ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+        sync_conn.exec_driver_sql(f"ATTACH DATABASE ? AS {schema}", (str(path),))
+    for table in ARCHIVED_TABLES:
+        sync_archive_table(sync_conn, schema, table)
+    return created
+
+
+def sync_archive_schemas(sync_conn):
+    """At startup: every attached archive gets the columns added to the hot tables since."""
+    for schema in _attached_schemas(sync_conn):
+        if re.fullmatch(r"sy\d{4}", schema):
+            for table in ARCHIVED_TABLES:
+                if _columns(sync_conn, schema, table):
+                    sync_archive_table(sync_conn, schema, table)
+
+
+def install_archive_progress(sync_conn):
+    sync_conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS archive_progress ("
+        "table_name TEXT NOT NULL, school_year INTEGER NOT NULL, moved INTEGER NOT NULL DEFAULT 0, "
+        "updated_at TEXT NOT NULL, PRIMARY KEY (table_name, school_year))"
+    )
+
+
+def archive_plan(sync_conn, before: datetime, tables: Iterable[str]) -> List[Tuple[str, int]]:
+    """(table, school year) pairs that still have hot rows older than `before`, oldest first."""
+    plan = []
+    for table in tables:
+        ts_column = ARCHIVED_TABLES[table]
+        oldest = sync_conn.exec_driver_sql(
+            f"SELECT MIN({ts_column}) FROM main.{table} WHERE {ts_column} < ?", (_sql_timestamp(before),)
+        ).scalar()
+        if oldest is None:
+            continue
+        oldest = datetime.fromisoformat(str(oldest).replace("T", " "))
+        for year in range(school_year_of(oldest), school_year_of(_naive(before)) + 1):
+            if school_year_bounds(year)[0] < _naive(before):
+                plan.append((table, year))
+    return sorted(plan, key=lambda item: (item[1], item[0]))
+
+
+def move_batch(sync_conn, table: str, year: int, before: datetime, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Moves up to batch_size hot rows of one school year (and older than `before`) into
+    its archive, which must be attached. The caller commits. Returns the rows moved.
+    """
+    schema = archive_schema(year)
+    ts_column = ARCHIVED_TABLES[table]
+    year_start, year_end = school_year_bounds(year)
+    upper = min(year_end, _naive(before))
+    ids = [row[0] for row in sync_conn.exec_driver_sql(
+        f"SELECT id FROM main.{table} WHERE {ts_column} >= ? AND {ts_column} < ? ORDER BY {ts_column} LIMIT ?",
+        (_sql_timestamp(year_start), _sql_timestamp(upper), batch_size)
+    ).fetchall()]
+    if not ids:
+        return 0
+    columns = ", ".join(name for name, _ in _columns(sync_conn, "main", table))
+    placeholders = ", ".join("?" for _ in ids)
+    # REPLACE: on a re-run the hot row is the newer version of one copied earlier
+    sync_conn.exec_driver_sql(
+        f"INSERT OR REPLACE INTO {schema}.{table} ({columns}) SELECT {columns} FROM main.{table} WHERE id IN ({placeholders})",
+        tuple(ids)
+    )
+    sync_conn.exec_driver_sql(f"DELETE FROM main.{table} WHERE id IN ({placeholders})", tuple(ids))
+    sync_conn.exec_driver_sql(
+        "INSERT INTO archive_progress (table_name, school_year, moved, updated_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(table_name, school_year) DO UPDATE SET moved = moved + excluded.moved, updated_at = excluded.updated_at",
+        (table, year, len(ids), datetime.utcnow().isoformat())
+    )
+    return len(ids)
+
+
+def delete_user_from_archives(sync_conn, user_id: str):
+    """Deleting a user also removes their archived rows, in every attached archive."""
+    for schema in _attached_schemas(sync_conn):
+        if not re.fullmatch(r"sy\d{4}", schema):
+            continue
+        for table in ARCHIVED_TABLES:
+            if any(name == "user_id" for name, _ in _columns(sync_conn, schema, table)):
+                sync_conn.exec_driver_sql(f"DELETE FROM {schema}.{table} WHERE user_id = ?", (user_id,))
+
+
+def archive_status(sync_conn) -> List[dict]:
+    rows = sync_conn.exec_driver_sql(
+        "SELECT table_name, school_year, moved, updated_at FROM archive_progress ORDER BY school_year, table_name"
+    ).fetchall()
+    return [
+        {"table": table, "school_year": f"{year}-{year + 1}", "moved": moved, "updated_at": updated_at}
+        for table, year, moved, updated_at in rows
+    ]
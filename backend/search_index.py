@@ -0,0 +1,103 @@
+"""
+Full-text search over food entries, chat messages and feedback (SQLite FTS5).
+
+Each searchable table gets an external-content FTS5 table that stores only the
+index, plus triggers that keep it in step with every INSERT/UPDATE/DELETE on
+the base table, so no application code has to remember to reindex. Queries
+join the FTS rowid back to the base table and its user for access control and
+are ranked with bm25().
+"""
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+
+# source -> (base table, FTS table, indexed columns)
+SEARCH_SOURCES: Dict[str, Tuple[str, str, Tuple[str, ...]]] = {
+    "food_entries": ("food_entries", "food_entries_fts", ("food_name", "ai_feedback")),
+    "chat_messages": ("chat_messages", "chat_messages_fts", ("message",)),
+    "feedback": ("feedback_items", "feedback_items_fts", ("feedback_text",)),
+}
+
+# Diacritics folded (so "cafe" finds "café"), prefix indexes for type-ahead queries
+FTS_OPTIONS = "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'"
+MAX_QUERY_TERMS = 8
+
+
+def _trigger_sql(table: str, fts_table: str, columns: Tuple[str, ...]) -> List[str]:
+    cols = ", ".join(columns)
+    new_values = ", ".join(f"new.{column}" for column in columns)
+    old_values = ", ".join(f"old.{column}" for column in columns)
+    delete_old = f"INSERT INTO {fts_table}({fts_table}, rowid, {cols}) VALUES ('delete', old.rowid, {old_values});"
+    insert_new = f"INSERT INTO {fts_table}(rowid, {cols}) VALUES (new.rowid, {new_values});"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {table} BEGIN {insert_new} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {table} BEGIN {delete_old} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE OF {cols} ON {table} BEGIN {delete_old} {insert_new} END",
+    ]
+
+
+def install_search_index(sync_conn):
+    """Creates the FTS tables and triggers if missing; a new FTS table is filled from existing rows once."""
+    for table, fts_table, columns in SEARCH_SOURCES.values():
+        exists = sync_conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts_table,)
+        ).first()
+        if not exists:
+            sync_conn.exec_driver_sql(
+                f"CREATE VIRTUAL TABLE {fts_table} USING fts5({', '.join(columns)}, "
+                f"content = '{table}', content_rowid = 'rowid', {FTS_OPTIONS})"
+            )
+            sync_conn.exec_driver_sql(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+            logging.info(f"Built full-text index {fts_table} from existing {table} rows.")
+        for statement in _trigger_sql(table, fts_table, columns):
+            sync_conn.exec_driver_sql(statement)
+
+
+def optimize_search_index(sync_conn):
+    """Merges each FTS index's b-tree segments into one; an off-peak job, it rewrites the whole index."""
+    for _, fts_table, _ in SEARCH_SOURCES.values():
+        sync_conn.exec_driver_sql(f"INSERT INTO {fts_table}({fts_table}) VALUES ('optimize')")
+
+
+def to_match_query(user_query: str) -> Optional[str]:
+    """
+    Turns free text into a safe FTS5 query: every word must match, the last one as a
+    prefix ("energy dri" finds "energy drink"). FTS5 operators in the input are not
+    interpreted. Returns None when there is nothing to search for.
+    """
+    terms = re.findall(r"\w+", user_query.lower())[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    if len(terms[-1]) >= 2:
+        quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def search_sql(sources: List[str], scope: str) -> str:
+    """
+    One ranked query over the requested sources. `scope` limits rows by owner:
+    "all" (admin), "class" (:class_code) or "own" (:user_id); chat messages are
+    visible to the whole class, so "own" still uses :class_code for them.
+    Bound parameters: :query, :limit, :offset and the scope parameters.
+    """
+    selects = []
+    for source in sources:
+        table, fts_table, columns = SEARCH_SOURCES[source]
+        title_column = "t.food_name" if source == "food_entries" else "''"
+        where = [f"{fts_table} MATCH :query"]
+        if scope == "class" or (scope == "own" and source == "chat_messages"):
+            where.append("u.class_code = :class_code")
+        elif scope == "own":
+            where.append("t.user_id = :user_id")
+        selects.append(
+            f"SELECT '{source}' AS source, t.id AS id, t.user_id AS user_id, u.username AS username, "
+            f"u.class_code AS class_code, {title_column} AS title, "
+            f"snippet({fts_table}, -1, '[', ']', '…', 12) AS snippet, t.timestamp AS timestamp, "
+            f"bm25({fts_table}) AS rank "
+            f"FROM {fts_table} JOIN {table} t ON t.rowid = {fts_table}.rowid "
+            f"JOIN users u ON u.id = t.user_id "
+            f"WHERE {' AND '.join(where)}"
+        )
+    # bm25 is lower-is-better; id breaks ties so pages are stable
+    return " UNION ALL ".join(selects) + " ORDER BY rank, id LIMIT :limit OFFSET :offset"
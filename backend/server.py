@@ -1,4 +1,5 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, UploadFile, Form, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, UploadFile, Form, Request, Response, status
+from fastapi.responses import FileResponse, PlainTextResponse, JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials, OAuth2PasswordBearer
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
@@ -7,15 +8,17 @@ import json
 
 # SQLAlchemy imports
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
-from sqlalchemy.orm import declarative_base, Mapped, mapped_column
-from sqlalchemy import Column, Integer, String, DateTime, JSON as SAJson, ForeignKey, Float, Boolean, Text, select, update, delete, func, distinct # Renamed JSON to SAJson to avoid conflict with 'import json'
+from sqlalchemy import select, update, delete, func, distinct
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy import case, insert, bindparam, text, event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict
+from typing import Callable, List, Optional, Dict, Set, Tuple
 import uuid
-from datetime import datetime, timedelta
+import asyncio
+from datetime import datetime, timedelta, date, timezone
 import jwt
 import hashlib
 import base64
@@ -25,144 +28,238 @@ from PIL import Image
 import numpy as np
 import json
 import requests
+from request_profiler import SlowRequestProfiler, PROFILE_HEADER, monotonic_ms
+from photo_uploads import (
+    UPLOAD_DIR, MAX_UPLOAD_BYTES, UploadTooLarge, UnsupportedImage,
+    spool_upload, content_length_too_large, path_for_upload_url, urls_for_upload_name
+)
+from analysis_queue import AnalysisJobQueue, AnalysisNotifier, AnalysisWorkerPool, JOB_DONE, JOB_DEAD
+from gallery_feed import GalleryFeed, FEED_KINDS, NEWEST_INDEX_SIZE, TOP_WINDOW_DAYS, LIKE_FLUSH_SECONDS
+from shared_state import InvalidationBus, shared_store_lock
+from json_migration import JSON_STORE_FILES, NORMALIZERS, SQL_OWNED_FIELDS, diff_rows, normalize_daily_question, parse_timestamp
+from photo_dedupe import PhotoAnalysisIndex, dhash_bytes, hash_to_hex
+from inference_coalescer import InflightCoalescer
+from badge_engine import BadgeEngine, replay as replay_badge_events
+from search_index import SEARCH_SOURCES, install_search_index, optimize_search_index, search_sql, to_match_query
+from export_stream import EXPORT_FORMATS, encode_rows, export_headers, export_media_type
+from rate_limiter import AdmissionController, RateLimited, retry_after_header
+from execution_lanes import ExecutionLanes, LaneFull
+from warm_start import SnapshotStore, SNAPSHOT_INTERVAL_SECONDS, install_change_counters, read_change_counters
+from compact_records import AnalysisRecord, EntryColumns, UserRecord
+from class_activity import ACTIVITY_DEFAULT_DAYS, ACTIVITY_MAX_DAYS, ActivityCache, ActivityMatrix
+from password_hashing import PasswordHasher
+from scheduler import Daily, Job, JobScheduler, Weekly
+from memory_stats import DEFAULT_TOP_ALLOCATORS, AllocationStats
+from nutrition_ledger import LEDGER_MAX_DAYS, LEDGER_RECONCILE_DAYS, class_attainment, day_progress, entry_nutrition, goals_for, ledger_day, parse_quantity_grams, week_days, week_progress
+from tenant_shards import DEFAULT_SCHOOL, ShardRouter, TenantMap
+from db_models import (
+    Base, DATABASE_URL, USER_OWNED_MODELS, USER_ROLES, add_missing_columns_and_indexes,
+    UserDb, FoodEntryDb, CalorieCheckDb, FoodComparisonDb, ChatMessageDb, DailyQuestionDb, QuestionResponseDb,
+    GalleryDb, GalleryLikeDb, PointsLedgerDb, FeedbackDb, SyncMutationDb, BadgeCounterDb, NutritionLedgerDb, WeeklyClassReportDb
+)
+import endpoint_queries as queries
+from endpoint_queries import LEDGER_COLUMNS
+from school_archive import archive_status, archived_years, attach_archives, delete_user_from_archives, install_archive_progress, overlapping_years, sync_archive_schemas
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# Password Hashing
-# Password Hashing disabled
-# pwd_context was here
+# Password Hashing (see password_hashing.py). Routes use the async methods of
+# password_hasher, which run in its worker pool; the two functions below block
+# and are meant for scripts such as create_initial_admin.py.
+password_hasher = PasswordHasher()
 
 def verify_password(plain_password: str, stored_password: str) -> bool:
-    """Verifies a plain password against a stored (plain text) password."""
-    return plain_password == stored_password
+    """Verifies a password against a stored hash (or a legacy plain-text record)."""
+    valid, _ = password_hasher.verify_and_update_blocking(plain_password, stored_password)
+    return valid
 
 def get_password_hash(password: str) -> str:
-    """Returns the password as is (no hashing)."""
-    return password
+    return password_hasher.hash_blocking(password)
 
 
-# SQLAlchemy Database Setup
-DATABASE_URL = "sqlite+aiosqlite:///./snackcheck_local.db"  # Local SQLite file, ensure aiosqlite is in requirements.txt
-
+# SQLAlchemy Database Setup (the models and DATABASE_URL are in db_models.py)
 async_engine = create_async_engine(DATABASE_URL, echo=True)  # echo=True for logging SQL queries
 AsyncSessionLocal = async_sessionmaker(
     bind=async_engine,
     class_=AsyncSession,
     expire_on_commit=False
 )
-Base = declarative_base()
-
-# --- SQLAlchemy Database Models ---
-class UserDb(Base):
-    __tablename__ = "users"
-
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    username: Mapped[str] = mapped_column(String(100), index=True)
-    password_hash: Mapped[str] = mapped_column(String(256))
-    class_code: Mapped[str] = mapped_column(String(50), index=True)
-    role: Mapped[str] = mapped_column(String(50))
-    points: Mapped[int] = mapped_column(Integer, default=0)
-    level: Mapped[int] = mapped_column(Integer, default=1)
-    badges: Mapped[List[str]] = mapped_column(SAJson, default=lambda: []) # Use lambda for default mutable list
-    streak_days: Mapped[int] = mapped_column(Integer, default=0)
-    last_entry_date: Mapped[Optional[str]] = mapped_column(String(10), nullable=True) # Format YYYY-MM-DD
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-
-class FoodEntryDb(Base):
-    __tablename__ = "food_entries"
-
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
-    food_name: Mapped[str] = mapped_column(String(255))
-    meal_type: Mapped[str] = mapped_column(String(50))
-    quantity: Mapped[str] = mapped_column(String(100))
-    image_data: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # Base64 encoded image
-    image_url: Mapped[Optional[str]] = mapped_column(String(512), nullable=True)
-    ai_score: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
-    ai_feedback: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
-    ai_suggestions: Mapped[Optional[List[str]]] = mapped_column(SAJson, nullable=True)
-    calories_estimated: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
-    nutrition_info: Mapped[Optional[Dict]] = mapped_column(SAJson, nullable=True)
-    points_earned: Mapped[int] = mapped_column(Integer, default=0)
-    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
-
-class CalorieCheckDb(Base):
-    __tablename__ = "calorie_checks"
-
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
-    food_name: Mapped[str] = mapped_column(String(255))
-    quantity: Mapped[str] = mapped_column(String(100))
-    calories_per_100g: Mapped[float] = mapped_column(Float)
-    estimated_calories: Mapped[float] = mapped_column(Float)
-    nutrition_breakdown: Mapped[Optional[Dict]] = mapped_column(SAJson, nullable=True)
-    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-
-class FoodComparisonDb(Base):
-    __tablename__ = "food_comparisons"
-
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
-    food_1: Mapped[str] = mapped_column(String(255))
-    food_2: Mapped[str] = mapped_column(String(255))
-    comparison_result: Mapped[Dict] = mapped_column(SAJson)
-    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-
-class ChatMessageDb(Base):
-    __tablename__ = "chat_messages"
-
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
-    username: Mapped[str] = mapped_column(String(100))
-    message: Mapped[str] = mapped_column(Text)
-    is_admin: Mapped[bool] = mapped_column(Boolean, default=False)
-    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
-
-class DailyQuestionDb(Base):
-    __tablename__ = "daily_questions"
-
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    question: Mapped[str] = mapped_column(Text)
-    options: Mapped[List[str]] = mapped_column(SAJson)
-    date: Mapped[str] = mapped_column(String(10), index=True)  # YYYY-MM-DD
-    active: Mapped[bool] = mapped_column(Boolean, default=True)
-    points_reward: Mapped[int] = mapped_column(Integer, default=5)
-
-class QuestionResponseDb(Base):
-    __tablename__ = "question_responses"
-
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
-    question_id: Mapped[str] = mapped_column(String(36), ForeignKey("daily_questions.id"), index=True)
-    answer: Mapped[str] = mapped_column(Text)
-    points_earned: Mapped[int] = mapped_column(Integer, default=0)
-    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-
-class GalleryDb(Base):
-    __tablename__ = "gallery_items"
-
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id: Mapped[str] = mapped_column(String(36), ForeignKey("users.id"), index=True)
-    username: Mapped[str] = mapped_column(String(100))
-    food_name: Mapped[str] = mapped_column(String(255))
-    image_data: Mapped[str] = mapped_column(Text)  # Base64 encoded image
-    ai_score: Mapped[float] = mapped_column(Float)
-    likes: Mapped[int] = mapped_column(Integer, default=0)
-    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
 
+@event.listens_for(async_engine.sync_engine, "connect")
+def attach_school_archives(dbapi_connection, connection_record):
+    # Archived school years (see school_archive.py) are readable from every connection
+    attach_archives(dbapi_connection)
+
+# Per-school databases (see tenant_shards.py); async_engine is the default shard and user directory
+shard_router = ShardRouter(async_engine, TenantMap.load())
+
+
+
+# School of each user, looked up once per process in the directory (the default database)
+user_school_cache: Dict[str, str] = {}
+
+async def school_for_user(user_id: Optional[str]) -> str:
+    if not shard_router.sharded or not user_id:
+        return DEFAULT_SCHOOL
+    if user_id not in user_school_cache:
+        async with shard_router.session(DEFAULT_SCHOOL) as db:
+            class_code = (await db.execute(select(UserDb.class_code).where(UserDb.id == user_id))).scalar_one_or_none()
+        user_school_cache[user_id] = shard_router.school_for_class_code(class_code)
+    return user_school_cache[user_id]
+
+async def school_for_entry(entry_id: str) -> str:
+    """For background work that only has an entry id, like the analysis queue."""
+    if not shard_router.sharded:
+        return DEFAULT_SCHOOL
+
+    async def has_entry(db: AsyncSession, school: str):
+        return (await db.execute(select(FoodEntryDb.id).where(FoodEntryDb.id == entry_id))).first()
+
+    return await shard_router.locate(has_entry) or DEFAULT_SCHOOL
 
 # Dependency to get DB session
-async def get_db() -> AsyncSession:
-    async with AsyncSessionLocal() as session:
+async def get_db(request: Request) -> AsyncSession:
+    # The requesting user's school database; requests without a valid token (login) use the default one
+    school = await school_for_user(request_user_id(request))
+    async with shard_router.session(school) as session:
         try:
             yield session
         finally:
             await session.close() # Ensure session is closed
 
+# JSON -> SQL cutover (see migrate_json_to_sqlite.py):
+#   "json": read and write the JSON stores only (old behaviour)
+#   "dual": serve reads from JSON, mirror writes to SQL and log any read differences
+#   "sql":  serve reads from SQL; writes still go to both stores
+DATA_READ_MODE = os.environ.get("SNACKCHECK_READ_MODE", "json").lower()
+
+# Shared content that every school database gets a copy of
+GLOBAL_COLLECTIONS = {"daily_questions"}
+# /search reads these from their SQL tables (FTS), so they are written to SQL in every read mode.
+# Rows from before that: migrate_json_to_sqlite.py migrate --only chat_messages,feedback_items
+SEARCHED_COLLECTIONS = {"chat_messages", "feedback_items"}
+# Logins, the current user and point awards read users from SQL, so users are written there in every mode too
+SQL_READ_COLLECTIONS = SEARCHED_COLLECTIONS | {"users"}
+
+async def schools_for_record(collection: str, record: Dict) -> List[str]:
+    if not shard_router.sharded:
+        return [DEFAULT_SCHOOL]
+    if collection in GLOBAL_COLLECTIONS:
+        return shard_router.schools
+    if collection == "users":
+        # The directory keeps every user; the school's database gets its own copy
+        return list(dict.fromkeys([DEFAULT_SCHOOL, shard_router.school_for_class_code(record.get("class_code"))]))
+    return [await school_for_user(record.get("user_id"))]
+
+def mirror_statement(collection: str, row: Dict):
+    """Upsert of a normalized JSON record; SQL-owned columns of an existing row are kept."""
+    table = Base.metadata.tables[NORMALIZERS[collection][0]]
+    key_columns = [column.name for column in table.primary_key.columns]
+    stmt = sqlite_insert(table).values(row)
+    updated = {
+        column: stmt.excluded[column] for column in row
+        if column not in key_columns and column not in SQL_OWNED_FIELDS.get(collection, ())
+    }
+    if not updated:
+        return stmt.on_conflict_do_nothing()
+    return stmt.on_conflict_do_update(index_elements=key_columns, set_=updated)
+
+async def mirror_to_sql(collection: str, record: Dict):
+    """Writes a record that was just created or changed in a JSON store to its SQL table as well."""
+    if DATA_READ_MODE == "json" and collection not in SQL_READ_COLLECTIONS:
+        return
+    row = NORMALIZERS[collection][1](record)
+    for school in await schools_for_record(collection, record):
+        async with shard_router.session(school) as db:
+            try:
+                await db.execute(mirror_statement(collection, row))
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                logging.error(f"Error mirroring {collection} record {record.get('id')} to SQL ({school}): {e}")
+
+async def set_user_totals_in_sql(user_id: str, values: Dict, awarded_by: Optional[str] = None):
+    """
+    Admin overrides of the SQL-owned user columns (points, streak, level). The change in
+    points is logged to the points ledger of the user's school like any other award.
+    """
+    school = await school_for_user(user_id)
+    for target in dict.fromkeys([school, DEFAULT_SCHOOL]):
+        async with shard_router.session(target) as db:
+            try:
+                old_points = (await db.execute(select(UserDb.points).where(UserDb.id == user_id))).scalar_one_or_none()
+                if old_points is None:
+                    continue
+                await db.execute(update(UserDb).where(UserDb.id == user_id).values(**values))
+                if target == school and "points" in values and values["points"] != old_points:
+                    db.add(PointsLedgerDb(user_id=user_id, points=values["points"] - old_points, reason="admin_adjustment", awarded_by=awarded_by))
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                logging.error(f"Error updating the totals of user {user_id} in SQL ({target}): {e}")
+
+
+
+async def delete_user_rows_from_sql(user_id: str):
+    """Keeps the SQL tables in step with the JSON cascade in admin_delete_user."""
+    school = await school_for_user(user_id)  # Before the directory row is gone
+    for target in dict.fromkeys([school, DEFAULT_SCHOOL]):
+        async with shard_router.session(target) as db:
+            try:
+                # Other users' likes of this user's gallery items go with the items
+                await db.execute(delete(GalleryLikeDb).where(
+                    GalleryLikeDb.item_id.in_(select(GalleryDb.id).where(GalleryDb.user_id == user_id))
+                ))
+                for model in USER_OWNED_MODELS:
+                    await db.execute(delete(model).where(model.user_id == user_id))
+                await db.execute(delete(UserDb).where(UserDb.id == user_id))
+                if target == DEFAULT_SCHOOL:
+                    await (await db.connection()).run_sync(delete_user_from_archives, user_id)
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                logging.error(f"Error deleting SQL rows for user {user_id} ({target}): {e}")
+    user_school_cache.pop(user_id, None)
+    class_activity_cache.forget_user(user_id)
+
+async def store_password_hash(user_id: str, password_hash: str):
+    """Saves a rehashed password (legacy record or old cost profile) to the JSON store and SQL."""
+    async with shared_store_lock("users"):
+        all_users = await execution_lanes.run_blocking(load_users)
+        for user in all_users:
+            if user.get("id") == user_id:
+                user["password_hash"] = password_hash
+                await execution_lanes.run_blocking(save_users, all_users)
+                break
+    school = await school_for_user(user_id)
+    for target in dict.fromkeys([school, DEFAULT_SCHOOL]):
+        async with shard_router.session(target) as db:
+            try:
+                await db.execute(update(UserDb).where(UserDb.id == user_id).values(password_hash=password_hash))
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                logging.error(f"Error storing the upgraded password hash of user {user_id} ({target}): {e}")
+
+def log_read_differences(collection: str, json_records: List[Dict], sql_rows: List[Dict]):
+    """Dual-read consistency check for one response; only logs, never changes the response."""
+    _, normalizer, fields = NORMALIZERS[collection]
+    report = diff_rows((normalizer(record) for record in json_records), sql_rows, fields)
+    if not report["consistent"]:
+        logging.warning(f"Dual-read mismatch for {collection}: {report}")
+
 # HuggingFace Client
 hf_client = InferenceClient(token=os.environ.get('HF_API_KEY'))
 
+# The hosted model takes one input per request, so concurrent analyses are not
+# batched: identical ones share one call and each caller resumes when its own
+# call finishes (see inference_coalescer.py).
+food_analysis_calls = InflightCoalescer(lambda food_name, image_data=None: analyze_food_with_huggingface(food_name, image_data))
+
+async def analyze_food_coalesced(food_name: str, image_data: Optional[str] = None) -> Dict:
+    return await food_analysis_calls.submit((food_name, image_data))
+
 # Create the main app without a prefix
 app = FastAPI(title="SnackCheck Research Platform", version="3.0.0")
 
@@ -183,6 +280,52 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
+# Cross-worker cache invalidation (see shared_state.py)
+invalidation_bus = InvalidationBus()
+
+# School-year archives (see school_archive.py): years whose archive is attached to every connection
+school_archive_years = archived_years()
+def archived_source(model, start: Optional[datetime] = None, end: Optional[datetime] = None, school: str = DEFAULT_SCHOOL):
+    """
+    The model itself, or an alias of it over the hot table plus the archives that the
+    time range [start, end) touches. No range means all history. Archives belong to
+    the default database; school databases don't have any yet.
+    """
+    years = overlapping_years(school_archive_years, start, end) if school == DEFAULT_SCHOOL else []
+    return queries.with_archives(model, years)
+
+async def reattach_school_archives():
+    global school_archive_years
+    # New connections attach the current set of archive files; drop the pooled ones first
+    await async_engine.dispose()
+    school_archive_years = archived_years()
+
+def on_archive_invalidated(topic: str):
+    asyncio.create_task(reattach_school_archives())
+
+invalidation_bus.subscribe("archive", on_archive_invalidated)
+
+async def reload_shard_map():
+    await shard_router.reload(TenantMap.load())
+    user_school_cache.clear()
+
+def on_shards_invalidated(topic: str):
+    # add_school_shard.py published a new shards file
+    asyncio.create_task(reload_shard_map())
+
+invalidation_bus.subscribe("shards", on_shards_invalidated)
+
+# Uploaded photos are stored on disk; GET /api/uploads/{file_name} serves them to the owner's class only
+UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    # Reject before the multipart body is read at all, based on Content-Length
+    if request.method == "POST" and request.url.path == "/api/food-entries/upload":
+        if content_length_too_large(request.headers.get("content-length")):
+            return JSONResponse(status_code=413, content={"detail": f"Image exceeds the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit"})
+    return await call_next(request)
+
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/login")
@@ -193,14 +336,98 @@ SECRET_KEY = "snackcheck_secret_key_2024"
 ALGORITHM = "HS256"  # Added ALGORITHM constant
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7 # 7 days
 
-# User Roles
-USER_ROLES = {
-    "STUDENT_CLASS_1": "student_class_1",
-    "STUDENT_CLASS_2": "student_class_2", 
-    "STUDENT_CLASS_3": "student_class_3",
-    "TEACHER": "teacher",
-    "ADMIN": "admin"
-}
+
+
+# Slow-request profiling (see request_profiler.py for configuration)
+slow_request_profiler = SlowRequestProfiler()
+
+def request_user_id(request: Request) -> Optional[str]:
+    """The user id from a raw request's bearer token, or None; only used for routing, not auth."""
+    auth_header = request.headers.get("authorization", "")
+    if not auth_header.lower().startswith("bearer "):
+        return None
+    try:
+        payload = jwt.decode(auth_header[7:], SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+    return payload.get("user_id") or payload.get("sub")
+
+def is_admin_request(request: Request) -> bool:
+    """Checks the bearer token of a raw request for the admin role, without touching the DB."""
+    auth_header = request.headers.get("authorization", "")
+    if not auth_header.lower().startswith("bearer "):
+        return False
+    try:
+        payload = jwt.decode(auth_header[7:], SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.InvalidTokenError:
+        return False
+    return payload.get("role") == USER_ROLES["ADMIN"]
+
+# Execution lanes (see execution_lanes.py): these routes share a small concurrency
+# budget so they can't crowd out the student-facing requests
+HEAVY_ROUTES = [
+    ("DELETE", r"^/api/admin/users/[^/]+$", "heavy"),
+    ("GET", r"^/api/analytics/class-summary$", "heavy"),
+    ("GET", r"^/api/export/", "heavy"),
+    ("POST", r"^/api/admin/badges/backfill$", "heavy"),
+    ("POST", r"^/api/classes/[^/]+/award-points$", "heavy"),
+]
+execution_lanes = ExecutionLanes(HEAVY_ROUTES)
+
+class ReleaseAfterSending:
+    """Wraps a response so the lane slot is given back once its body is sent (or the client left)."""
+
+    def __init__(self, response: Response, release: Callable[..., None]):
+        self.response = response
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        failed = True
+        try:
+            await self.response(scope, receive, send)
+            failed = False
+        finally:
+            self.release(failed=failed)
+
+@app.middleware("http")
+async def route_to_lane(request: Request, call_next):
+    lane = execution_lanes.lane_for(request.method, request.url.path)
+    try:
+        release = await lane.acquire()
+    except LaneFull:
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "The server is busy with other heavy requests, please retry shortly."},
+            headers={"Retry-After": "5"}
+        )
+    try:
+        response = await call_next(request)
+    except BaseException:
+        release(failed=True)
+        raise
+    # call_next returns as soon as the response starts; a streamed body (exports) runs while it is sent
+    return ReleaseAfterSending(response, release)
+
+@app.middleware("http")
+async def profile_slow_requests(request: Request, call_next):
+    header_value = request.headers.get(PROFILE_HEADER)
+    if not slow_request_profiler.should_profile(header_value, is_admin_request(request) if header_value else False):
+        return await call_next(request)
+
+    request_samples = slow_request_profiler.begin()
+    started_ms = monotonic_ms()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        duration_ms = monotonic_ms() - started_ms
+        profile_id = slow_request_profiler.finish(request_samples, request.method, request.url.path, status_code, duration_ms)
+        if profile_id:
+            logging.info(f"Captured slow-request profile {profile_id} for {request.method} {request.url.path} ({duration_ms:.0f} ms)")
+    if profile_id:
+        response.headers["X-SnackCheck-Profile-Id"] = profile_id
+    return response
 
 # Enhanced nutrition database with calorie information
 NUTRITION_DATA = {
@@ -248,17 +475,322 @@ class User(BaseModel):
     last_entry_date: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class UserOut(BaseModel):
+    """A user as returned by the API: User without the password hash."""
+    id: str
+    username: str
+    class_code: str
+    role: str
+    points: int = 0
+    level: int = 1
+    badges: List[str] = []
+    streak_days: int = 0
+    last_entry_date: Optional[str] = None
+    created_at: Optional[datetime] = None
+
 class UserLogin(BaseModel):
     username: str
     password: str
+
+class UserCreate(BaseModel):
+    username: str
+    password: str
+    class_code: str
+    role: Optional[str] = None
+
+# Model for user data returned after successful login (excludes password_hash)
+class UserResponse(BaseModel):
+    id: str
+    username: str
+    class_code: str
+    role: str
+    points: Optional[int] = 0
+    level: Optional[int] = 1
+    badges: Optional[List[str]] = Field(default_factory=list)
+    streak_days: Optional[int] = 0
+    last_entry_date: Optional[str] = None
+    created_at: str
+
+class CalorieCheckRequest(BaseModel):
+    food_item: str
+
+class ChatMessage(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    username: str
+    class_code: Optional[str] = None
+    message: str
+    is_admin: bool = False
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class DailyQuestionCreate(BaseModel):
+    question: str
+    options: List[str]
+    date: str  # Expecting YYYY-MM-DD format
+    active: bool = True
+    points_reward: int = 5
+
+class DailyQuestion(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    question: str
+    options: List[str]
+    date: str
+    active: bool = True
+    points_reward: int = 5
+
+class QuestionResponse(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    username: Optional[str] = None
+    class_code: Optional[str] = None
+    question_id: str
+    response_text: str
+    points_earned: int = 0
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class QuestionResponseCreate(BaseModel):
+    question_id: str
+    response_text: str
+
+class FeedbackCreate(BaseModel):
+    feedback_text: str
+    category: Optional[str] = None
+
+class Feedback(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    username: str
+    feedback_text: str
+    category: Optional[str] = None
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class AdminUpdatePointsRequest(BaseModel):
+    new_points: int
+
+class ClassSummaryStat(BaseModel):
+    class_code: str
+    total_entries: int
+    avg_score: Optional[float] = None
+    total_points_from_entries: int
+    avg_calories: Optional[float] = None
+    active_users: int
+
+class UserStats(BaseModel):
+    total_entries: int
+    avg_score: Optional[float] = None
+    total_points: int
+    level: int
+    badges: List[str]
+    streak_days: int
+    total_calories_consumed: int
+    avg_calories_per_day: Optional[float] = None
+
+# AI Functions
+async def analyze_food_with_huggingface(food_name: str, image_data: str = None) -> Dict:
+    """Enhanced AI analysis using HuggingFace API"""
+    try:
+        # Try to use HuggingFace for food recognition if image is provided
+        if image_data and hf_client:
+            try:
+                image_bytes = base64.b64decode(image_data)
+                # The client call blocks on the network, so it runs in the I/O pool
+                result = await execution_lanes.run_blocking(hf_client.image_classification, image_bytes, model="nateraw/food")
+                if result:
+                    top_prediction = result[0]
+                    detected_food = (getattr(top_prediction, "label", None) or food_name).lower()
+                    confidence = getattr(top_prediction, "score", 0.5)
+                    food_name = detected_food
+                    logging.info(f"HuggingFace detected: {detected_food} (confidence: {confidence})")
+            except Exception as e:
+                logging.error(f"HuggingFace API error: {e}")
+                # Fall back to manual analysis
+
+        # Analyze using our nutrition database
+        food_lower = food_name.lower()
+        for food_key, data in NUTRITION_DATA.items():
+            if food_key in food_lower or food_lower in food_key:
+                return {
+                    "score": data["score"],
+                    "feedback": data["tips"],
+                    "suggestions": generate_healthy_alternatives(data["category"], data["score"]),
+                    "category": data["category"],
+                    "calories_per_100g": data["calories_per_100g"],
+                    "detected_food": food_name,
+                    "confidence": 0.9
+                }
+
+        # Default analysis for unknown foods
+        return {
+            "score": 5,
+            "feedback": "We couldn't analyze this food precisely. Try to include more fruits and vegetables in your diet!",
+            "suggestions": ["Try adding some fruits", "Consider vegetables as snacks", "Drink more water"],
+            "category": "unknown",
+            "calories_per_100g": 200,  # Estimated
+            "detected_food": food_name,
+            "confidence": 0.3
+        }
+
+    except Exception as e:
+        logging.error(f"Food analysis error: {e}")
+        return {
+            "score": 5,
+            "feedback": "Error analyzing food. Please try again.",
+            "suggestions": ["Try again with a clearer image"],
+            "category": "unknown",
+            "calories_per_100g": 200,
+            "detected_food": food_name,
+            "confidence": 0.1
+        }
+
+def generate_healthy_alternatives(category: str, current_score: int) -> List[str]:
+    """Generate healthy alternatives based on food category"""
+    if current_score >= 7:
+        return ["Great choice! Keep it up!", "Maybe add some variety with other healthy options"]
+
+    alternatives = {
+        "sweets": ["Try fresh fruits like berries or grapes", "Dark chocolate (70%+) in small amounts", "Frozen grapes or banana 'ice cream'"],
+        "snacks": ["Raw nuts or seeds", "Carrot sticks with hummus", "Air-popped popcorn"],
+        "drinks": ["Water with lemon or cucumber", "Herbal tea", "Sparkling water with fruit"],
+        "fast_food": ["Grilled chicken salad", "Veggie wrap with hummus", "Homemade smoothie bowl"],
+        "processed": ["Whole grain alternatives", "Fresh fruits and vegetables", "Homemade versions with less salt/sugar"]
+    }
+
+    return alternatives.get(category, ["Add more fruits and vegetables", "Choose whole grain options", "Drink more water"])
+
+# Authentication
+def create_jwt_token(user_id: str, role: str) -> str:
+    payload = {
+        "user_id": user_id,
+        "role": role,
+        "exp": datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    }
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+
+def user_from_row(user_db: UserDb) -> User:
+    return User(
+        id=user_db.id,
+        username=user_db.username,
+        password_hash=user_db.password_hash,
+        class_code=user_db.class_code,
+        role=user_db.role,
+        points=user_db.points or 0,
+        level=user_db.level or 1,
+        badges=user_db.badges or [],
+        streak_days=user_db.streak_days or 0,
+        last_entry_date=user_db.last_entry_date,
+        created_at=user_db.created_at
+    )
+
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
+    # Points, streaks and levels are awarded in SQL, so the user is read from the user's school database
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired", headers={"WWW-Authenticate": "Bearer"})
+    except jwt.InvalidTokenError:
+        raise credentials_exception
+    user_id = payload.get("user_id") or payload.get("sub")
+    if not user_id:
+        raise credentials_exception
+
+    async with shard_router.session(await school_for_user(user_id)) as db:
+        user_db = (await db.execute(queries.user_by_id(user_id))).scalar_one_or_none()
+    if user_db is None:
+        raise credentials_exception
+    return user_from_row(user_db)
+
+async def get_current_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return current_user
+
+def get_role_from_class_code(class_code: str) -> str:
+    role_mapping = {
+        "KLAS1": USER_ROLES["STUDENT_CLASS_1"],
+        "KLAS2": USER_ROLES["STUDENT_CLASS_2"],
+        "KLAS3": USER_ROLES["STUDENT_CLASS_3"],
+        "DOCENT": USER_ROLES["TEACHER"],
+        "ADMIN": USER_ROLES["ADMIN"]
+    }
+    return role_mapping.get(class_code.upper(), "")
+
+# JSON stores. Callers hold shared_store_lock(<collection>) around a load/save pair;
+# a save replaces the file in one rename, so a reader never sees half of it.
+USERS_FILE = ROOT_DIR / JSON_STORE_FILES["users"]
+FOOD_ENTRIES_FILE = ROOT_DIR / JSON_STORE_FILES["food_entries"]
+GALLERY_ITEMS_FILE = ROOT_DIR / JSON_STORE_FILES["gallery_items"]
+CALORIE_CHECKS_FILE = ROOT_DIR / JSON_STORE_FILES["calorie_checks"]
+FOOD_COMPARISONS_FILE = ROOT_DIR / JSON_STORE_FILES["food_comparisons"]
+CHAT_MESSAGES_FILE = ROOT_DIR / JSON_STORE_FILES["chat_messages"]
+DAILY_QUESTIONS_FILE = ROOT_DIR / JSON_STORE_FILES["daily_questions"]
+QUESTION_RESPONSES_FILE = ROOT_DIR / JSON_STORE_FILES["question_responses"]
+FEEDBACK_ITEMS_FILE = ROOT_DIR / JSON_STORE_FILES["feedback_items"]
+
+def load_json_store(path: Path) -> List[Dict]:
+    if not path.exists():
+        return []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+            return data if isinstance(data, list) else []
+    except (json.JSONDecodeError, IOError) as e:
+        logging.error(f"Error loading or parsing {path}: {e}")
+        return []
+
+def save_json_store(path: Path, records: List[Dict]):
+    tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(records, f, indent=2, default=str)
+        os.replace(tmp_path, path)
+    except IOError as e:
+        logging.error(f"Error writing to {path}: {e}")
+
+def load_users(): return load_json_store(USERS_FILE)
+def save_users(users): save_json_store(USERS_FILE, users)
+def load_food_entries(): return load_json_store(FOOD_ENTRIES_FILE)
+def save_food_entries(food_entries): save_json_store(FOOD_ENTRIES_FILE, food_entries)
+def load_gallery_items(): return load_json_store(GALLERY_ITEMS_FILE)
+def save_gallery_items(gallery_items): save_json_store(GALLERY_ITEMS_FILE, gallery_items)
+def load_calorie_checks(): return load_json_store(CALORIE_CHECKS_FILE)
+def save_calorie_checks(checks): save_json_store(CALORIE_CHECKS_FILE, checks)
+def load_food_comparisons(): return load_json_store(FOOD_COMPARISONS_FILE)
+def save_food_comparisons(comparisons): save_json_store(FOOD_COMPARISONS_FILE, comparisons)
+def load_chat_messages(): return load_json_store(CHAT_MESSAGES_FILE)
+def save_chat_messages(messages): save_json_store(CHAT_MESSAGES_FILE, messages)
+def load_daily_questions(): return load_json_store(DAILY_QUESTIONS_FILE)
+def save_daily_questions(questions): save_json_store(DAILY_QUESTIONS_FILE, questions)
+def load_question_responses(): return load_json_store(QUESTION_RESPONSES_FILE)
+def save_question_responses(responses): save_json_store(QUESTION_RESPONSES_FILE, responses)
+def load_feedback_items(): return load_json_store(FEEDBACK_ITEMS_FILE)
+def save_feedback_items(feedback_items): save_json_store(FEEDBACK_ITEMS_FILE, feedback_items)
+
+@api_router.post("/login")
+async def login_user(login_data: UserLogin, db_session: AsyncSession = Depends(get_db)):
+    # Requests without a token use the default database, the directory of every user
+    user_result = await db_session.execute(
+        select(UserDb).where(UserDb.username == login_data.username).order_by(UserDb.created_at).limit(1)
     )
     db_user = user_result.scalar_one_or_none()
 
-    if not db_user or not verify_password(login_data.password, db_user.password_hash):
+    try:
+        password_ok, upgraded_hash = await password_hasher.verify_and_update(
+            login_data.password, db_user.password_hash if db_user else None
+        )
+    except LaneFull:
+        raise HTTPException(status_code=503, detail="Too many logins at once, please retry shortly.", headers={"Retry-After": "2"})
+    if not db_user or not password_ok:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if upgraded_hash:
+        await store_password_hash(db_user.id, upgraded_hash)
 
     token_str = create_jwt_token(user_id=db_user.id, role=db_user.role)
-    
+
     user_response_data = {
         "id": db_user.id,
         "username": db_user.username,
@@ -268,7 +800,7 @@ class UserLogin(BaseModel):
         "level": db_user.level,
         "badges": db_user.badges if db_user.badges else [],
         "streak_days": db_user.streak_days,
-        "last_entry_date": db_user.last_entry_date.strftime("%Y-%m-%d") if db_user.last_entry_date else None,
+        "last_entry_date": db_user.last_entry_date,  # Stored as YYYY-MM-DD
         "created_at": db_user.created_at.isoformat() # Ensure created_at is string for UserResponse
     }
     user_for_response = UserResponse.model_validate(user_response_data)
@@ -278,77 +810,121 @@ class UserLogin(BaseModel):
         "user": user_for_response
     }
 
-# ... (rest of the code remains the same)
+POINTS_PER_LEVEL = 100
 
-async def update_user_data_in_db(user_id: str, points_awarded: int, db: AsyncSession):
+def points_award_values(points_awarded: int, counts_for_streak: bool, today: date) -> Dict:
     """
-    Updates user's points, streak, level in the database based on a new food entry.
+    SET clause for an atomic award. Every expression reads the row's old values,
+    so points, streak and level are derived in one UPDATE without a prior SELECT.
+    `today` is the UTC day, like the nutrition ledger and the activity matrix.
     """
-    from datetime import date, timedelta # Ensure date and timedelta are imported
-
-    user_result = await db.execute(select(UserDb).where(UserDb.id == user_id))
-    user_db = user_result.scalar_one_or_none()
+    values = {
+        "points": UserDb.points + points_awarded,
+        "level": func.max(func.coalesce(UserDb.level, 1), (UserDb.points + points_awarded) // POINTS_PER_LEVEL + 1)
+    }
+    if counts_for_streak:
+        today_str = today.strftime("%Y-%m-%d")
+        yesterday_str = (today - timedelta(days=1)).strftime("%Y-%m-%d")
+        values["streak_days"] = case(
+            (UserDb.last_entry_date == today_str, UserDb.streak_days),
+            (UserDb.last_entry_date == yesterday_str, UserDb.streak_days + 1),
+            else_=1
+        )
+        values["last_entry_date"] = today_str
+    return values
 
-    if not user_db:
-        logging.error(f"User with ID {user_id} not found in DB for points/streak update.")
+async def award_points(
+    db: AsyncSession,
+    user_id: str,
+    points_awarded: int,
+    reason: str,
+    source_id: Optional[str] = None,
+    awarded_by: Optional[str] = None,
+    counts_for_streak: bool = False
+) -> Optional[Dict]:
+    """
+    Atomically adds points to a user and appends a ledger row. Does not commit, so the
+    caller can group it with other writes. Returns the new points/streak/level or None.
+    """
+    result = await db.execute(
+        update(UserDb)
+        .where(UserDb.id == user_id)
+        .values(**points_award_values(points_awarded, counts_for_streak, datetime.utcnow().date()))
+        .returning(UserDb.points, UserDb.streak_days, UserDb.level)
+    )
+    row = result.first()
+    if row is None:
+        return None
+    db.add(PointsLedgerDb(user_id=user_id, points=points_awarded, reason=reason, source_id=source_id, awarded_by=awarded_by))
+    badge_events = [{"type": "points", "user_id": user_id, "points_before": row.points - points_awarded, "points": row.points}]
+    if counts_for_streak:
+        badge_events.append({"type": "streak", "user_id": user_id, "streak_days": row.streak_days})
+    await apply_badge_events(db, user_id, badge_events)
+    return {"points": row.points, "streak_days": row.streak_days, "level": row.level}
+
+# Badges (see badge_engine.py for the rules)
+badge_engine = BadgeEngine()
+
+async def grant_badges(db: AsyncSession, user_id: str, badge_names: List[str]):
+    user_db = (await db.execute(select(UserDb).where(UserDb.id == user_id))).scalar_one_or_none()
+    if user_db is None:
         return
+    new_badges = [name for name in badge_names if name not in (user_db.badges or [])]
+    if new_badges:
+        user_db.badges = list(user_db.badges or []) + new_badges  # Reassign so the JSON column is marked dirty
+        logging.info(f"User {user_id} earned badge(s): {', '.join(new_badges)}")
 
-    today_date_obj = date.today()
-    today_str = today_date_obj.strftime("%Y-%m-%d")
-
-    # Update points
-    user_db.points = (user_db.points or 0) + points_awarded
-
-    # Update streak
-    current_streak = user_db.streak_days or 0
-    last_entry_date_obj = user_db.last_entry_date
-
-    if last_entry_date_obj != today_date_obj:
-        if last_entry_date_obj:
-            days_diff = (today_date_obj - last_entry_date_obj).days
-            if days_diff == 1:
-                current_streak += 1
-            elif days_diff > 1:
-                current_streak = 1  # Reset streak
-            # If days_diff <= 0 (entry from future or same day already handled), do nothing to streak here
-            # This case (days_diff <=0) should ideally not happen if last_entry_date is always in the past.
-        else:  # No last_entry_date, so first entry for streak purposes
-            current_streak = 1
-        
-        user_db.last_entry_date = today_date_obj
-        user_db.streak_days = current_streak
-    
-    # Update level
-    points_per_level = 100 
-    new_level = (user_db.points // points_per_level) + 1
-    if new_level > user_db.level:
-        user_db.level = new_level
-    elif user_db.level == 0: # Ensure level is at least 1
-        user_db.level = 1
-
-    try:
-        await db.commit()
-        await db.refresh(user_db)
-        logging.info(f"User {user_id} points/streak updated. New points: {user_db.points}, New streak: {user_db.streak_days}")
-    except Exception as e:
-        await db.rollback()
-        logging.error(f"Error updating user {user_id} in DB: {e}")
-
-# ... (rest of the code remains the same)
-
-@api_router.post("/admin/users/{user_id}/reset-points-streak")
-async def admin_reset_user_points_streak(user_id: str, db: AsyncSession = Depends(get_db), current_admin: User = Depends(get_current_admin_user)):
-    user_result = await db.execute(select(UserDb).where(UserDb.id == user_id))
-    user_db = user_result.scalar_one_or_none()
-
-    if not user_db:
-        raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found.")
+async def apply_badge_events(db: AsyncSession, user_id: str, events: List[Dict]):
+    """
+    Feeds a user's new domain events to the badge rules: one counter upsert per matching
+    counting rule, nothing for threshold rules. Does not commit, like award_points.
+    """
+    reached = []
+    for event in events:
+        for rule, key in badge_engine.counter_updates(event):
+            new_count = (await db.execute(
+                sqlite_insert(BadgeCounterDb)
+                .values(user_id=user_id, rule_id=rule["id"], window_key=key, count=1)
+                .on_conflict_do_update(
+                    index_elements=[BadgeCounterDb.user_id, BadgeCounterDb.rule_id, BadgeCounterDb.window_key],
+                    set_={"count": BadgeCounterDb.count + 1}
+                )
+                .returning(BadgeCounterDb.count)
+            )).scalar_one()
+            if badge_engine.count_reached(rule, new_count):
+                reached.append(rule["name"])
+        reached.extend(rule["name"] for rule in badge_engine.threshold_badges(event))
+    if reached:
+        await grant_badges(db, user_id, reached)
+
+async def add_to_nutrition_ledger(db: AsyncSession, user_id: str, timestamp: datetime, entries: int = 0,
+                                  grams: float = 0.0, nutrition: Optional[Tuple[float, float]] = None):
+    """
+    Adds an entry (entries=1 and its grams) or its analysed calories and protein to
+    the user's ledger row of that day in one upsert. Does not commit, like award_points.
+    """
+    calories, protein = nutrition or (0.0, 0.0)
+    analyzed = 1 if nutrition else 0
+    await db.execute(
+        sqlite_insert(NutritionLedgerDb)
+        .values(user_id=user_id, day=ledger_day(timestamp), entries=entries, analyzed=analyzed,
+                grams=grams, calories=calories, protein=protein)
+        .on_conflict_do_update(
+            index_elements=[NutritionLedgerDb.user_id, NutritionLedgerDb.day],
+            set_={
+                "entries": NutritionLedgerDb.entries + entries,
+                "analyzed": NutritionLedgerDb.analyzed + analyzed,
+                "grams": NutritionLedgerDb.grams + grams,
+                "calories": NutritionLedgerDb.calories + calories,
+                "protein": NutritionLedgerDb.protein + protein,
+            }
+        )
+    )
 
-    user_db.points = 0
-    user_db.streak_days = 0
-    user_db.level = 1
-    user_db.last_entry_date = None
-    
+# Chat system
+@api_router.post("/chat/send")
+async def send_chat_message(
+    message: str = Form(...),
     current_user: User = Depends(get_current_user)
 ) -> ChatMessage:
     chat_message_data = {
@@ -361,9 +937,11 @@ async def admin_reset_user_points_streak(user_id: str, db: AsyncSession = Depend
         "timestamp": datetime.now(timezone.utc).isoformat() # Store as ISO string
     }
     
-    all_messages = load_chat_messages()
-    all_messages.append(chat_message_data)
-    save_chat_messages(all_messages)
+    async with shared_store_lock("chat_messages"):
+        all_messages = load_chat_messages()
+        all_messages.append(chat_message_data)
+        save_chat_messages(all_messages)
+    await mirror_to_sql("chat_messages", chat_message_data)
     
     # Validate data before returning, ensuring it matches Pydantic model (especially timestamp)
     # The Pydantic model ChatMessage expects a datetime object for timestamp if not changed.
@@ -382,8 +960,27 @@ async def admin_reset_user_points_streak(user_id: str, db: AsyncSession = Depend
         raise HTTPException(status_code=500, detail="Error processing chat message after saving.")
 
 @api_router.get("/chat/messages")
-async def get_chat_messages(current_user: User = Depends(get_current_user)) -> List[ChatMessage]:
-    all_messages_data = load_chat_messages()
+async def get_chat_messages(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)) -> List[ChatMessage]:
+    if DATA_READ_MODE != "json":
+        class_filter = None if current_user.role == USER_ROLES["ADMIN"] else current_user.class_code
+        stmt = queries.recent_chat_messages(class_filter, 100)
+        sql_messages_data = [
+            {
+                "id": msg.id,
+                "user_id": msg.user_id,
+                "username": msg.username,
+                "class_code": class_code,
+                "message": msg.message,
+                "is_admin": msg.is_admin,
+                "timestamp": msg.timestamp.isoformat()
+            }
+            for msg, class_code in (await db.execute(stmt)).all()
+        ]
+        if DATA_READ_MODE == "sql":
+            return [ChatMessage.model_validate(msg_data) for msg_data in sql_messages_data]
+
+    async with shared_store_lock("chat_messages", exclusive=False):
+        all_messages_data = load_chat_messages()
     
     filtered_messages = []
     if current_user.role == USER_ROLES["ADMIN"]:
@@ -399,6 +996,11 @@ async def get_chat_messages(current_user: User = Depends(get_current_user)) -> L
     
     # Limit to the most recent 100 messages
     limited_messages_data = filtered_messages[:100]
+
+    if DATA_READ_MODE == "dual":
+        log_read_differences("chat_messages", limited_messages_data, [
+            {"id": msg["id"], "user_id": msg["user_id"], "message": msg["message"]} for msg in sql_messages_data
+        ])
     
     # Validate and convert to Pydantic models
     response_messages = []
@@ -411,15 +1013,536 @@ async def get_chat_messages(current_user: User = Depends(get_current_user)) -> L
             
     return response_messages
 
+# Admission control for endpoints that use the shared HuggingFace quota (see rate_limiter.py)
+ai_admission = AdmissionController()
+
+def rate_limited(endpoint: str, cost: float = 1.0):
+    """Dependency that resolves the current user and takes `cost` tokens from their user and class buckets."""
+    ai_admission.check_cost(endpoint, cost)
+    async def admit_current_user(current_user: User = Depends(get_current_user)) -> User:
+        if current_user.role == USER_ROLES["ADMIN"]:
+            return current_user
+        try:
+            await ai_admission.admit(endpoint, current_user.id, current_user.class_code, cost)
+        except RateLimited as e:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many AI requests, please try again shortly.",
+                headers={"Retry-After": retry_after_header(e.retry_after)}
+            )
+        return current_user
+    return admit_current_user
+
+@api_router.get("/admin/archive")
+async def admin_get_archive(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    progress = await (await db.connection()).run_sync(archive_status)
+    return {"attached_school_years": [f"{year}-{year + 1}" for year in school_archive_years], "progress": progress}
+
+@api_router.get("/admin/lanes")
+async def admin_get_lanes(current_user: User = Depends(get_current_user)):
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return {**execution_lanes.stats(), "password_hashing": password_hasher.stats()}
+
+@api_router.get("/admin/rate-limits")
+async def admin_get_rate_limits(current_user: User = Depends(get_current_user)):
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    # Counters of the worker that answered; the limits are shared by all workers
+    return ai_admission.stats()
+
+# Streaming photo uploads for food entries
+# Near-duplicate photos reuse earlier analyses (see photo_dedupe.py)
+photo_analysis_index = PhotoAnalysisIndex()
+photo_analysis_index_lock = asyncio.Lock()
+REUSED_ANALYSIS_FIELDS = AnalysisRecord.FIELDS
+
+async def ensure_photo_analysis_index_loaded(db: AsyncSession):
+    if photo_analysis_index.loaded:
+        return
+    async with photo_analysis_index_lock:
+        if photo_analysis_index.loaded:
+            return
+        query = (
+            select(FoodEntryDb.image_phash, *[getattr(FoodEntryDb, field) for field in REUSED_ANALYSIS_FIELDS])
+            .where(FoodEntryDb.image_phash.is_not(None), FoodEntryDb.ai_score.is_not(None))
+        )
+
+        async def analyzed_photos(shard_db: AsyncSession, school: str = DEFAULT_SCHOOL):
+            return (await shard_db.execute(query)).all()
+
+        if shard_router.sharded:
+            # One index for all schools: the same snack photo gets the same analysis anywhere
+            rows = [row for shard_rows in (await shard_router.fan_out(analyzed_photos)).values() for row in shard_rows]
+        else:
+            rows = await analyzed_photos(db)
+        for row in rows:
+            # Slotted records with interned strings: this index holds one payload per analyzed photo
+            photo_analysis_index.add(int(row.image_phash, 16), AnalysisRecord.from_mapping(row))
+        photo_analysis_index.loaded = True
+        logging.info(f"Photo analysis index loaded with {photo_analysis_index.tree.size} hashes.")
+
+async def find_reusable_analysis(entry_db: FoodEntryDb, photo_hash: Optional[int], db: AsyncSession) -> Optional[Dict]:
+    """Exact resubmits match on sha256; similar photos of the same meal match on dHash distance."""
+    if entry_db.image_sha256:
+        exact = (await db.execute(
+            select(FoodEntryDb)
+            .where(FoodEntryDb.image_sha256 == entry_db.image_sha256, FoodEntryDb.ai_score.is_not(None), FoodEntryDb.id != entry_db.id)
+            .limit(1)
+        )).scalar_one_or_none()
+        if exact:
+            return {field: getattr(exact, field) for field in REUSED_ANALYSIS_FIELDS}
+    if photo_hash is not None:
+        await ensure_photo_analysis_index_loaded(db)
+        match = photo_analysis_index.lookup(photo_hash)
+        return match.as_dict() if match else None
+    return None
+
+async def analyze_uploaded_food_entry(entry_id: str):
+    """
+    Analysis queue handler: runs the AI analysis for an entry saved without one
+    and fills in the AI fields and points once it is done.
+    """
+    async with shard_router.session(await school_for_entry(entry_id)) as db:
+        entry_db = (await db.execute(select(FoodEntryDb).where(FoodEntryDb.id == entry_id))).scalar_one_or_none()
+        if not entry_db:
+            logging.error(f"Food entry {entry_id} disappeared before analysis.")
+            return
+        if entry_db.ai_score is not None:
+            return  # Already analyzed by an earlier attempt; don't award points twice
+
+        image_bytes = None
+        photo_hash = None
+        image_path = path_for_upload_url(entry_db.image_url)
+        if image_path and image_path.exists():
+            image_bytes = await execution_lanes.run_blocking(image_path.read_bytes)
+            try:
+                # Decoding and resizing the photo is CPU-bound, so it runs in the process pool
+                photo_hash = await execution_lanes.run_cpu(dhash_bytes, image_bytes)
+                entry_db.image_phash = hash_to_hex(photo_hash)
+            except Exception as e:
+                logging.error(f"Could not hash photo for entry {entry_id}: {e}")
+
+        reused_analysis = await find_reusable_analysis(entry_db, photo_hash, db)
+        if reused_analysis:
+            for field, value in reused_analysis.items():
+                setattr(entry_db, field, value)
+            logging.info(f"Reused analysis of a duplicate photo for entry {entry_id}.")
+        else:
+            image_data = base64.b64encode(image_bytes).decode("ascii") if image_bytes else None
+            ai_analysis_result = await analyze_food_coalesced(entry_db.food_name, image_data)
+
+            entry_db.ai_score = ai_analysis_result.get("score")
+            entry_db.ai_feedback = ai_analysis_result.get("feedback", "")
+            entry_db.ai_suggestions = ai_analysis_result.get("suggestions", [])
+            entry_db.nutrition_info = {
+                "category": ai_analysis_result.get("category", "unknown"),
+                "detected_food": ai_analysis_result.get("detected_food", entry_db.food_name),
+                "confidence": ai_analysis_result.get("confidence", 0),
+                "calories_per_100g": ai_analysis_result.get("calories_per_100g"),
+                "protein_per_100g": ai_analysis_result.get("protein_per_100g")
+            }
+            if photo_hash is not None and photo_analysis_index.loaded:
+                photo_analysis_index.add(photo_hash, AnalysisRecord.from_mapping(entry_db))
+
+        if entry_db.quantity_grams is None:
+            entry_db.quantity_grams = parse_quantity_grams(entry_db.quantity, entry_db.food_name)
+        nutrition = entry_nutrition(entry_db.quantity_grams, entry_db.nutrition_info)
+        if nutrition:
+            entry_db.calories_estimated = nutrition[0]  # For this entry's quantity, also when the analysis was reused
+            await add_to_nutrition_ledger(db, entry_db.user_id, entry_db.timestamp, nutrition=nutrition)
+
+        points_earned = int(entry_db.ai_score or 0)
+        entry_db.points_earned = points_earned
+        await apply_badge_events(db, entry_db.user_id, [{
+            "type": "food_entry", "user_id": entry_db.user_id, "timestamp": entry_db.timestamp,
+            "category": (entry_db.nutrition_info or {}).get("category")
+        }])
+        # AI fields, points, streak and gallery post commit together: a retry after a crash
+        # redoes all of them, and the ai_score check above stops a second award
+        new_totals = await award_points(db, entry_db.user_id, points_earned, "food_entry", source_id=entry_db.id, counts_for_streak=True)
+        if new_totals is None:
+            logging.error(f"User with ID {entry_db.user_id} not found in DB for points/streak update.")
+        gallery_item = None
+        if entry_db.ai_score is not None and entry_db.ai_score >= GALLERY_SCORE_THRESHOLD:
+            gallery_item = await add_entry_to_gallery(entry_db, db)
+        await db.commit()
+
+        class_activity_cache.on_analysis(entry_db.user_id, entry_db.timestamp, entry_db.ai_score, entry_db.calories_estimated)
+        class_code = (await db.execute(select(UserDb.class_code).where(UserDb.id == entry_db.user_id))).scalar_one_or_none()
+        await invalidation_bus.publish(f"activity:{class_code}")
+        if gallery_item is not None:
+            await announce_gallery_post(gallery_item, class_code)
+
+# Durable AI analysis queue (see analysis_queue.py)
+analysis_job_queue = AnalysisJobQueue()
+analysis_notifier = AnalysisNotifier()
+analysis_worker_pool = AnalysisWorkerPool(analysis_job_queue, analyze_uploaded_food_entry, analysis_notifier)
+
+async def enqueue_food_entry_analysis(entry_id: str):
+    await asyncio.to_thread(analysis_job_queue.enqueue, entry_id)
+    analysis_worker_pool.wake()
+
+ORPHANED_ANALYSIS_GRACE_SECONDS = 300
+
+async def enqueue_orphaned_analyses():
+    """
+    Start-up sweep for uploads that were saved but never got a job (a crash between the
+    commit and the enqueue). Young entries are left alone: their upload may still be enqueuing.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=ORPHANED_ANALYSIS_GRACE_SECONDS)
+
+    async def unanalyzed(db: AsyncSession, school: str) -> List[str]:
+        return (await db.execute(
+            select(FoodEntryDb.id)
+            .where(FoodEntryDb.ai_score.is_(None), FoodEntryDb.image_url.is_not(None), FoodEntryDb.timestamp < cutoff)
+        )).scalars().all()
+
+    entry_ids = [entry_id for ids in (await shard_router.fan_out(unanalyzed)).values() for entry_id in ids]
+    added = await asyncio.to_thread(analysis_job_queue.enqueue_missing, entry_ids) if entry_ids else 0
+    if added:
+        logging.warning(f"Enqueued analysis for {added} uploaded entries that had no job.")
+        analysis_worker_pool.wake()
+
+@api_router.post("/food-entries/upload", status_code=202)
+async def upload_food_entry_photo(
+    food_name: str = Form(...),
+    meal_type: str = Form(...),
+    quantity: str = Form(...),
+    image: UploadFile = File(...),
+    current_user: User = Depends(rate_limited("food-entries/upload")),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Multipart alternative to sending base64 images in JSON. The photo is spooled to disk
+    in chunks and the entry is returned right away; AI fields are filled in afterwards.
+    """
+    try:
+        stored_photo = await spool_upload(image)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UnsupportedImage as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    finally:
+        await image.close()
+
+    entry_db = FoodEntryDb(
+        user_id=current_user.id,
+        food_name=food_name,
+        meal_type=meal_type,
+        quantity=quantity,
+        quantity_grams=parse_quantity_grams(quantity, food_name),
+        image_url=stored_photo["url"],
+        image_sha256=stored_photo["sha256"],
+        ai_score=None,  # Filled in by analyze_uploaded_food_entry
+        points_earned=0,
+        timestamp=datetime.utcnow()
+    )
+    db.add(entry_db)
+    await add_to_nutrition_ledger(db, entry_db.user_id, entry_db.timestamp, entries=1, grams=entry_db.quantity_grams)
+    await db.commit()
+    class_activity_cache.on_new_entry(entry_db.user_id, entry_db.timestamp)
+    await invalidation_bus.publish(f"activity:{current_user.class_code}")
+
+    # Enqueued before answering, so a 202 always means a durable job exists; the start-up
+    # sweep (enqueue_orphaned_analyses) covers a crash between the commit and this line
+    await enqueue_food_entry_analysis(entry_db.id)
+
+    return {
+        "id": entry_db.id,
+        "image_url": entry_db.image_url,
+        "image_sha256": entry_db.image_sha256,
+        "size_bytes": stored_photo["size_bytes"],
+        "analysis_status": "pending"
+    }
+
+async def get_analysis_status(entry_id: str, current_user: User, db: AsyncSession) -> Dict:
+    entry_db = (await db.execute(select(FoodEntryDb).where(FoodEntryDb.id == entry_id))).scalar_one_or_none()
+    if not entry_db:
+        raise HTTPException(status_code=404, detail="Food entry not found")
+    if entry_db.user_id != current_user.id and current_user.role not in [USER_ROLES["ADMIN"], USER_ROLES["TEACHER"]]:
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    job = await asyncio.to_thread(analysis_job_queue.status_for_entry, entry_id)
+    if entry_db.ai_score is not None:
+        analysis_status = JOB_DONE
+    else:
+        analysis_status = job["status"] if job else "not_queued"
+    return {
+        "id": entry_db.id,
+        "analysis_status": analysis_status,
+        "attempts": job["attempts"] if job else 0,
+        "ai_score": entry_db.ai_score,
+        "ai_feedback": entry_db.ai_feedback,
+        "ai_suggestions": entry_db.ai_suggestions,
+        "calories_estimated": entry_db.calories_estimated,
+        "points_earned": entry_db.points_earned
+    }
+
+@api_router.get("/food-entries/{entry_id}/analysis")
+async def get_food_entry_analysis(entry_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    return await get_analysis_status(entry_id, current_user, db)
+
+@api_router.get("/food-entries/{entry_id}/analysis/stream")
+async def stream_food_entry_analysis(entry_id: str, current_user: User = Depends(get_current_user)):
+    """Server-sent events: pushes the analysis status until it is done or dead-lettered."""
+    school = await school_for_user(current_user.id)
+    async with shard_router.session(school) as db:
+        first_status = await get_analysis_status(entry_id, current_user, db)  # Raises 403/404 before streaming
+
+    async def event_stream():
+        status_data = first_status
+        deadline = monotonic_ms() + 120_000
+        while True:
+            yield f"data: {json.dumps(status_data, default=str)}\n\n"
+            if status_data["analysis_status"] in (JOB_DONE, JOB_DEAD) or monotonic_ms() > deadline:
+                return
+            # Wakes up immediately if this process ran the job, otherwise re-checks periodically
+            await analysis_notifier.wait(entry_id, timeout=2.0)
+            async with shard_router.session(school) as db:
+                status_data = await get_analysis_status(entry_id, current_user, db)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@api_router.get("/admin/analysis-jobs")
+async def admin_get_analysis_jobs(current_user: User = Depends(get_current_user)):
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return {
+        "counts": await asyncio.to_thread(analysis_job_queue.counts),
+        "dead_jobs": await asyncio.to_thread(analysis_job_queue.dead_jobs),
+        "photo_dedupe": photo_analysis_index.stats(),
+        "inference_calls": food_analysis_calls.stats()
+    }
+
+@api_router.post("/admin/analysis-jobs/{job_id}/requeue")
+async def admin_requeue_analysis_job(job_id: int, current_user: User = Depends(get_current_user)):
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if not await asyncio.to_thread(analysis_job_queue.requeue, job_id):
+        raise HTTPException(status_code=404, detail="Dead job not found")
+    analysis_worker_pool.wake()
+    return {"message": "Job requeued", "job_id": job_id}
+
+# Gallery feed (see gallery_feed.py)
+GALLERY_SCORE_THRESHOLD = 6
+gallery_feed = GalleryFeed()
+
+def on_gallery_invalidated(topic: str):
+    # "gallery:<class_code>" -> new post or flushed likes in that class, bare "gallery" -> all classes
+    _, _, class_code = topic.partition(":")
+    gallery_feed.invalidate_class(class_code or None)
+
+invalidation_bus.subscribe("gallery", on_gallery_invalidated)
+
+def gallery_summary(item_id: str, user_id: str, username: str, food_name: str, ai_score: float, likes: int, timestamp: datetime) -> Dict:
+    """Feed entry without image data; clients fetch the image from image_url."""
+    return {
+        "id": item_id,
+        "user_id": user_id,
+        "username": username,
+        "food_name": food_name,
+        "ai_score": ai_score,
+        "likes": likes or 0,
+        "timestamp": timestamp.isoformat(),
+        "image_url": f"/api/gallery/{item_id}/image"
+    }
+
+async def add_entry_to_gallery(entry_db: FoodEntryDb, db: AsyncSession) -> Optional[GalleryDb]:
+    """Stages the gallery post of a well-scored entry. Does not commit; announce it afterwards."""
+    user_db = (await db.execute(select(UserDb).where(UserDb.id == entry_db.user_id))).scalar_one_or_none()
+    if not user_db:
+        return None
+    gallery_item = GalleryDb(
+        user_id=user_db.id,
+        username=user_db.username,
+        food_name=entry_db.food_name,
+        image_data="",
+        image_url=entry_db.image_url,
+        ai_score=entry_db.ai_score,
+        likes=0
+    )
+    db.add(gallery_item)
+    await db.flush()  # Fills in the id and timestamp defaults
+    return gallery_item
+
+async def announce_gallery_post(gallery_item: GalleryDb, class_code: str):
+    gallery_feed.on_new_post(class_code, gallery_summary(
+        gallery_item.id, gallery_item.user_id, gallery_item.username, gallery_item.food_name,
+        gallery_item.ai_score, gallery_item.likes, gallery_item.timestamp
+    ))
+    await invalidation_bus.publish(f"gallery:{class_code}")
+
+async def load_gallery_feed_index(class_code: str, db: AsyncSession):
+    """Builds the newest/top-this-week lists for a class with two column-only queries."""
+    newest_rows = (await db.execute(queries.gallery_newest(class_code, NEWEST_INDEX_SIZE))).all()
+    week_rows = (await db.execute(
+        queries.gallery_top(class_code, datetime.utcnow() - timedelta(days=TOP_WINDOW_DAYS), 500)
+    )).all()
+
+    gallery_feed.set_index(
+        class_code,
+        [gallery_summary(*row) for row in newest_rows],
+        [gallery_summary(*row) for row in week_rows]
+    )
+
+async def flush_gallery_likes():
+    """Writes the pending like deltas in one executemany UPDATE."""
+    deltas = gallery_feed.likes.drain()
+    if not deltas:
+        return
+    gallery_table = GalleryDb.__table__
+    stmt = (
+        gallery_table.update()
+        .where(gallery_table.c.id == bindparam("b_item_id"))
+        .values(likes=gallery_table.c.likes + bindparam("b_delta"))
+    )
+
+    async def flush_on(db: AsyncSession, school: str) -> Tuple[Dict[str, int], Set[str]]:
+        # The owners' classes are what the other workers have to reload
+        rows = (await db.execute(
+            select(GalleryDb.id, UserDb.class_code)
+            .outerjoin(UserDb, UserDb.id == GalleryDb.user_id)
+            .where(GalleryDb.id.in_(list(deltas)))
+        )).all()
+        shard_deltas = {item_id: deltas[item_id] for item_id, _ in rows}
+        if shard_deltas:
+            await db.execute(stmt, [{"b_item_id": item_id, "b_delta": delta} for item_id, delta in shard_deltas.items()])
+            await db.commit()
+        return shard_deltas, {class_code for _, class_code in rows if class_code}
+
+    # Each school's items are updated on its own database; a failed shard keeps its deltas for the next flush
+    flushed, changed_classes = {}, set()
+    results = await shard_router.fan_out(flush_on)
+    for shard_deltas, shard_classes in results.values():
+        flushed.update(shard_deltas)
+        changed_classes |= shard_classes
+    unflushed = {item_id: delta for item_id, delta in deltas.items() if item_id not in flushed}
+    if unflushed and len(results) < len(shard_router.schools):  # Otherwise the items were deleted
+        gallery_feed.likes.restore(unflushed)
+        logging.error(f"Could not flush {len(unflushed)} gallery like counters; retrying on the next flush.")
+    if not flushed:
+        return
+    gallery_feed.apply_flushed_likes(flushed)
+    # Only the classes whose items were liked; the other classes' indexes stay warm on every worker
+    for class_code in sorted(changed_classes):
+        await invalidation_bus.publish(f"gallery:{class_code}")
+
+async def run_gallery_like_flusher():
+    while True:
+        await asyncio.sleep(LIKE_FLUSH_SECONDS)
+        await flush_gallery_likes()
+
+@api_router.get("/gallery/feed")
+async def get_gallery_feed(
+    kind: str = "newest",
+    page: int = 0,
+    class_code: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    if kind not in FEED_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(FEED_KINDS)}")
+    if page < 0:
+        raise HTTPException(status_code=400, detail="page must be >= 0")
+
+    # Students see their own class; teachers and admins may pick one
+    feed_class_code = current_user.class_code
+    if class_code and current_user.role in [USER_ROLES["ADMIN"], USER_ROLES["TEACHER"]]:
+        feed_class_code = class_code.upper()
+
+    body = gallery_feed.get_page(feed_class_code, kind, page)
+    if body is None:
+        await load_gallery_feed_index(feed_class_code, db)
+        body = gallery_feed.get_page(feed_class_code, kind, page)
+    return Response(content=body, media_type="application/json")
+
+@api_router.post("/gallery/{item_id}/like")
+async def like_gallery_item(item_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    item_likes = (await db.execute(select(GalleryDb.likes).where(GalleryDb.id == item_id))).scalar_one_or_none()
+    if item_likes is None:
+        raise HTTPException(status_code=404, detail="Gallery item not found")
+
+    # One like per user and item; only the counter update is batched
+    liked = (await db.execute(
+        sqlite_insert(GalleryLikeDb).values(item_id=item_id, user_id=current_user.id).on_conflict_do_nothing()
+    )).rowcount
+    await db.commit()
+    if liked:
+        gallery_feed.likes.add(item_id)  # Written to the DB by the periodic flusher
+    message = "Like registered successfully" if liked else "You already liked this item"
+    return {"message": message, "item_id": item_id, "likes": item_likes + gallery_feed.likes.pending(item_id)}
+
+@api_router.get("/gallery/{item_id}/image")
+async def get_gallery_image(item_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    row = (await db.execute(
+        select(GalleryDb.image_data, GalleryDb.image_url, GalleryDb.user_id, UserDb.class_code)
+        .outerjoin(UserDb, UserDb.id == GalleryDb.user_id)
+        .where(GalleryDb.id == item_id)
+    )).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Gallery item not found")
+    ensure_can_view_photo([(row.user_id, row.class_code)], current_user)
+    if row.image_url:
+        return upload_file_response(path_for_upload_url(row.image_url))
+
+    image_data = row.image_data or ""
+    media_type = "image/jpeg"
+    if image_data.startswith("data:"):
+        header, _, image_data = image_data.partition(",")
+        media_type = header[5:].split(";")[0] or media_type
+    try:
+        image_bytes = base64.b64decode(image_data)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Stored image is not valid base64")
+    # Gallery images never change, but they are only for the owner's class, so no shared caches
+    return Response(content=image_bytes, media_type=media_type, headers={"Cache-Control": PHOTO_CACHE_CONTROL})
+
+@api_router.get("/uploads/{file_name}")
+async def get_uploaded_photo(file_name: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    image_urls = urls_for_upload_name(file_name)
+    if not image_urls:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    # Content-addressed files can be shared by several entries; any one the user may see is enough
+    owners = []
+    for model in (FoodEntryDb, GalleryDb):
+        owners.extend((await db.execute(
+            select(model.user_id, UserDb.class_code)
+            .outerjoin(UserDb, UserDb.id == model.user_id)
+            .where(model.image_url.in_(image_urls))
+        )).all())
+    if not owners and current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    ensure_can_view_photo(owners, current_user)
+    return upload_file_response(path_for_upload_url(image_urls[0]))
+
+PHOTO_CACHE_CONTROL = "private, max-age=86400, immutable"
+
+def ensure_can_view_photo(owners: List[Tuple[str, Optional[str]]], current_user: User):
+    """Photos are visible to their owner, the owner's class (students and teacher) and admins."""
+    if current_user.role == USER_ROLES["ADMIN"]:
+        return
+    for user_id, class_code in owners:
+        if user_id == current_user.id or (class_code and class_code == current_user.class_code):
+            return
+    raise HTTPException(status_code=403, detail="Access denied")
+
+def upload_file_response(image_path: Optional[Path]) -> FileResponse:
+    if image_path is None or not image_path.is_file():
+        raise HTTPException(status_code=404, detail="Photo not found")
+    return FileResponse(image_path, headers={"Cache-Control": PHOTO_CACHE_CONTROL})
+
 # Calorie Checker & Food Comparison Endpoints
 @api_router.post("/calorie-check", response_model=Dict) # Assuming the analysis result is a Dict
-async def check_calories(request: CalorieCheckRequest, current_user: User = Depends(get_current_user)):
+async def check_calories(request: CalorieCheckRequest, current_user: User = Depends(rate_limited("calorie-check"))):
     food_item_name = request.food_item
     
     try:
         # Call the existing HuggingFace analysis function
         # This function might need to be adapted if its output isn't directly what's needed
-        analysis_result = await analyze_food_with_huggingface(food_item_name)
+        analysis_result = await analyze_food_coalesced(food_item_name)
     except Exception as e:
         # Log the exception e
         print(f"Error during HuggingFace analysis for {food_item_name}: {e}")
@@ -433,9 +1556,11 @@ async def check_calories(request: CalorieCheckRequest, current_user: User = Depe
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
     
-    all_checks = load_calorie_checks()
-    all_checks.append(calorie_check_data)
-    save_calorie_checks(all_checks)
+    async with shared_store_lock("calorie_checks"):
+        all_checks = load_calorie_checks()
+        all_checks.append(calorie_check_data)
+        save_calorie_checks(all_checks)
+    await mirror_to_sql("calorie_checks", calorie_check_data)
     
     return analysis_result # Return the analysis part to the user
 
@@ -445,18 +1570,18 @@ class FoodCompareRequest(BaseModel):
     food_item2: str
 
 @api_router.post("/food-compare", response_model=Dict) # Assuming the response is a Dict containing both analyses
-async def compare_foods(request: FoodCompareRequest, current_user: User = Depends(get_current_user)):
+async def compare_foods(request: FoodCompareRequest, current_user: User = Depends(rate_limited("food-compare", cost=2))):  # Two analyses
     food1_name = request.food_item1
     food2_name = request.food_item2
     
     try:
-        analysis1_result = await analyze_food_with_huggingface(food1_name)
+        analysis1_result = await analyze_food_coalesced(food1_name)
     except Exception as e:
         print(f"Error during HuggingFace analysis for {food1_name}: {e}")
         raise HTTPException(status_code=500, detail=f"Error analyzing {food1_name}: {e}")
 
     try:
-        analysis2_result = await analyze_food_with_huggingface(food2_name)
+        analysis2_result = await analyze_food_coalesced(food2_name)
     except Exception as e:
         print(f"Error during HuggingFace analysis for {food2_name}: {e}")
         raise HTTPException(status_code=500, detail=f"Error analyzing {food2_name}: {e}")
@@ -474,9 +1599,11 @@ async def compare_foods(request: FoodCompareRequest, current_user: User = Depend
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
     
-    all_comparisons = load_food_comparisons()
-    all_comparisons.append(comparison_data_to_store)
-    save_food_comparisons(all_comparisons)
+    async with shared_store_lock("food_comparisons"):
+        all_comparisons = load_food_comparisons()
+        all_comparisons.append(comparison_data_to_store)
+        save_food_comparisons(all_comparisons)
+    await mirror_to_sql("food_comparisons", comparison_data_to_store)
     
     return {
         "food_1_name": food1_name,
@@ -489,113 +1616,74 @@ async def compare_foods(request: FoodCompareRequest, current_user: User = Depend
 # Daily questions endpoints
 @api_router.post("/daily-questions")
 async def create_daily_question(question_input: DailyQuestion, current_user: User = Depends(get_current_user)) -> DailyQuestion:
-    if current_user.role != USER_ROLES["ADMIN"]:
-        raise HTTPException(status_code=403, detail="Only admins can create daily questions.")
-
-    all_questions = load_daily_questions()
-
-    # Check for date uniqueness
-    for q_data in all_questions:
-        # Compare date part of stored ISO string with input date object
-        if date.fromisoformat(q_data['date']) == question_input.date:
-            raise HTTPException(status_code=400, detail=f"A question for the date {question_input.date.isoformat()} already exists.")
-
-    # Deactivate other active questions if this one is active
-    if question_input.is_active:
-        for q_data in all_questions:
-            q_data['is_active'] = False
-
-    # Prepare data for JSON storage, using Pydantic model defaults where appropriate
-    # and converting date/datetime to ISO strings.
-    new_question_data = {
-        "id": question_input.id, # Use ID from Pydantic model (default_factory)
-        "question_text": question_input.question_text,
-        "date": question_input.date.isoformat(),
-        "is_active": question_input.is_active,
-        "created_by_user_id": current_user.id, # Explicitly set creator
-        "created_at": question_input.created_at.isoformat() # Use datetime from Pydantic model (default_factory)
-    }
-
-    all_questions.append(new_question_data)
-    save_daily_questions(all_questions)
-
-    # Return the validated Pydantic model. Pydantic will parse ISO strings back to date/datetime.
-    # The input `question_input` can be returned after setting `created_by_user_id` if preferred,
-    # but constructing from `new_question_data` ensures what's returned matches what's stored.
-    return DailyQuestion.model_validate(new_question_data)
+    # Same as /admin/create-question; the id is always a new one
+    return await admin_create_question(DailyQuestionCreate(**question_input.model_dump(exclude={"id"})), current_user)
 
 @api_router.get("/daily-questions/today")
 async def get_todays_questions() -> List[DailyQuestion]: # Removed db_session
-    today_date_obj = date.today() # Get today as a date object
-    all_questions_data = load_daily_questions()
-    
+    today_str = datetime.utcnow().date().isoformat()  # Question dates are UTC days, like streaks
+    async with shared_store_lock("daily_questions", exclusive=False):
+        all_questions_data = load_daily_questions()
+
+    # The store also holds the undated question bank (option objects, numeric ids); normalized, those have no date
     todays_active_questions_data = []
     for q_data in all_questions_data:
-        question_date_obj = date.fromisoformat(q_data.get("date", "")) # Parse stored ISO string to date object
-        if question_date_obj == today_date_obj and q_data.get("is_active", False):
-            todays_active_questions_data.append(q_data)
-            
+        question = normalize_daily_question(q_data)
+        if question["date"] == today_str and question["active"]:
+            todays_active_questions_data.append(question)
+
     # Limit to 10, consistent with original logic, though ideally only one is active per day
-    limited_questions_data = todays_active_questions_data[:10]
-    
-    response_questions = []
-    for q_data in limited_questions_data:
-        try:
-            response_questions.append(DailyQuestion.model_validate(q_data))
-        except Exception as e:
-            print(f"Error validating daily question data for GET /daily-questions/today: {e} - Data: {q_data}")
-            # Optionally skip this item
-            
+    return [DailyQuestion.model_validate(q_data) for q_data in todays_active_questions_data[:10]]
+
 @api_router.post("/question-responses")
 async def submit_question_response(
     response_data: QuestionResponseCreate,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ) -> QuestionResponse:
-    all_responses = load_question_responses()
-
-    # Check if user already answered this question
-    for resp in all_responses:
-        if resp.get("user_id") == current_user.id and resp.get("question_id") == response_data.question_id:
-            raise HTTPException(status_code=400, detail="You have already answered this question.")
-
-    # Check if the question exists
-    all_questions = load_daily_questions()
-    target_question = next((q for q in all_questions if q.get("id") == response_data.question_id), None)
-    if not target_question:
-        raise HTTPException(status_code=404, detail="Question not found.")
-
-    # Points logic: Fixed points for now, as DailyQuestion Pydantic model lacks points_reward
-    points_earned = 5 
-
-    # Update user points and streak in users.json
-    users = load_users()
-    user_found_for_update = False
-    for user_dict in users:
-        if user_dict.get("id") == current_user.id:
-            user_dict["points"] = user_dict.get("points", 0) + points_earned
-            # Simple streak increment; more complex logic (e.g., daily check) would require more state
-            user_dict["streak"] = user_dict.get("streak", 0) + 1 
-            user_found_for_update = True
-            break
-    if user_found_for_update:
-        save_users(users)
-    else:
-        # This should ideally not happen if current_user is valid
-        print(f"Warning: User with ID {current_user.id} not found in users.json for point update.")
+    async with shared_store_lock("question_responses"):
+        all_responses = load_question_responses()
+
+        # Check if user already answered this question
+        for resp in all_responses:
+            if resp.get("user_id") == current_user.id and resp.get("question_id") == response_data.question_id:
+                raise HTTPException(status_code=400, detail="You have already answered this question.")
+
+        # Check if the question exists
+        all_questions = load_daily_questions()
+        target_question = next((q for q in all_questions if str(q.get("id")) == response_data.question_id), None)
+        if not target_question:
+            raise HTTPException(status_code=404, detail="Question not found.")
+
+        # Points logic: Fixed points for now, as DailyQuestion Pydantic model lacks points_reward
+        points_earned = 5 
+
+        response_id = str(uuid.uuid4())
+
+        # Atomic points update plus ledger row, in one transaction. Answers don't count
+        # for the streak, which tracks days with a food entry (last_entry_date).
+        new_totals = await award_points(db, current_user.id, points_earned, "daily_question", source_id=response_id)
+        if new_totals is None:
+            # This should ideally not happen if current_user is valid
+            print(f"Warning: User with ID {current_user.id} not found in DB for point update.")
+        else:
+            await apply_badge_events(db, current_user.id, [{"type": "question_response", "user_id": current_user.id, "timestamp": datetime.utcnow()}])
+        await db.commit()
 
-    new_response_data = {
-        "id": str(uuid.uuid4()),
-        "question_id": response_data.question_id,
-        "user_id": current_user.id,
-        "username": current_user.username,
-        "response_text": response_data.response_text,
-        "class_code": current_user.class_code,
-        "points_earned": points_earned,
-        "timestamp": datetime.now(timezone.utc).isoformat()
-    }
+        new_response_data = {
+            "id": response_id,
+            "question_id": response_data.question_id,
+            "user_id": current_user.id,
+            "username": current_user.username,
+            "response_text": response_data.response_text,
+            "class_code": current_user.class_code,
+            "points_earned": points_earned,
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }
 
-    all_responses.append(new_response_data)
-    save_question_responses(all_responses)
+        all_responses.append(new_response_data)
+        save_question_responses(all_responses)
+    await mirror_to_sql("question_responses", new_response_data)
 
     try:
         validated_response = QuestionResponse.model_validate(new_response_data)
@@ -605,14 +1693,34 @@ async def submit_question_response(
         raise HTTPException(status_code=500, detail="Error processing response after saving.")
 
 @api_router.get("/daily-questions/responses/{question_id}")
-async def get_responses_for_question(question_id: str, current_user: User = Depends(get_current_user)) -> List[QuestionResponse]:
+async def get_responses_for_question(question_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)) -> List[QuestionResponse]:
     # Authorization: Only admin or teacher can see all responses for a question
     if current_user.role not in [USER_ROLES["ADMIN"], USER_ROLES["TEACHER"]]:
         # Optionally, allow users to see responses if they've answered, or if the question is 'closed'
         # For now, restricting to admin/teacher for simplicity
         raise HTTPException(status_code=403, detail="Access denied. Admin or teacher role required.")
 
-    all_responses_data = load_question_responses()
+    if DATA_READ_MODE != "json":
+        stmt = queries.question_responses(question_id)
+        sql_responses_data = [
+            {
+                "id": resp.id,
+                "question_id": resp.question_id,
+                "user_id": resp.user_id,
+                "username": username or "",
+                "response_text": resp.answer,
+                "answer": resp.answer,
+                "class_code": class_code or "",
+                "points_earned": resp.points_earned,
+                "timestamp": resp.timestamp.isoformat()
+            }
+            for resp, username, class_code in (await db.execute(stmt)).all()
+        ]
+        if DATA_READ_MODE == "sql":
+            return [QuestionResponse.model_validate(resp_data) for resp_data in sql_responses_data]
+
+    async with shared_store_lock("question_responses", exclusive=False):
+        all_responses_data = load_question_responses()
     
     question_specific_responses = []
     for resp_data in all_responses_data:
@@ -622,6 +1730,9 @@ async def get_responses_for_question(question_id: str, current_user: User = Depe
     # Sort responses by timestamp (ascending - oldest first)
     # Assumes timestamp is an ISO string that can be sorted lexicographically
     question_specific_responses.sort(key=lambda x: x.get("timestamp", ""))
+
+    if DATA_READ_MODE == "dual":
+        log_read_differences("question_responses", question_specific_responses, sql_responses_data)
     
     # Validate and convert to Pydantic models
     validated_responses = []
@@ -636,32 +1747,38 @@ async def get_responses_for_question(question_id: str, current_user: User = Depe
 
 # Analytics endpoints
 @api_router.get("/analytics/class-summary", response_model=List[ClassSummaryStat])
-async def get_class_summary(current_user: User = Depends(get_current_user), db_session: AsyncSession = Depends(get_db)):
+async def get_class_summary(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user),
+    db_session: AsyncSession = Depends(get_db)
+):
     if current_user.role not in [USER_ROLES["ADMIN"], USER_ROLES["TEACHER"]]:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    # Get summary statistics by class
-    stmt = (
-        select(
-            UserDb.class_code,
-            func.count(FoodEntryDb.id).label("total_entries"),
-            func.avg(FoodEntryDb.ai_score).label("avg_score"),
-            func.sum(FoodEntryDb.points_earned).label("total_points_from_entries"),
-            func.avg(FoodEntryDb.calories_estimated).label("avg_calories"),
-            func.count(distinct(FoodEntryDb.user_id)).label("active_users")
-        )
-        .join(UserDb, FoodEntryDb.user_id == UserDb.id)
-        .group_by(UserDb.class_code)
-        .order_by(UserDb.class_code)
-    )
+    # Get summary statistics by class; a range within the current school year only reads the hot table
+    async def summarize(db: AsyncSession, school: str):
+        entries = archived_source(FoodEntryDb, start, end, school)
+        return (await db.execute(queries.class_summary(entries, start, end))).all()
+
+    if current_user.role == USER_ROLES["ADMIN"] and shard_router.sharded:
+        # Admins see every school: each database summarizes its own classes, in parallel
+        results_db = [row for rows in (await shard_router.fan_out(summarize)).values() for row in rows]
+    else:
+        results_db = await summarize(db_session, db_session.info.get("school", DEFAULT_SCHOOL)) # list of Row objects
 
-    result = await db_session.execute(stmt)
-    results_db = result.all() # list of Row objects
+    # Merging and validating every class's row is plain CPU work, kept off the event loop
+    try:
+        return await execution_lanes.run_blocking(build_class_summaries, results_db)
+    except LaneFull:
+        raise HTTPException(status_code=503, detail="The server is busy, please retry shortly.", headers={"Retry-After": "5"})
 
+def build_class_summaries(results_db) -> List[ClassSummaryStat]:
+    """Blocking: class-summary rows (from one or more schools) -> response models, by class code."""
     # Pydantic model conversion can be done here if needed, or directly by FastAPI if types match
     # For complex cases or when names don't match, manual mapping is safer:
     summaries = []
-    for row in results_db:
+    for row in sorted(results_db, key=lambda row: row.class_code or ""):
         summaries.append(ClassSummaryStat(
             class_code=row.class_code,
             total_entries=row.total_entries or 0,
@@ -672,11 +1789,118 @@ async def get_class_summary(current_user: User = Depends(get_current_user), db_s
         ))
     return summaries
 
+# Students x days activity matrices for the teacher dashboard (see class_activity.py)
+class_activity_cache = ActivityCache()
+
+def on_activity_invalidated(topic: str):
+    # "activity:<class_code>" -> another worker saw a new entry or analysis in that class
+    _, _, class_code = topic.partition(":")
+    class_activity_cache.invalidate_class(class_code or None)
+
+invalidation_bus.subscribe("activity", on_activity_invalidated)
+
+async def load_class_activity(class_code: str, start: date, end: date) -> ActivityMatrix:
+    """One columnar query for the class's entries in the window; the matrix itself is built with numpy."""
+    school = shard_router.school_for_class_code(class_code)
+    window_start = datetime.combine(start, datetime.min.time())
+    window_end = datetime.combine(end + timedelta(days=1), datetime.min.time())
+    entries = archived_source(FoodEntryDb, window_start, window_end, school)
+    async with shard_router.session(school) as db:
+        students = (await db.execute(queries.class_students(class_code, UserDb.id, UserDb.username))).all()
+        result = await db.execute(queries.class_entries(entries, class_code, window_start, window_end))
+        columns = EntryColumns(result.mappings())
+    return ActivityMatrix.build(class_code, start, end, [(row.id, row.username) for row in students], columns)
+
+def staff_class_code(current_user: User, class_code: Optional[str]) -> str:
+    """The class an admin or teacher (own class only, the default) asks about, upper-cased as stored."""
+    if current_user.role == USER_ROLES["TEACHER"]:
+        class_code = (class_code or current_user.class_code).upper()
+        if class_code != current_user.class_code:
+            raise HTTPException(status_code=403, detail="Teachers can only view their own class")
+    elif current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    if not class_code:
+        raise HTTPException(status_code=400, detail="class_code is required")
+    return class_code.upper()
+
+@api_router.get("/analytics/class-activity")
+async def get_class_activity(
+    class_code: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Entries, average score and average calories per student per day (UTC) for one class."""
+    class_code = staff_class_code(current_user, class_code)
+    end = end or datetime.utcnow().date()
+    start = start or end - timedelta(days=ACTIVITY_DEFAULT_DAYS - 1)
+    if start > end or (end - start).days + 1 > ACTIVITY_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"The window must run forward and span at most {ACTIVITY_MAX_DAYS} days")
+
+    matrix = class_activity_cache.get(class_code, start, end)
+    if matrix is None:
+        matrix = await load_class_activity(class_code, start, end)
+        class_activity_cache.put(matrix)
+    return matrix.to_response()
+
+# Nutrition progress against the daily goals (see nutrition_ledger.py): reads of one to seven ledger rows
+async def nutrition_goals(db: AsyncSession, user_id: str) -> Dict[str, float]:
+    overrides = (await db.execute(
+        select(UserDb.daily_calorie_goal_override, UserDb.daily_protein_goal_override).where(UserDb.id == user_id)
+    )).first()
+    return goals_for(*(overrides or (None, None)))
+
+async def nutrition_ledger_rows(db: AsyncSession, user_id: str, first_day: date, last_day: date) -> Dict[str, Dict]:
+    result = await db.execute(
+        select(*LEDGER_COLUMNS)
+        .where(NutritionLedgerDb.user_id == user_id, NutritionLedgerDb.day.between(first_day.isoformat(), last_day.isoformat()))
+    )
+    return {row["day"]: dict(row) for row in result.mappings()}
+
+@api_router.get("/nutrition/today")
+async def get_nutrition_today(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Today's (UTC) calories and protein against the user's goals."""
+    today = datetime.utcnow().date()
+    goals = await nutrition_goals(db, current_user.id)
+    rows = await nutrition_ledger_rows(db, current_user.id, today, today)
+    return {"goals": goals, **day_progress(today.isoformat(), rows.get(today.isoformat()), goals)}
+
+@api_router.get("/nutrition/week")
+async def get_nutrition_week(day: Optional[date] = None, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Progress per day of the ISO week that contains `day` (default: this week)."""
+    days = week_days(day or datetime.utcnow().date())
+    goals = await nutrition_goals(db, current_user.id)
+    return week_progress(days, await nutrition_ledger_rows(db, current_user.id, days[0], days[-1]), goals)
+
+@api_router.get("/analytics/class-nutrition")
+async def get_class_nutrition(
+    class_code: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """How many students of a class met their calorie and protein goals, per day and per student."""
+    class_code = staff_class_code(current_user, class_code)
+    this_week = week_days(datetime.utcnow().date())
+    start = start or this_week[0]
+    end = end or this_week[-1]
+    if start > end or (end - start).days + 1 > LEDGER_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"The window must run forward and span at most {LEDGER_MAX_DAYS} days")
+
+    async with shard_router.session(shard_router.school_for_class_code(class_code)) as db:
+        students = (await db.execute(queries.class_students(
+            class_code, UserDb.id, UserDb.username, UserDb.daily_calorie_goal_override, UserDb.daily_protein_goal_override
+        ))).mappings().all()
+        rows = (await db.execute(queries.class_nutrition_rows(class_code, start.isoformat(), end.isoformat()))).mappings().all()
+    days = [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+    return class_attainment(class_code, days, students, rows)
+
 @api_router.get("/analytics/user-stats", response_model=UserStats)
 async def get_user_stats(current_user: User = Depends(get_current_user), db_session: AsyncSession = Depends(get_db)):
-    # Get user's personal statistics from FoodEntryDb
-    stmt = select(FoodEntryDb).where(FoodEntryDb.user_id == current_user.id)
-    result = await db_session.execute(stmt)
+    # Get user's personal statistics from FoodEntryDb, including the archived school
+    # years since the account was created (no entry predates it)
+    entries = archived_source(FoodEntryDb, start=current_user.created_at, school=db_session.info.get("school", DEFAULT_SCHOOL))
+    result = await db_session.execute(queries.user_entries(entries, current_user.id))
     user_entries_db = result.scalars().all()
 
     if not user_entries_db:
@@ -713,33 +1937,426 @@ async def get_user_stats(current_user: User = Depends(get_current_user), db_sess
     )
 
 @api_router.get("/leaderboard")
-async def get_leaderboard(current_user: User = Depends(get_current_user), db_session: AsyncSession = Depends(get_db)) -> List[User]:
+async def get_leaderboard(current_user: User = Depends(get_current_user), db_session: AsyncSession = Depends(get_db)) -> List[UserOut]:
     # Get class leaderboard (only for same class)
-    result = await db_session.execute(
-        select(UserDb.id, UserDb.username, UserDb.points, UserDb.level, UserDb.badges, UserDb.class_code, UserDb.role, UserDb.streak_days, UserDb.last_entry_date, UserDb.created_at) # Explicitly list fields for Pydantic User model
-        .where(UserDb.class_code == current_user.class_code)
-        .order_by(UserDb.points.desc())
-        .limit(20)
+    result = await db_session.execute(queries.leaderboard(current_user.class_code))
+    # Rows -> compact records -> plain dicts; FastAPI builds the UserOut models once for the response
+    return [UserRecord.from_row(row).to_response() for row in result.all()]
+
+# Streaming exports (see export_stream.py)
+EXPORT_YIELD_PER = 1000
+
+def export_class_filter(current_user: User, class_code: Optional[str]) -> Optional[str]:
+    """Admins may export any or all classes; teachers only their own."""
+    if current_user.role == USER_ROLES["ADMIN"]:
+        return class_code.upper() if class_code else None
+    if current_user.role == USER_ROLES["TEACHER"]:
+        if class_code and class_code.upper() != current_user.class_code:
+            raise HTTPException(status_code=403, detail="Teachers can only export their own class")
+        return current_user.class_code
+    raise HTTPException(status_code=403, detail="Access denied. Admin or teacher role required.")
+
+def export_schools(class_filter: Optional[str]) -> List[str]:
+    """One class lives on one school database; an export of all classes reads every school in turn."""
+    return [shard_router.school_for_class_code(class_filter)] if class_filter else shard_router.schools
+
+async def stream_query_rows(build_stmt, schools: List[str]):
+    for school in schools:
+        # Own session: the request's session may already be closed while the response streams
+        async with shard_router.session(school) as db:
+            result = await db.stream(build_stmt(school).execution_options(yield_per=EXPORT_YIELD_PER))
+            async for row in result.mappings():
+                yield row
+
+def export_response(name: str, build_stmt, schools: List[str], format: str, gzip: bool) -> StreamingResponse:
+    """build_stmt(school) returns the export query for one school database."""
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(EXPORT_FORMATS)}")
+    fields = list(build_stmt(DEFAULT_SCHOOL).selected_columns.keys())
+    return StreamingResponse(
+        encode_rows(stream_query_rows(build_stmt, schools), fields, format, gzip),
+        media_type=export_media_type(format, gzip),
+        headers=export_headers(name, format, gzip)
     )
-    # users_db = result.scalars().all() # This would return only the first column if multiple are selected like this
-    # Instead, we map the result rows to User Pydantic model
-    leaderboard_users = []
-    for row in result.all(): # .all() gives list of Row objects
-        user_data = {
+
+@api_router.get("/export/food-entries")
+async def export_food_entries(
+    format: str = "csv",
+    gzip: bool = False,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    class_code: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    class_filter = export_class_filter(current_user, class_code)
+
+    def build_stmt(school: str):
+        return queries.export_food_entries(archived_source(FoodEntryDb, start, end, school), class_filter, start, end)
+
+    return export_response("food_entries", build_stmt, export_schools(class_filter), format, gzip)
+
+@api_router.get("/export/question-responses")
+async def export_question_responses(
+    format: str = "csv",
+    gzip: bool = False,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    class_code: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    class_filter = export_class_filter(current_user, class_code)
+
+    def build_stmt(school: str):
+        return queries.export_question_responses(archived_source(QuestionResponseDb, start, end, school), class_filter, start, end)
+
+    return export_response("question_responses", build_stmt, export_schools(class_filter), format, gzip)
+
+@api_router.get("/export/class-summaries")
+async def export_class_summaries(
+    format: str = "csv",
+    gzip: bool = False,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    class_code: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """One row per class per day, with the same figures as /analytics/class-summary."""
+    class_filter = export_class_filter(current_user, class_code)
+
+    def build_stmt(school: str):
+        return queries.export_class_summaries(archived_source(FoodEntryDb, start, end, school), class_filter, start, end)
+
+    return export_response("class_summaries", build_stmt, export_schools(class_filter), format, gzip)
+
+# Points
+class ClassPointsAwardRequest(BaseModel):
+    points: int = Field(..., gt=0, le=100)
+    reason: Optional[str] = None
+
+@api_router.post("/classes/{class_code}/award-points")
+async def award_points_to_class(
+    class_code: str,
+    award: ClassPointsAwardRequest,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role not in [USER_ROLES["ADMIN"], USER_ROLES["TEACHER"]]:
+        raise HTTPException(status_code=403, detail="Access denied. Admin or teacher role required.")
+    if current_user.role == USER_ROLES["TEACHER"] and class_code.upper() != current_user.class_code:
+        raise HTTPException(status_code=403, detail="Teachers can only award points to their own class")
+
+    # The class's school database, not the requester's (admins live on the default one)
+    async with shard_router.session(shard_router.school_for_class_code(class_code)) as db:
+        return await award_points_in_class(db, class_code, award, current_user)
+
+async def award_points_in_class(db: AsyncSession, class_code: str, award: ClassPointsAwardRequest, current_user: User) -> Dict:
+
+    # One UPDATE for the whole class, then one multi-row ledger INSERT, in a single transaction
+    result = await db.execute(queries.class_award_update(class_code.upper(), points_award_values(award.points, False, datetime.utcnow().date())))
+    awarded_rows = result.all()
+    if not awarded_rows:
+        await db.rollback()
+        raise HTTPException(status_code=404, detail="No students found in this class")
+
+    reason = f"class_award: {award.reason}"[:50] if award.reason else "class_award"
+    await db.execute(insert(PointsLedgerDb), [
+        {"id": str(uuid.uuid4()), "user_id": row.id, "points": award.points, "reason": reason, "awarded_by": current_user.id, "timestamp": datetime.utcnow()}
+        for row in awarded_rows
+    ])
+    for row in awarded_rows:
+        await apply_badge_events(db, row.id, [{"type": "points", "user_id": row.id, "points_before": row.points - award.points, "points": row.points}])
+    await db.commit()
+
+    return {
+        "message": f"Awarded {award.points} points to {len(awarded_rows)} students",
+        "students": [{"id": row.id, "points": row.points, "level": row.level} for row in awarded_rows]
+    }
+
+@api_router.get("/points/ledger")
+async def get_points_ledger(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    result = await db.execute(queries.points_ledger(current_user.id))
+    return [
+        {
             "id": row.id,
-            "username": row.username,
             "points": row.points,
-            "level": row.level,
-            "badges": row.badges,
-            "class_code": row.class_code,
-            "role": row.role,
-            "streak_days": row.streak_days,
-            "last_entry_date": row.last_entry_date,
-            "created_at": row.created_at
+            "reason": row.reason,
+            "source_id": row.source_id,
+            "timestamp": row.timestamp.isoformat()
         }
-        leaderboard_users.append(User.model_validate(user_data))
-    
-    return leaderboard_users
+        for row in result.scalars().all()
+    ]
+
+@api_router.get("/badges/rules")
+async def get_badge_rules(current_user: User = Depends(get_current_user)):
+    return badge_engine.rules
+
+class BadgeBackfillRequest(BaseModel):
+    rule_ids: Optional[List[str]] = None  # None -> all rules
+
+@api_router.post("/admin/badges/backfill")
+async def admin_backfill_badges(
+    request: BadgeBackfillRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Replays stored history through the badge rules, e.g. after a new rule was added."""
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    rule_ids = request.rule_ids or [rule["id"] for rule in badge_engine.rules]
+    unknown = [rule_id for rule_id in rule_ids if rule_id not in badge_engine.by_id]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown badge rule(s): {', '.join(unknown)}")
+
+    async def backfill(db: AsyncSession, school: str) -> Dict[str, int]:
+        # Whole history, archived school years included
+        entries = archived_source(FoodEntryDb, school=school)
+        responses = archived_source(QuestionResponseDb, school=school)
+        entry_rows = (await db.execute(
+            select(entries.user_id, entries.timestamp, entries.nutrition_info).where(entries.ai_score.is_not(None))
+        )).all()
+        response_rows = (await db.execute(select(responses.user_id, responses.timestamp))).all()
+        events = [
+            {"type": "food_entry", "user_id": row.user_id, "timestamp": row.timestamp, "category": (row.nutrition_info or {}).get("category")}
+            for row in entry_rows
+        ] + [
+            {"type": "question_response", "user_id": row.user_id, "timestamp": row.timestamp}
+            for row in response_rows
+        ]
+        events.sort(key=lambda event: event["timestamp"])
+        # Points history before the ledger existed is unknown, so each user's current total counts as one award
+        # (the default database also holds the directory copies of other schools' users; skip those)
+        events += [
+            {"type": "points", "user_id": row.id, "points_before": 0, "points": row.points or 0}
+            for row in (await db.execute(select(UserDb.id, UserDb.points, UserDb.class_code))).all()
+            if shard_router.school_for_class_code(row.class_code) == school
+        ]
+
+        counters, awarded = replay_badge_events(badge_engine, events, rule_ids)
+
+        # Replayed counters replace the live ones for these rules
+        await db.execute(delete(BadgeCounterDb).where(BadgeCounterDb.rule_id.in_(rule_ids)))
+        if counters:
+            await db.execute(insert(BadgeCounterDb), [
+                {"user_id": user_id, "rule_id": rule_id, "window_key": key, "count": count}
+                for (user_id, rule_id, key), count in counters.items()
+            ])
+        for user_id, badge_names in awarded.items():
+            await grant_badges(db, user_id, badge_names)
+        await db.commit()
+
+        return {"events_replayed": len(events), "counters_written": len(counters), "users_with_badges": len(awarded)}
+
+    # Every user's history and counters live on their school's database, so each school replays its own
+    if shard_router.sharded:
+        per_school = await shard_router.fan_out(backfill)
+    else:
+        per_school = {DEFAULT_SCHOOL: await backfill(db, DEFAULT_SCHOOL)}
+    return {
+        "rules": rule_ids,
+        **{key: sum(result[key] for result in per_school.values()) for key in ("events_replayed", "counters_written", "users_with_badges")},
+        "schools": sorted(per_school)
+    }
+
+# Offline-first sync: one round trip applies the client's queued mutations
+# and returns everything that changed since its last sync token.
+SYNC_MAX_MUTATIONS = 50
+SYNC_MAX_CHAT_MESSAGES = 100
+SYNC_CLAIM_LEASE_SECONDS = 120  # A claim older than this was left by a crashed worker and can be taken over
+
+class SyncMutation(BaseModel):
+    idempotency_key: str = Field(..., min_length=1, max_length=64)
+    type: str  # chat_message, question_response, gallery_like
+    payload: Dict = Field(default_factory=dict)
+
+class SyncRequest(BaseModel):
+    sync_token: Optional[str] = None
+    mutations: List[SyncMutation] = Field(default_factory=list, max_length=SYNC_MAX_MUTATIONS)
+
+def encode_sync_token(synced_at: datetime, question_ids: List[str], chat_after_id: str = "") -> str:
+    # chat_after_id: the last chat message sent when the token stops at its timestamp
+    raw = json.dumps({"t": synced_at.isoformat(), "c": chat_after_id, "q": question_ids}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_sync_token(token: Optional[str]) -> Optional[Dict]:
+    """None for a missing or unreadable token, which means a full sync."""
+    if not token:
+        return None
+    try:
+        state = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        return {"since": parse_timestamp(state["t"]), "chat_after_id": str(state.get("c", "")),
+                "question_ids": list(state.get("q", []))}
+    except Exception:
+        return None
+
+async def store_chat_message(current_user: User, message: str) -> Dict:
+    chat_message_data = {
+        "id": str(uuid.uuid4()),
+        "user_id": current_user.id,
+        "username": current_user.username,
+        "class_code": current_user.class_code,
+        "message": message,
+        "is_admin": current_user.role == USER_ROLES["ADMIN"],
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+    async with shared_store_lock("chat_messages"):
+        all_messages = load_chat_messages()
+        all_messages.append(chat_message_data)
+        save_chat_messages(all_messages)
+    await mirror_to_sql("chat_messages", chat_message_data)
+    return chat_message_data
+
+async def apply_sync_mutation(mutation: SyncMutation, current_user: User, db: AsyncSession):
+    payload = mutation.payload
+    if mutation.type == "chat_message":
+        message = str(payload.get("message", "")).strip()
+        if not message:
+            raise HTTPException(status_code=400, detail="Empty chat message")
+        return await store_chat_message(current_user, message)
+    if mutation.type == "question_response":
+        response = await submit_question_response(
+            QuestionResponseCreate(question_id=payload.get("question_id", ""), response_text=payload.get("response_text", "")),
+            current_user, db
+        )
+        return response.model_dump(mode="json")
+    if mutation.type == "gallery_like":
+        return await like_gallery_item(str(payload.get("item_id", "")), current_user, db)
+    raise HTTPException(status_code=400, detail=f"Unknown mutation type: {mutation.type}")
+
+async def claim_sync_mutation(mutation: SyncMutation, current_user: User, db: AsyncSession) -> Optional[SyncMutationDb]:
+    """
+    Claims the key for this request; returns None when claimed, else the stored row of
+    the earlier attempt. An unfinished claim past its lease is taken over.
+    """
+    key = (SyncMutationDb.user_id == current_user.id, SyncMutationDb.idempotency_key == mutation.idempotency_key)
+    claimed = (await db.execute(
+        sqlite_insert(SyncMutationDb)
+        .values(user_id=current_user.id, idempotency_key=mutation.idempotency_key, status_code=0, created_at=datetime.utcnow())
+        .on_conflict_do_nothing()
+    )).rowcount
+    await db.commit()
+    if claimed:
+        return None
+    stored = (await db.execute(select(SyncMutationDb).where(*key))).scalar_one()
+    if stored.status_code == 0 and stored.created_at < datetime.utcnow() - timedelta(seconds=SYNC_CLAIM_LEASE_SECONDS):
+        # Compare-and-set on the old claim time, so only one retry takes it over
+        taken_over = (await db.execute(
+            update(SyncMutationDb)
+            .where(*key, SyncMutationDb.status_code == 0, SyncMutationDb.created_at == stored.created_at)
+            .values(created_at=datetime.utcnow())
+        )).rowcount
+        await db.commit()
+        if taken_over:
+            return None
+        await db.refresh(stored)
+    return stored
+
+async def run_sync_mutation(mutation: SyncMutation, current_user: User, db: AsyncSession) -> Dict:
+    # Claim the key first; if it already exists this is a retry and gets the stored outcome
+    stored = await claim_sync_mutation(mutation, current_user, db)
+    if stored is not None:
+        if stored.status_code == 0:
+            return {"idempotency_key": mutation.idempotency_key, "status": 409, "error": "Mutation is still being applied", "replayed": True}
+        return {"idempotency_key": mutation.idempotency_key, "status": stored.status_code, **(stored.result or {}), "replayed": True}
+
+    try:
+        outcome = {"result": await apply_sync_mutation(mutation, current_user, db)}
+        status_code = 200
+    except HTTPException as e:
+        # Client errors are final: a retry would fail the same way
+        await db.rollback()
+        outcome = {"error": e.detail}
+        status_code = e.status_code
+    except Exception as e:
+        # Part of the mutation may already be committed (points before the JSON store), so
+        # the failure is final too: re-applying it under the same key could apply it twice
+        await db.rollback()
+        logging.error(f"Sync mutation {mutation.idempotency_key} of user {current_user.id} failed: {e}")
+        outcome = {"error": "Mutation failed and may be partly applied; check before resending it with a new key"}
+        status_code = 500
+
+    await db.execute(
+        update(SyncMutationDb)
+        .where(SyncMutationDb.user_id == current_user.id, SyncMutationDb.idempotency_key == mutation.idempotency_key)
+        .values(status_code=status_code, result=json.loads(json.dumps(outcome, default=str)))
+    )
+    await db.commit()
+    return {"idempotency_key": mutation.idempotency_key, "status": status_code, **outcome, "replayed": False}
+
+async def chat_messages_since(current_user: User, since: Optional[datetime], after_id: str, db: AsyncSession) -> Tuple[List[Dict], bool]:
+    """
+    The oldest SYNC_MAX_CHAT_MESSAGES messages after (`since`, `after_id`), oldest first
+    by timestamp then id, and whether more follow. A full sync (no `since`) only gets the
+    newest ones instead.
+    """
+    if DATA_READ_MODE == "sql":
+        class_filter = None if current_user.role == USER_ROLES["ADMIN"] else current_user.class_code
+        if since:
+            stmt = queries.chat_messages_after(class_filter, since, SYNC_MAX_CHAT_MESSAGES + 1, after_id)
+        else:
+            stmt = queries.recent_chat_messages(class_filter, SYNC_MAX_CHAT_MESSAGES + 1)
+        messages = [
+            {"id": msg.id, "user_id": msg.user_id, "username": msg.username, "class_code": class_code,
+             "message": msg.message, "is_admin": msg.is_admin, "timestamp": msg.timestamp.isoformat()}
+            for msg, class_code in (await db.execute(stmt)).all()
+        ]
+    else:
+        async with shared_store_lock("chat_messages", exclusive=False):
+            all_messages = load_chat_messages()
+        messages = [
+            msg for msg in all_messages
+            if (current_user.role == USER_ROLES["ADMIN"] or msg.get("class_code") == current_user.class_code)
+            and (since is None or (parse_timestamp(msg.get("timestamp")), msg.get("id", "")) > (since, after_id))
+        ]
+        messages.sort(key=lambda msg: (parse_timestamp(msg.get("timestamp")), msg.get("id", "")), reverse=since is None)
+        messages = messages[:SYNC_MAX_CHAT_MESSAGES + 1]
+    more = since is not None and len(messages) > SYNC_MAX_CHAT_MESSAGES
+    messages = messages[:SYNC_MAX_CHAT_MESSAGES]
+    if since is None:
+        messages.reverse()  # Oldest first, in the order the client appends them
+    return messages, more
+
+@api_router.post("/sync")
+async def sync(request: SyncRequest, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    # Taken before reading, so changes made while the delta is built show up next time (clients dedupe by id)
+    synced_at = datetime.utcnow()
+    previous = decode_sync_token(request.sync_token)
+    since = previous["since"] if previous else None
+    chat_after_id = previous["chat_after_id"] if previous else ""
+
+    mutation_results = [await run_sync_mutation(mutation, current_user, db) for mutation in request.mutations]
+
+    me = (await db.execute(
+        select(UserDb.points, UserDb.level, UserDb.streak_days, UserDb.badges).where(UserDb.id == current_user.id)
+    )).first()
+    leaderboard_position = None
+    if me is not None:
+        leaderboard_position = (await db.execute(
+            select(func.count()).select_from(UserDb).where(UserDb.class_code == current_user.class_code, UserDb.points > me.points)
+        )).scalar_one() + 1
+
+    # With more messages than fit, the token only advances to the last one sent and the client syncs again
+    chat_messages, has_more = await chat_messages_since(current_user, since, chat_after_id, db)
+    chat_after_id = ""
+    if has_more:
+        synced_at = parse_timestamp(chat_messages[-1]["timestamp"])
+        chat_after_id = chat_messages[-1]["id"]
+
+    todays_questions = await get_todays_questions()
+    question_ids = sorted(question.id for question in todays_questions)
+    delta = {
+        "sync_token": encode_sync_token(synced_at, question_ids, chat_after_id),
+        "full_sync": previous is None,
+        "has_more": has_more,
+        "mutations": mutation_results,
+        "me": {
+            "points": me.points, "level": me.level, "streak_days": me.streak_days, "badges": me.badges or []
+        } if me is not None else None,
+        "leaderboard_position": leaderboard_position,
+        "chat_messages": chat_messages
+    }
+    # Today's question rarely changes, so it is only sent when the client's copy is stale
+    if previous is None or previous["question_ids"] != question_ids:
+        delta["todays_questions"] = [question.model_dump(mode="json") for question in todays_questions]
+    return delta
 
 # Admin endpoints
 @api_router.post("/admin/create-user")
@@ -750,41 +2367,45 @@ async def admin_create_user(
     if current_user.role != USER_ROLES["ADMIN"]:
         raise HTTPException(status_code=403, detail="Admin access required")
 
-    all_users = load_users()
-    class_code_upper = user_data.class_code.upper()
-
-    # Check if username already exists in this class
-    for existing_user in all_users:
-        if existing_user.get("username") == user_data.username and \
-           existing_user.get("class_code") == class_code_upper:
-            raise HTTPException(status_code=400, detail="Username already exists in this class")
-
-    # Determine role from class code or use provided role
-    role = user_data.role or get_role_from_class_code(class_code_upper)
-    if not role:
-        raise HTTPException(status_code=400, detail="Invalid class code or role not determinable")
-
-    # Create new user dictionary
-    new_user_id = str(uuid.uuid4())
-    new_user_entry = {
-        "id": new_user_id,
-        "username": user_data.username,
-        "password_hash": get_password_hash(user_data.password), # Use the correct hashing function
-        "class_code": class_code_upper,
-        "role": role,
-        "points": 0,
-        "level": 1,
-        "badges": [],
-        "streak_days": 0,
-        "last_entry_date": None, # Stored as string or None
-        "created_at": datetime.now(timezone.utc).isoformat(),
-        "is_active": True,
-        "daily_calorie_goal_override": None,
-        "daily_protein_goal_override": None
-    }
+    # Hash before taking the store lock; it holds up every other users.json writer
+    password_hash = await password_hasher.hash(user_data.password)
+    async with shared_store_lock("users"):
+        all_users = load_users()
+        class_code_upper = user_data.class_code.upper()
+
+        # Check if username already exists in this class
+        for existing_user in all_users:
+            if existing_user.get("username") == user_data.username and \
+               existing_user.get("class_code") == class_code_upper:
+                raise HTTPException(status_code=400, detail="Username already exists in this class")
+
+        # Determine role from class code or use provided role
+        role = user_data.role or get_role_from_class_code(class_code_upper)
+        if not role:
+            raise HTTPException(status_code=400, detail="Invalid class code or role not determinable")
+
+        # Create new user dictionary
+        new_user_id = str(uuid.uuid4())
+        new_user_entry = {
+            "id": new_user_id,
+            "username": user_data.username,
+            "password_hash": password_hash,
+            "class_code": class_code_upper,
+            "role": role,
+            "points": 0,
+            "level": 1,
+            "badges": [],
+            "streak_days": 0,
+            "last_entry_date": None, # Stored as string or None
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "is_active": True,
+            "daily_calorie_goal_override": None,
+            "daily_protein_goal_override": None
+        }
 
-    all_users.append(new_user_entry)
-    save_users(all_users)
+        all_users.append(new_user_entry)
+        save_users(all_users)
+    await mirror_to_sql("users", new_user_entry)
 
     # Return a subset of user info, similar to original, excluding password_hash
     return {
@@ -806,26 +2427,28 @@ async def admin_reset_user_points_streak(
     if current_user.role != USER_ROLES["ADMIN"]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
 
-    all_users = load_users()
-    user_to_update = None
-    user_index = -1
+    async with shared_store_lock("users"):
+        all_users = load_users()
+        user_to_update = None
+        user_index = -1
 
-    for i, u in enumerate(all_users):
-        if u.get("id") == user_id:
-            user_to_update = u
-            user_index = i
-            break
+        for i, u in enumerate(all_users):
+            if u.get("id") == user_id:
+                user_to_update = u
+                user_index = i
+                break
 
-    if not user_to_update:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        if not user_to_update:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    user_to_update["points"] = 0
-    user_to_update["streak_days"] = 0
-    # Potentially also reset level if it's derived from points, or last_entry_date if streak is reset
-    # For now, only points and streak_days as per direct request.
+        user_to_update["points"] = 0
+        user_to_update["streak_days"] = 0
+        # Potentially also reset level if it's derived from points, or last_entry_date if streak is reset
+        # For now, only points and streak_days as per direct request.
 
-    all_users[user_index] = user_to_update
-    save_users(all_users)
+        all_users[user_index] = user_to_update
+        save_users(all_users)
+    await set_user_totals_in_sql(user_id, {"points": 0, "streak_days": 0, "level": 1, "last_entry_date": None}, current_user.id)
 
     try:
         # Validate the updated user data before returning
@@ -846,27 +2469,29 @@ async def admin_update_user_points(
     if current_user.role != USER_ROLES["ADMIN"]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
 
-    all_users = load_users()
-    user_to_update = None
-    user_index = -1
+    async with shared_store_lock("users"):
+        all_users = load_users()
+        user_to_update = None
+        user_index = -1
 
-    for i, u in enumerate(all_users):
-        if u.get("id") == user_id:
-            user_to_update = u
-            user_index = i
-            break
+        for i, u in enumerate(all_users):
+            if u.get("id") == user_id:
+                user_to_update = u
+                user_index = i
+                break
 
-    if not user_to_update:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        if not user_to_update:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    if points_data.new_points < 0:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Points cannot be negative.")
+        if points_data.new_points < 0:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Points cannot be negative.")
 
-    user_to_update["points"] = points_data.new_points
-    # Note: Level is not automatically recalculated here. This might be a future enhancement.
+        user_to_update["points"] = points_data.new_points
+        # Note: Level is not automatically recalculated here. This might be a future enhancement.
 
-    all_users[user_index] = user_to_update
-    save_users(all_users)
+        all_users[user_index] = user_to_update
+        save_users(all_users)
+    await set_user_totals_in_sql(user_id, {"points": points_data.new_points}, current_user.id)
 
     try:
         updated_user_model = User.model_validate(user_to_update)
@@ -875,137 +2500,189 @@ async def admin_update_user_points(
         print(f"Error validating user data after points update: {e} - Data: {user_to_update}")
         raise HTTPException(status_code=500, detail="Error processing user data after points update.")
 
+class NutritionGoalsUpdate(BaseModel):
+    # None restores the default goal
+    daily_calorie_goal_override: Optional[float] = Field(None, gt=0)
+    daily_protein_goal_override: Optional[float] = Field(None, ge=0)
 
-@api_router.get("/admin/users", response_model=List[User])
-async def admin_get_users(current_user: User = Depends(get_current_user)):
+@api_router.post("/admin/users/{user_id}/nutrition-goals")
+async def admin_set_nutrition_goals(user_id: str, goals: NutritionGoalsUpdate, current_user: User = Depends(get_current_user)):
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    overrides = goals.model_dump()
+
+    async with shared_store_lock("users"):
+        all_users = await execution_lanes.run_blocking(load_users)
+        user_to_update = next((u for u in all_users if u.get("id") == user_id), None)
+        if not user_to_update:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        user_to_update.update(overrides)
+        await execution_lanes.run_blocking(save_users, all_users)
+
+    school = await school_for_user(user_id)
+    for target in dict.fromkeys([school, DEFAULT_SCHOOL]):
+        async with shard_router.session(target) as db:
+            await db.execute(update(UserDb).where(UserDb.id == user_id).values(**overrides))
+            await db.commit()
+    return {"user_id": user_id, "goals": goals_for(goals.daily_calorie_goal_override, goals.daily_protein_goal_override)}
+
+
+async def users_of_school(db: AsyncSession, school: str) -> List[UserDb]:
+    """The users a school database is authoritative for (the default one also holds the directory)."""
+    users = (await db.execute(select(UserDb))).scalars().all()
+    return [user_db for user_db in users if shard_router.school_for_class_code(user_db.class_code) == school]
+
+@api_router.get("/admin/shards")
+async def admin_get_shards(current_user: User = Depends(get_current_user)):
     if current_user.role != USER_ROLES["ADMIN"]:
         raise HTTPException(status_code=403, detail="Admin access required")
-    
-    all_users_data = load_users()
+
+    async def row_counts(db: AsyncSession, school: str) -> Dict[str, int]:
+        counts = {}
+        for model in (UserDb,) + USER_OWNED_MODELS[:3]:
+            counts[model.__tablename__] = (await db.execute(select(func.count()).select_from(model))).scalar_one()
+        return counts
+
+    shards = shard_router.stats()
+    for school, counts in (await shard_router.fan_out(row_counts)).items():
+        shards[school]["rows"] = counts
+    return shards
+
+@api_router.get("/admin/users", response_model=List[UserOut])
+async def admin_get_users(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    if DATA_READ_MODE != "json":
+        if shard_router.sharded:
+            # Points and badges are kept on each school's database; the directory copies may lag behind
+            per_school = await shard_router.fan_out(users_of_school)
+            sql_users = sorted((user_db for users in per_school.values() for user_db in users), key=lambda user_db: user_db.created_at, reverse=True)
+        else:
+            result = await db.execute(select(UserDb).order_by(UserDb.created_at.desc()))
+            sql_users = result.scalars().all()
+        if DATA_READ_MODE == "sql":
+            # SQL rows have the column types, so FastAPI validates the plain dicts once, at the boundary
+            return [UserRecord.from_row(user_db).to_response() for user_db in sql_users]
+
+    async with shared_store_lock("users", exclusive=False):
+        all_users_data = load_users()
+
+    if DATA_READ_MODE == "dual":
+        fields = NORMALIZERS["users"][2]
+        log_read_differences("users", all_users_data, [
+            {"id": user_db.id, **{field: getattr(user_db, field) for field in fields}} for user_db in sql_users
+        ])
     
     # Sort users by created_at (descending - newest first)
     # Assumes created_at is an ISO string that can be sorted lexicographically
     all_users_data.sort(key=lambda x: x.get("created_at", ""), reverse=True)
     
-    # Validate and convert to Pydantic User models
-    # Pydantic's User model does not include 'password_hash', so it will be excluded automatically.
+    # JSON records drift, so each one is validated here and a bad record is skipped, not a 500
     validated_users = []
     for user_data in all_users_data:
         try:
-            validated_users.append(User.model_validate(user_data))
+            validated_users.append(UserOut.model_validate(UserRecord.from_json(user_data).to_response()))
         except Exception as e:
-            print(f"Error validating user data for GET /admin/users: {e} - Data: {user_data}")
+            print(f"Error converting user data for GET /admin/users: {e} - Data: {user_data}")
             # Optionally, decide to skip this item or handle error differently
             
     return validated_users
 
+# store name, load, save, plural and singular label for the admin_delete_user cascade
+USER_CASCADE_STORES = [
+    ("food_entries", load_food_entries, save_food_entries, "food entries", "food entry"),
+    ("chat_messages", load_chat_messages, save_chat_messages, "chat messages", "chat message"),
+    ("question_responses", load_question_responses, save_question_responses, "question responses", "question response"),
+    ("gallery_items", load_gallery_items, save_gallery_items, "gallery items", "gallery item"),
+    ("calorie_checks", load_calorie_checks, save_calorie_checks, "calorie checks", "calorie check"),
+    ("food_comparisons", load_food_comparisons, save_food_comparisons, "food comparisons", "food comparison"),
+]
+
+def remove_user_records(load_fn, save_fn, user_id: str) -> bool:
+    """Blocking: drops a user's records from one JSON store. Returns whether anything was removed."""
+    records = load_fn()
+    kept = [record for record in records if record.get("user_id") != user_id]
+    if len(kept) == len(records):
+        return False
+    save_fn(kept)
+    return True
+
 @api_router.delete("/admin/users/{user_id}")
 async def admin_delete_user(user_id: str, current_user: User = Depends(get_current_user)):
     if current_user.role != USER_ROLES["ADMIN"]:
         raise HTTPException(status_code=403, detail="Admin access required")
-    
-    all_users = load_users()
-    user_to_delete_index = -1
-    for i, user_dict in enumerate(all_users):
-        if user_dict.get("id") == user_id:
-            user_to_delete_index = i
-            break
-            
-    if user_to_delete_index == -1:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    del all_users[user_to_delete_index]
-    save_users(all_users)
-
-    # Cascading delete for food_entries.json
     try:
-        all_food_entries = load_food_entries()
-        # Filter out food entries belonging to the deleted user
-        updated_food_entries = [entry for entry in all_food_entries if entry.get("user_id") != user_id]
-        if len(updated_food_entries) < len(all_food_entries):
-            save_food_entries(updated_food_entries)
-            food_entries_message = "Food entries for the user also deleted."
-        else:
-            food_entries_message = "No food entries found for the user to delete."
-    except Exception as e:
-        # Log this error but don't let it fail the whole user deletion process
-        print(f"Error during cascading delete of food entries for user {user_id}: {e}")
-        food_entries_message = "Could not process food entry deletion due to an error."
+        return await delete_user_everywhere(user_id)
+    except LaneFull:
+        # Nothing is orphaned: the user record goes last, so a retry finishes the deletion
+        raise HTTPException(
+            status_code=503, detail="The server is busy, please retry the deletion shortly.", headers={"Retry-After": "5"}
+        )
 
-    # Cascading delete for chat_messages.json
-    chat_messages_delete_message = ""
-    try:
-        all_chat_messages = load_chat_messages()
-        updated_chat_messages = [msg for msg in all_chat_messages if msg.get("user_id") != user_id]
-        if len(updated_chat_messages) < len(all_chat_messages):
-            save_chat_messages(updated_chat_messages)
-            chat_messages_delete_message = "Chat messages for the user also deleted."
-        else:
-            chat_messages_delete_message = "No chat messages found for the user to delete."
-    except Exception as e:
-        print(f"Error during cascading delete of chat messages for user {user_id}: {e}")
-        chat_messages_delete_message = "Could not process chat message deletion due to an error."
+async def delete_user_everywhere(user_id: str) -> Dict:
+    async with shared_store_lock("users", exclusive=False):
+        all_users = await execution_lanes.run_blocking(load_users)
+    if not any(user_dict.get("id") == user_id for user_dict in all_users):
+        raise HTTPException(status_code=404, detail="User not found")
 
-    # Cascading delete for question_responses.json
-    question_responses_delete_message = ""
-    try:
-        all_question_responses = load_question_responses()
-        updated_question_responses = [resp for resp in all_question_responses if resp.get("user_id") != user_id]
-        if len(updated_question_responses) < len(all_question_responses):
-            save_question_responses(updated_question_responses)
-            question_responses_delete_message = "Question responses for the user also deleted."
-        else:
-            question_responses_delete_message = "No question responses found for the user to delete."
-    except Exception as e:
-        print(f"Error during cascading delete of question responses for user {user_id}: {e}")
-        question_responses_delete_message = "Could not process question response deletion due to an error."
+    # Cascading delete from the other JSON stores. Rewriting a store is blocking file
+    # I/O, so it runs in the I/O pool instead of on the event loop.
+    cascade_messages = []
+    for store_name, load_fn, save_fn, plural, singular in USER_CASCADE_STORES:
+        try:
+            async with shared_store_lock(store_name):
+                removed = await execution_lanes.run_blocking(remove_user_records, load_fn, save_fn, user_id)
+            if removed:
+                cascade_messages.append(f"{plural.capitalize()} for the user also deleted.")
+            else:
+                cascade_messages.append(f"No {plural} found for the user to delete.")
+        except LaneFull:
+            raise
+        except Exception as e:
+            # Log this error but don't let it fail the whole user deletion process
+            print(f"Error during cascading delete of {plural} for user {user_id}: {e}")
+            cascade_messages.append(f"Could not process {singular} deletion due to an error.")
 
-    # Cascading delete for gallery_items.json
-    gallery_items_delete_message = ""
-    try:
-        all_gallery_items = load_gallery_items()
-        updated_gallery_items = [item for item in all_gallery_items if item.get("user_id") != user_id]
-        if len(updated_gallery_items) < len(all_gallery_items):
-            save_gallery_items(updated_gallery_items)
-            gallery_items_delete_message = "Gallery items for the user also deleted."
-        else:
-            gallery_items_delete_message = "No gallery items found for the user to delete."
-    except Exception as e:
-        print(f"Error during cascading delete of gallery items for user {user_id}: {e}")
-        gallery_items_delete_message = "Could not process gallery item deletion due to an error."
+    # Always: entries, points and the searchable chat and feedback rows are in SQL in every read mode
+    await delete_user_rows_from_sql(user_id)
 
-    # Cascading delete for calorie_checks.json
-    calorie_checks_delete_message = ""
-    try:
-        all_calorie_checks = load_calorie_checks()
-        updated_calorie_checks = [check for check in all_calorie_checks if check.get("user_id") != user_id]
-        if len(updated_calorie_checks) < len(all_calorie_checks):
-            save_calorie_checks(updated_calorie_checks)
-            calorie_checks_delete_message = "Calorie checks for the user also deleted."
-        else:
-            calorie_checks_delete_message = "No calorie checks found for the user to delete."
-    except Exception as e:
-        print(f"Error during cascading delete of calorie checks for user {user_id}: {e}")
-        calorie_checks_delete_message = "Could not process calorie check deletion due to an error."
+    async with shared_store_lock("users"):
+        all_users = await execution_lanes.run_blocking(load_users)
+        remaining_users = [user_dict for user_dict in all_users if user_dict.get("id") != user_id]
+        if len(remaining_users) < len(all_users):
+            await execution_lanes.run_blocking(save_users, remaining_users)
 
-    # Cascading delete for food_comparisons.json
-    food_comparisons_delete_message = ""
-    try:
-        all_food_comparisons = load_food_comparisons()
-        updated_food_comparisons = [comp for comp in all_food_comparisons if comp.get("user_id") != user_id]
-        if len(updated_food_comparisons) < len(all_food_comparisons):
-            save_food_comparisons(updated_food_comparisons)
-            food_comparisons_delete_message = "Food comparisons for the user also deleted."
-        else:
-            food_comparisons_delete_message = "No food comparisons found for the user to delete."
-    except Exception as e:
-        print(f"Error during cascading delete of food comparisons for user {user_id}: {e}")
-        food_comparisons_delete_message = "Could not process food comparison deletion due to an error."
+    return {
+        "message": f"User deleted successfully from users.json. {' '.join(cascade_messages)}"
+    }
 
+@api_router.get("/admin/profiles")
+async def admin_list_profiles(current_user: User = Depends(get_current_user)):
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
     return {
-        "message": f"User deleted successfully from users.json. {food_entries_message} {chat_messages_delete_message} {question_responses_delete_message} {gallery_items_delete_message} {calorie_checks_delete_message} {food_comparisons_delete_message}"
+        "threshold_ms": slow_request_profiler.threshold_ms,
+        "profiles": slow_request_profiler.list_profiles()
     }
 
+@api_router.get("/admin/profiles/{profile_id}", response_class=PlainTextResponse)
+async def admin_get_profile(profile_id: str, current_user: User = Depends(get_current_user)):
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    collapsed = slow_request_profiler.get_collapsed(profile_id)
+    if collapsed is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    # Collapsed stacks: feed directly to flamegraph.pl, inferno or speedscope
+    return PlainTextResponse(collapsed)
+
+@api_router.delete("/admin/profiles")
+async def admin_clear_profiles(current_user: User = Depends(get_current_user)):
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    slow_request_profiler.clear()
+    return {"message": "Profiles cleared"}
+
 @api_router.post("/admin/create-question", response_model=DailyQuestion)
 async def admin_create_question(
     question_data: DailyQuestionCreate, 
@@ -1014,31 +2691,37 @@ async def admin_create_question(
     if current_user.role != USER_ROLES["ADMIN"]:
         raise HTTPException(status_code=403, detail="Admin access required")
 
-    all_questions = load_daily_questions()
-
-    # Check if a question for this date already exists
-    for q_dict in all_questions:
-        if q_dict.get("date") == question_data.date:
-            raise HTTPException(status_code=400, detail=f"A question for date {question_data.date} already exists.")
+    async with shared_store_lock("daily_questions"):
+        all_questions = load_daily_questions()
 
-    # If the new question is set to active, deactivate any other active questions
-    if question_data.active:
+        # Check if a question for this date already exists
         for q_dict in all_questions:
-            if q_dict.get("active") is True:
-                q_dict["active"] = False # Deactivate existing active question
-
-    new_question_entry = {
-        "id": str(uuid.uuid4()),
-        "question": question_data.question,
-        "options": question_data.options,
-        "date": question_data.date,
-        "active": question_data.active,
-        "points_reward": question_data.points_reward,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
+            if q_dict.get("date") == question_data.date:
+                raise HTTPException(status_code=400, detail=f"A question for date {question_data.date} already exists.")
+
+        # If the new question is set to active, deactivate any other active questions
+        deactivated_questions = []
+        if question_data.active:
+            for q_dict in all_questions:
+                if q_dict.get("active") is True:
+                    q_dict["active"] = False # Deactivate existing active question
+                    deactivated_questions.append(q_dict)
+
+        new_question_entry = {
+            "id": str(uuid.uuid4()),
+            "question": question_data.question,
+            "options": question_data.options,
+            "date": question_data.date,
+            "active": question_data.active,
+            "points_reward": question_data.points_reward,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
 
-    all_questions.append(new_question_entry)
-    save_daily_questions(all_questions)
+        all_questions.append(new_question_entry)
+        save_daily_questions(all_questions)
+    for q_dict in deactivated_questions:
+        await mirror_to_sql("daily_questions", q_dict)
+    await mirror_to_sql("daily_questions", new_question_entry)
 
     try:
         validated_question = DailyQuestion.model_validate(new_question_entry)
@@ -1058,9 +2741,11 @@ async def submit_feedback(feedback_input: FeedbackCreate, current_user: User = D
         "timestamp": datetime.now(timezone.utc).isoformat() # Pydantic will parse this to datetime
     }
 
-    all_feedback_items = load_feedback_items()
-    all_feedback_items.append(feedback_data)
-    save_feedback_items(all_feedback_items)
+    async with shared_store_lock("feedback_items"):
+        all_feedback_items = load_feedback_items()
+        all_feedback_items.append(feedback_data)
+        save_feedback_items(all_feedback_items)
+    await mirror_to_sql("feedback_items", feedback_data)
 
     # Validate the data with the Feedback Pydantic model before returning
     # This ensures the response conforms to the defined schema (e.g., ISO str to datetime)
@@ -1072,6 +2757,62 @@ async def submit_feedback(feedback_input: FeedbackCreate, current_user: User = D
         # This case should ideally not happen if data is constructed correctly
         raise HTTPException(status_code=500, detail="Error processing feedback after saving.")
 
+# Full-text search (see search_index.py)
+@api_router.get("/search")
+async def search(
+    q: str,
+    sources: Optional[str] = None,
+    limit: int = 20,
+    offset: int = 0,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    match_query = to_match_query(q)
+    if match_query is None:
+        raise HTTPException(status_code=400, detail="Search query must contain at least one word")
+    requested = [source.strip() for source in sources.split(",")] if sources else list(SEARCH_SOURCES)
+    unknown = [source for source in requested if source not in SEARCH_SOURCES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown search source(s): {', '.join(unknown)}")
+    limit = max(1, min(limit, 100))
+    offset = max(0, offset)
+
+    # Admins search everything, teachers their class, students their own entries/feedback and class chat
+    if current_user.role == USER_ROLES["ADMIN"]:
+        scope = "all"
+    elif current_user.role == USER_ROLES["TEACHER"]:
+        scope = "class"
+    else:
+        scope = "own"
+
+    params = {"query": match_query, "limit": limit + 1, "offset": offset, "class_code": current_user.class_code, "user_id": current_user.id}
+    try:
+        rows = (await db.execute(text(search_sql(requested, scope)), params)).all()
+    except Exception as e:
+        logging.error(f"Search for {q!r} failed: {e}")
+        raise HTTPException(status_code=400, detail="Invalid search query")
+
+    return {
+        "query": q,
+        "results": [
+            {
+                "source": row.source,
+                "id": row.id,
+                "user_id": row.user_id,
+                "username": row.username,
+                "class_code": row.class_code,
+                "title": row.title,
+                "snippet": row.snippet,
+                "timestamp": row.timestamp,
+                "rank": row.rank
+            }
+            for row in rows[:limit]
+        ],
+        "offset": offset,
+        "limit": limit,
+        "has_more": len(rows) > limit
+    }
+
 # Basic endpoints
 @api_router.get("/")
 async def root():
@@ -1083,24 +2824,313 @@ async def get_current_user_info(current_user: User = Depends(get_current_user)):
 
 @api_router.get("/users/{user_id}/profile", response_model=User)
 async def get_user_profile_by_id(user_id: str, db_session: AsyncSession = Depends(get_db)):
-    result = await db_session.execute(select(UserDb).where(UserDb.id == user_id))
+    result = await db_session.execute(queries.user_by_id(user_id))
     user_db = result.scalars().first()
     if not user_db:
         raise HTTPException(status_code=404, detail="User not found")
     return User.model_validate(user_db)
 
+# Warm-start snapshots of in-memory indexes (see warm_start.py)
+warm_start = SnapshotStore()
+
+def load_gallery_feed_snapshot(indexes: Dict):
+    for class_code, index in indexes.items():
+        gallery_feed.set_index(class_code, index["newest"], index["recent_for_top"])
+
+async def rebuild_photo_analysis_index(stale_items):
+    async with AsyncSessionLocal() as db:
+        await ensure_photo_analysis_index_loaded(db)
+
+async def rebuild_gallery_feed_indexes(stale_indexes):
+    # Only the classes that were warm before; others load on their first request as usual
+    for class_code in (stale_indexes or {}):
+        async with shard_router.session(shard_router.school_for_class_code(class_code)) as db:
+            await load_gallery_feed_index(class_code, db)
+
+warm_start.register(
+    "photo_analysis_index", ("food_entries",),
+    dump=lambda: photo_analysis_index.export_items() if photo_analysis_index.loaded else None,
+    # Older snapshots stored the analyses as dicts
+    load=lambda items: photo_analysis_index.load_items([
+        (photo_hash, analysis if isinstance(analysis, AnalysisRecord) else AnalysisRecord.from_mapping(analysis))
+        for photo_hash, analysis in items
+    ]),
+    rebuild=rebuild_photo_analysis_index
+)
+warm_start.register(
+    "gallery_feed", ("gallery_items", "users"),
+    dump=lambda: gallery_feed.export_indexes() or None,
+    load=load_gallery_feed_snapshot,
+    rebuild=rebuild_gallery_feed_indexes
+)
+
+async def read_db_change_counters() -> Dict[str, int]:
+    # Summed over the school databases; counters only grow, so a write to any of them changes the sum
+    totals: Dict[str, int] = {}
+    for school in shard_router.schools:
+        async with shard_router.engine(school).connect() as conn:
+            for table, version in (await conn.run_sync(read_change_counters)).items():
+                totals[table] = totals.get(table, 0) + version
+    return totals
+
+async def save_warm_start_snapshot():
+    try:
+        # Counters first: a write racing with the dump makes the snapshot look stale, never fresh
+        counters = await read_db_change_counters()
+        size = await asyncio.to_thread(warm_start.write, warm_start.collect(counters))
+        logging.info(f"Saved warm-start snapshot ({size} bytes).")
+    except Exception as e:
+        logging.error(f"Saving warm-start snapshot failed: {e}")
+
+async def load_warm_start_snapshot():
+    try:
+        counters = await read_db_change_counters()
+        snapshot = await asyncio.to_thread(warm_start.read)
+        stale_sections = warm_start.restore(snapshot, counters)
+    except Exception as e:
+        logging.error(f"Loading warm-start snapshot failed: {e}")
+        return
+    logging.info(f"Warm start: {warm_start.last_load}")
+    if stale_sections:
+        app.state.warm_start_rebuild = asyncio.create_task(warm_start.rebuild(stale_sections))
+
+async def run_snapshot_saver():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL_SECONDS)
+        await save_warm_start_snapshot()
+
+@api_router.get("/admin/warm-start")
+async def admin_get_warm_start(current_user: User = Depends(get_current_user)):
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return warm_start.stats()
+
+# Nightly and weekly maintenance (see scheduler.py); only the leader worker runs these
+SYNC_MUTATION_RETENTION_DAYS = 30
+BADGE_COUNTER_RETENTION_WEEKS = 8
+ANALYSIS_JOB_RETENTION_DAYS = 7
+
+async def roll_over_streaks(due: datetime) -> str:
+    """Students who logged nothing yesterday or today lose their streak: one UPDATE per database."""
+    cutoff = (datetime.utcnow().date() - timedelta(days=1)).strftime("%Y-%m-%d")
+
+    async def roll_over(db: AsyncSession, school: str) -> int:
+        result = await db.execute(
+            update(UserDb)
+            .where(UserDb.streak_days > 0, UserDb.last_entry_date.is_(None) | (UserDb.last_entry_date < cutoff))
+            .values(streak_days=0)
+        )
+        await db.commit()
+        return result.rowcount
+
+    reset = await shard_router.fan_out(roll_over)
+    return f"{sum(reset.values())} streaks reset"
+
+def iso_week_key(day: date) -> str:
+    year, week, _ = day.isocalendar()
+    return f"{year}-W{week:02d}"
+
+async def generate_weekly_class_reports(due: datetime) -> str:
+    """Stores last week's activity summary of every class, built like the class activity matrix."""
+    week_start = due.date() - timedelta(days=due.weekday() + 7)
+    week = iso_week_key(week_start)
+
+    async def classes_of(db: AsyncSession, school: str) -> List[str]:
+        codes = (await db.execute(
+            select(distinct(UserDb.class_code)).where(UserDb.role.not_in([USER_ROLES["TEACHER"], USER_ROLES["ADMIN"]]))
+        )).scalars().all()
+        # The default database lists every user; each school reports its own classes
+        return [code for code in codes if code and shard_router.school_for_class_code(code) == school]
+
+    class_codes = [code for codes in (await shard_router.fan_out(classes_of)).values() for code in codes]
+    for class_code in class_codes:
+        matrix = await load_class_activity(class_code, week_start, week_start + timedelta(days=6))
+        report = {"week": week, **matrix.summary()}
+        async with shard_router.session(shard_router.school_for_class_code(class_code)) as db:
+            await db.execute(
+                sqlite_insert(WeeklyClassReportDb)
+                .values(class_code=class_code, week=week, report=report, created_at=datetime.utcnow())
+                .on_conflict_do_update(
+                    index_elements=[WeeklyClassReportDb.class_code, WeeklyClassReportDb.week],
+                    set_={"report": report, "created_at": datetime.utcnow()}
+                )
+            )
+            await db.commit()
+    return f"{len(class_codes)} class reports for {week}"
+
+async def refresh_aggregates(due: datetime) -> str:
+    """Fresh query planner statistics on every database and a new warm-start snapshot."""
+    async def optimize(db: AsyncSession, school: str):
+        await db.execute(text("PRAGMA optimize"))
+
+    optimized = await shard_router.fan_out(optimize)
+    await save_warm_start_snapshot()
+    return f"optimized {len(optimized)} database(s), snapshot saved"
+
+async def compact_stores(due: datetime) -> str:
+    """Off-peak cleanup: expired sync keys and badge windows, merged search indexes."""
+    mutation_cutoff = datetime.utcnow() - timedelta(days=SYNC_MUTATION_RETENTION_DAYS)
+    today = datetime.utcnow().date()
+    day_cutoff = (today - timedelta(days=7)).isoformat()
+    week_cutoff = iso_week_key(today - timedelta(weeks=BADGE_COUNTER_RETENTION_WEEKS))
+
+    async def compact(db: AsyncSession, school: str) -> int:
+        removed = (await db.execute(delete(SyncMutationDb).where(SyncMutationDb.created_at < mutation_cutoff))).rowcount
+        # Counters of past day and week windows can never award a badge again
+        removed += (await db.execute(delete(BadgeCounterDb).where(
+            (BadgeCounterDb.window_key.op("GLOB", is_comparison=True)("[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]") & (BadgeCounterDb.window_key < day_cutoff))
+            | (BadgeCounterDb.window_key.op("GLOB", is_comparison=True)("[0-9][0-9][0-9][0-9]-W[0-9][0-9]") & (BadgeCounterDb.window_key < week_cutoff))
+        ))).rowcount
+        await (await db.connection()).run_sync(optimize_search_index)
+        await db.commit()
+        return removed
+
+    removed = await shard_router.fan_out(compact)
+    purged_jobs = await asyncio.to_thread(analysis_job_queue.purge_done, ANALYSIS_JOB_RETENTION_DAYS * 86400)
+    return f"{sum(removed.values())} expired rows removed, {purged_jobs} finished analysis jobs purged"
+
+async def reconcile_nutrition_ledger(due: datetime) -> str:
+    """
+    Rebuilds the ledger's recent days from the entries: backfills entries saved before the
+    ledger existed and corrects days whose entries were removed outside the app.
+    """
+    first_day = datetime.utcnow().date() - timedelta(days=LEDGER_RECONCILE_DAYS - 1)
+    window_start = datetime.combine(first_day, datetime.min.time())
+    entries_table = FoodEntryDb.__table__
+    backfill_stmt = (
+        entries_table.update()
+        .where(entries_table.c.id == bindparam("b_entry_id"))
+        .values(quantity_grams=bindparam("b_grams"), calories_estimated=bindparam("b_calories"))
+    )
+
+    async def rebuild(db: AsyncSession, school: str) -> int:
+        # Deleting first takes the write lock, so no new entry lands between the read and the rewrite
+        await db.execute(delete(NutritionLedgerDb).where(NutritionLedgerDb.day >= first_day.isoformat()))
+        entries = (await db.execute(
+            select(FoodEntryDb.id, FoodEntryDb.user_id, FoodEntryDb.timestamp, FoodEntryDb.food_name, FoodEntryDb.quantity,
+                   FoodEntryDb.quantity_grams, FoodEntryDb.calories_estimated, FoodEntryDb.nutrition_info)
+            .where(FoodEntryDb.timestamp >= window_start)
+        )).all()
+        totals: Dict[Tuple[str, str], Dict] = {}
+        backfill = []
+        for entry in entries:
+            grams = entry.quantity_grams if entry.quantity_grams is not None else parse_quantity_grams(entry.quantity, entry.food_name)
+            nutrition = entry_nutrition(grams, entry.nutrition_info)
+            if entry.quantity_grams is None or (nutrition and entry.calories_estimated is None):
+                backfill.append({"b_entry_id": entry.id, "b_grams": grams, "b_calories": nutrition[0] if nutrition else entry.calories_estimated})
+            day = totals.setdefault((entry.user_id, ledger_day(entry.timestamp)),
+                                    {"entries": 0, "analyzed": 0, "grams": 0.0, "calories": 0.0, "protein": 0.0})
+            day["entries"] += 1
+            day["grams"] += grams
+            if nutrition:
+                day["analyzed"] += 1
+                day["calories"] += nutrition[0]
+                day["protein"] += nutrition[1]
+        if backfill:
+            await db.execute(backfill_stmt, backfill)
+        if totals:
+            await db.execute(insert(NutritionLedgerDb), [
+                {"user_id": user_id, "day": day, **values} for (user_id, day), values in totals.items()
+            ])
+        await db.commit()
+        return len(totals)
+
+    rebuilt = await shard_router.fan_out(rebuild)
+    return f"{sum(rebuilt.values())} ledger days rebuilt since {first_day.isoformat()}"
+
+job_scheduler = JobScheduler([
+    Job("streak_rollover", Daily(0, 5), roll_over_streaks,
+        description="Reset the streaks of students without an entry yesterday or today"),
+    Job("weekly_class_reports", Weekly(0, 1, 0), generate_weekly_class_reports,
+        description="Summarize last week's activity of every class"),
+    Job("nutrition_ledger_reconcile", Daily(2, 30), reconcile_nutrition_ledger,
+        description="Rebuild the last days of the nutrition ledger from the food entries"),
+    Job("refresh_aggregates", Daily(3, 0), refresh_aggregates, catch_up_hours=3,
+        description="Refresh query planner statistics and the warm-start snapshot"),
+    Job("compact_stores", Daily(3, 30), compact_stores, catch_up_hours=3,
+        description="Purge expired rows and compact the search indexes"),
+])
+
+@api_router.get("/analytics/weekly-reports")
+async def get_weekly_class_reports(class_code: Optional[str] = None, weeks: int = 8, current_user: User = Depends(get_current_user)):
+    """The newest stored weekly reports of a class."""
+    class_code = staff_class_code(current_user, class_code)
+    async with shard_router.session(shard_router.school_for_class_code(class_code)) as db:
+        result = await db.execute(
+            select(WeeklyClassReportDb.report)
+            .where(WeeklyClassReportDb.class_code == class_code)
+            .order_by(WeeklyClassReportDb.week.desc())
+            .limit(max(1, min(weeks, 52)))
+        )
+        return result.scalars().all()
+
+@api_router.get("/admin/scheduler")
+async def admin_get_scheduler(current_user: User = Depends(get_current_user)):
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return await job_scheduler.status()
+
+# Live memory report (see memory_stats.py); soak_test.py samples it
+allocation_stats = AllocationStats()
+allocation_stats.track("user_school_cache", lambda: len(user_school_cache))
+allocation_stats.track("class_activity", class_activity_cache.stats)
+allocation_stats.track("gallery_feed", gallery_feed.stats)
+allocation_stats.track("photo_analysis_index", photo_analysis_index.stats)
+
+@api_router.get("/admin/memory")
+async def admin_get_memory(
+    limit: int = DEFAULT_TOP_ALLOCATORS,
+    group_by: str = "lineno",
+    full_gc: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    RSS, cache sizes and (with tracemalloc on) the top allocators of the worker that answers.
+    full_gc=true collects garbage and counts tracked objects first, which pauses the worker.
+    """
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    caches = allocation_stats.cache_sizes()  # On the loop, where the caches are updated
+    try:
+        return await asyncio.to_thread(allocation_stats.snapshot, max(1, min(limit, 200)), group_by, caches, full_gc)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.post("/admin/memory/baseline")
+async def admin_reset_memory_baseline(current_user: User = Depends(get_current_user)):
+    """Growth in GET /admin/memory is measured from here on."""
+    if current_user.role != USER_ROLES["ADMIN"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    await asyncio.to_thread(allocation_stats.reset_baseline)
+    return {"pid": os.getpid(), "message": "Memory baseline reset"}
+
 # Include the router in the main app
 async def create_db_and_tables():
-    async with async_engine.begin() as conn:
-        # For development, you might want to drop tables first (use with caution):
-        # await conn.run_sync(Base.metadata.drop_all)
-        await conn.run_sync(Base.metadata.create_all)
+    for school in shard_router.schools:
+        async with shard_router.engine(school).begin() as conn:
+            # For development, you might want to drop tables first (use with caution):
+            # await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(add_missing_columns_and_indexes)
+            await conn.run_sync(install_search_index)
+            await conn.run_sync(install_change_counters, warm_start.tracked_tables)
+            if school == DEFAULT_SCHOOL:
+                await conn.run_sync(install_archive_progress)
+                await conn.run_sync(sync_archive_schemas)
     logging.info("Database tables created (if they didn't exist).")
 
 @app.on_event("startup")
 async def on_startup():
     logging.info("Application startup: creating database and tables...")
+    allocation_stats.start()  # First, so tracemalloc sees the startup allocations too
     await create_db_and_tables()
+    await load_warm_start_snapshot()  # Before serving, so the first requests hit warm indexes
+    analysis_worker_pool.start()
+    await enqueue_orphaned_analyses()
+    await invalidation_bus.start()
+    job_scheduler.start()
+    app.state.gallery_like_flusher = asyncio.create_task(run_gallery_like_flusher())
+    app.state.snapshot_saver = asyncio.create_task(run_snapshot_saver())
     logging.info("Application startup complete.")
 
 # Include the router in the main app
@@ -1116,6 +3146,18 @@ logger = logging.getLogger(__name__)
 @app.on_event("shutdown")
 async def on_shutdown():
     logging.info("Application shutdown.")
+    await job_scheduler.stop()
+    await analysis_worker_pool.stop()
+    await food_analysis_calls.stop()
+    app.state.gallery_like_flusher.cancel()
+    app.state.snapshot_saver.cancel()
+    await flush_gallery_likes()
+    await save_warm_start_snapshot()  # After the like flush, so the feed snapshot includes it
+    await invalidation_bus.stop()
+    execution_lanes.shutdown()
+    password_hasher.shutdown()
+    await shard_router.dispose()
+    allocation_stats.stop()
     # The SQLAlchemy async_engine does not require explicit closing here in the same way Motor client did.
     # Connections are managed by the pool and sessions.
     pass
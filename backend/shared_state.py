@@ -0,0 +1,215 @@
+"""
+Coordination between uvicorn worker processes (``--workers N``).
+
+* shared_store_lock(name): an OS file lock (fcntl.flock) around the
+  load -> modify -> save sequences on the JSON stores, so two workers can no
+  longer overwrite each other's changes. A per-process asyncio lock is taken
+  first so waiting requests don't tie up threads. Reads take the lock shared
+  (exclusive=False), so they never see a half-written store.
+* InvalidationBus: a change counter per topic in a small shared SQLite file
+  (or Redis, when SNACKCHECK_REDIS_URL is set and the redis package is
+  installed). Every worker polls it and drops its local caches for topics
+  another worker bumped.
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import sqlite3
+from contextlib import asynccontextmanager, closing
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+SHARED_STATE_DIR = Path(os.environ.get("SNACKCHECK_SHARED_STATE_DIR", Path(__file__).parent / ".shared_state"))
+INVALIDATION_DB = SHARED_STATE_DIR / "invalidation.db"
+REDIS_URL = os.environ.get("SNACKCHECK_REDIS_URL")
+INVALIDATION_POLL_SECONDS = 0.5
+
+_process_locks: Dict[str, asyncio.Lock] = {}
+
+
+def _lock_path(store_name: str) -> Path:
+    SHARED_STATE_DIR.mkdir(parents=True, exist_ok=True)
+    return SHARED_STATE_DIR / f"{store_name}.lock"
+
+
+def _acquire_file_lock(path: Path, exclusive: bool) -> int:
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def _release_file_lock(fd: int):
+    try:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def _release_abandoned_lock(acquire: asyncio.Future):
+    if not acquire.cancelled() and acquire.exception() is None:
+        _release_file_lock(acquire.result())
+
+
+async def _acquire(store_name: str, exclusive: bool) -> int:
+    acquire = asyncio.ensure_future(asyncio.to_thread(_acquire_file_lock, _lock_path(store_name), exclusive))
+    try:
+        return await asyncio.shield(acquire)
+    except asyncio.CancelledError:
+        # The thread goes on and takes the lock anyway; give it back as soon as it has it
+        acquire.add_done_callback(_release_abandoned_lock)
+        raise
+
+
+@asynccontextmanager
+async def shared_store_lock(store_name: str, exclusive: bool = True):
+    """
+    Serializes writes to a JSON store across requests and worker processes.
+    Shared (read) holders skip the process lock and only wait for writers.
+    """
+    if not exclusive:
+        fd = await _acquire(store_name, exclusive)
+        try:
+            yield
+        finally:
+            _release_file_lock(fd)
+        return
+    process_lock = _process_locks.setdefault(store_name, asyncio.Lock())
+    async with process_lock:
+        fd = await _acquire(store_name, exclusive)
+        try:
+            yield
+        finally:
+            _release_file_lock(fd)
+
+
+class SqliteChangeCounters:
+    """Topic -> version counters in a shared SQLite file."""
+
+    def __init__(self, db_path: Path = INVALIDATION_DB):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS change_counters (topic TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA busy_timeout = 30000")
+        return conn
+
+    def bump(self, topic: str) -> int:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "INSERT INTO change_counters (topic, version) VALUES (?, 1) "
+                "ON CONFLICT(topic) DO UPDATE SET version = version + 1 RETURNING version",
+                (topic,),
+            ).fetchone()
+        return row[0]
+
+    def versions(self) -> Dict[str, int]:
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT topic, version FROM change_counters").fetchall())
+
+
+class RedisChangeCounters:
+    """Same interface as SqliteChangeCounters, backed by Redis INCR."""
+
+    KEY_PREFIX = "snackcheck:changes:"
+
+    def __init__(self, url: str):
+        self.client = redis.Redis.from_url(url)
+
+    def bump(self, topic: str) -> int:
+        return int(self.client.incr(self.KEY_PREFIX + topic))
+
+    def versions(self) -> Dict[str, int]:
+        keys = list(self.client.scan_iter(match=self.KEY_PREFIX + "*"))
+        if not keys:
+            return {}
+        values = self.client.mget(keys)
+        return {
+            key.decode()[len(self.KEY_PREFIX):]: int(value)
+            for key, value in zip(keys, values) if value is not None
+        }
+
+
+def create_change_counters():
+    if REDIS_URL:
+        if redis is not None:
+            return RedisChangeCounters(REDIS_URL)
+        logging.warning("SNACKCHECK_REDIS_URL is set but the redis package is not installed; using SQLite counters.")
+    return SqliteChangeCounters()
+
+
+class InvalidationBus:
+    """
+    Cross-process cache invalidation. Subscribers register a topic prefix and get
+    called with the full topic when another process bumps it.
+    """
+
+    def __init__(self, counters=None, poll_seconds: float = INVALIDATION_POLL_SECONDS):
+        self.counters = counters or create_change_counters()
+        self.poll_seconds = poll_seconds
+        self._seen: Dict[str, int] = {}
+        self._subscribers: List[Tuple[str, Callable[[str], None]]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._baselined = False
+
+    def subscribe(self, topic_prefix: str, callback: Callable[[str], None]):
+        self._subscribers.append((topic_prefix, callback))
+
+    def _dispatch(self, topic: str):
+        for prefix, callback in self._subscribers:
+            if topic.startswith(prefix):
+                try:
+                    callback(topic)
+                except Exception as e:
+                    logging.error(f"Invalidation callback for {topic} failed: {e}")
+
+    async def publish(self, topic: str):
+        """Tells the other workers that data behind `topic` changed."""
+        previous = self._seen.get(topic, 0)
+        version = await asyncio.to_thread(self.counters.bump, topic)
+        # Only skip our own bump if nobody else bumped in between; otherwise let poll() handle it
+        if version == previous + 1:
+            self._seen[topic] = version
+
+    def poll(self) -> List[str]:
+        """Blocking: returns topics changed by other processes since the last poll."""
+        changed = []
+        for topic, version in self.counters.versions().items():
+            if self._seen.get(topic) != version:
+                if topic in self._seen or self._baselined:
+                    changed.append(topic)
+                self._seen[topic] = version
+        return changed
+
+    async def _run(self):
+        while True:
+            try:
+                for topic in await asyncio.to_thread(self.poll):
+                    self._dispatch(topic)
+            except Exception as e:
+                logging.error(f"Invalidation bus poll failed: {e}")
+            await asyncio.sleep(self.poll_seconds)
+
+    async def start(self):
+        await asyncio.to_thread(self.poll)  # Baseline versions, so startup doesn't invalidate everything
+        self._baselined = True
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,390 @@
+"""
+Soak test: a synthetic classroom against a running server for hours.
+
+Virtual students log in and browse, post photos and chat; a teacher per class
+watches the dashboard and exports. Meanwhile the harness samples the worker's
+memory through GET /api/admin/memory (RSS, cache sizes, top tracemalloc
+allocators) and keeps per-endpoint latencies per time window. At the end it
+checks the budgets and exits with status 1 if any is exceeded:
+
+* p95 latency per endpoint;
+* latency drift: p95 of the last window over the first one;
+* RSS growth per hour after warm-up (least-squares slope over the samples);
+* memory retained per request, per endpoint: a probe runs each endpoint
+  alone between two tracemalloc baselines, before and after the soak;
+* error rate (429 throttling from the rate limiter is not an error).
+
+Start the server with one worker, so every memory sample and probe sees the
+same process, and with tracemalloc on for the retention probes:
+
+    SNACKCHECK_TRACEMALLOC_FRAMES=1 uvicorn server:app --port 8001 --workers 1
+    python soak_test.py --admin-username admin --admin-password ... [--hours 4]
+        [--classes 2 --students 25] [--budgets budgets.json] [--report soak_report.json]
+
+Budgets default to DEFAULT_BUDGETS; a JSON file with the same shape overrides
+any part of it. Soak users are created in classes SOAK<run id><n> and deleted
+again at the end unless --keep-users is given.
+"""
+import argparse
+import io
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+from PIL import Image
+
+DEFAULT_BUDGETS = {
+    "default": {"p95_ms": 500, "retained_bytes_per_request": 4096},
+    "endpoints": {
+        "POST /api/food-entries/upload": {"p95_ms": 2000, "retained_bytes_per_request": 8192},
+        "GET /api/export/food-entries": {"p95_ms": 5000},
+        "GET /api/analytics/class-activity": {"p95_ms": 1000},
+        "POST /api/login": {"p95_ms": 1500},
+    },
+    "max_latency_drift": 1.5,
+    "max_rss_growth_mb_per_hour": 32,
+    "max_error_rate": 0.01,
+}
+LATENCY_WINDOW_SECONDS = 300
+MIN_WINDOW_SAMPLES = 20
+WARMUP_SECONDS = 120
+PROBE_REQUESTS = 200
+THINK_TIME_SECONDS = (0.5, 3.0)
+REQUEST_TIMEOUT_SECONDS = 60
+
+
+def merge_budgets(overrides: Dict) -> Dict:
+    budgets = json.loads(json.dumps(DEFAULT_BUDGETS))
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(budgets.get(key), dict):
+            for name, limits in value.items():
+                budgets[key][name] = {**budgets[key].get(name, {}), **limits} if isinstance(limits, dict) else limits
+        else:
+            budgets[key] = value
+    return budgets
+
+
+def budget_for(budgets: Dict, endpoint: str, name: str):
+    return budgets["endpoints"].get(endpoint, {}).get(name, budgets["default"].get(name))
+
+
+def p95(values: List[float]) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, int(len(ordered) * 0.95) - 1)]
+
+
+def snack_photo() -> bytes:
+    """A small JPEG with random colours, so photo dedupe doesn't short-circuit every upload."""
+    image = Image.new("RGB", (64, 64), tuple(random.randint(0, 255) for _ in range(3)))
+    for _ in range(8):
+        x, y = random.randint(0, 56), random.randint(0, 56)
+        image.paste(tuple(random.randint(0, 255) for _ in range(3)), (x, y, x + 8, y + 8))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=80)
+    return buffer.getvalue()
+
+
+class Recorder:
+    """Latencies per endpoint and time window, plus status counts. Thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.monotonic()
+            self.windows: Dict[str, Dict[int, List[float]]] = defaultdict(lambda: defaultdict(list))
+            self.statuses: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint: str, elapsed_ms: float, status: str):
+        window = int((time.monotonic() - self.started) // LATENCY_WINDOW_SECONDS)
+        with self._lock:
+            self.statuses[endpoint][status] += 1
+            if status == "ok":
+                self.windows[endpoint][window].append(elapsed_ms)
+
+    def latencies(self, endpoint: str) -> List[float]:
+        return [value for values in self.windows[endpoint].values() for value in values]
+
+
+class Client:
+    def __init__(self, base_url: str, recorder: Recorder):
+        self.base_url = base_url.rstrip("/")
+        self.recorder = recorder
+        self.session = requests.Session()
+        self.token: Optional[str] = None
+
+    def call(self, method: str, path: str, **kwargs) -> Optional[requests.Response]:
+        endpoint = f"{method} {path.split('?')[0]}"
+        if self.token:
+            kwargs.setdefault("headers", {})["Authorization"] = f"Bearer {self.token}"
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=REQUEST_TIMEOUT_SECONDS, **kwargs)
+            if method == "GET":
+                _ = response.content  # Streaming exports count until the last byte
+        except requests.RequestException:
+            self.recorder.record(endpoint, (time.perf_counter() - started) * 1000, "error")
+            return None
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if response.status_code == 429 or response.status_code == 503:
+            status = "throttled"
+        elif response.status_code < 400:
+            status = "ok"
+        else:
+            status = "error"
+        self.recorder.record(endpoint, elapsed_ms, status)
+        return response
+
+    def login(self, username: str, password: str):
+        response = self.call("POST", "/api/login", json={"username": username, "password": password})
+        if response is None or response.status_code != 200:
+            raise RuntimeError(f"Login of {username} failed: {response.status_code if response is not None else 'no response'}")
+        self.token = response.json()["token"]
+
+
+def student_actions(client: Client, class_code: str) -> List[tuple]:
+    """(weight, endpoint, action) for one virtual student."""
+    return [
+        (5, "GET /api/leaderboard", lambda: client.call("GET", "/api/leaderboard")),
+        (5, "GET /api/gallery/feed", lambda: client.call(
+            "GET", f"/api/gallery/feed?kind={random.choice(['newest', 'top_week'])}&page={random.randint(0, 2)}")),
+        (3, "GET /api/analytics/user-stats", lambda: client.call("GET", "/api/analytics/user-stats")),
+        (3, "GET /api/daily-questions/today", lambda: client.call("GET", "/api/daily-questions/today")),
+        (3, "GET /api/chat/messages", lambda: client.call("GET", "/api/chat/messages")),
+        (2, "POST /api/sync", lambda: client.call("POST", "/api/sync", json={"mutations": [{
+            "idempotency_key": uuid.uuid4().hex, "type": "chat_message", "payload": {"message": "Ik eet een appel!"}
+        }]})),
+        (1, "POST /api/food-entries/upload", lambda: client.call("POST", "/api/food-entries/upload", data={
+            "food_name": random.choice(["appel", "banaan", "wortel", "boterham", "koek"]),
+            "meal_type": "snack", "quantity": random.choice(["1 stuk", "150 g", "2 plakjes"]),
+        }, files={"image": ("snack.jpg", snack_photo(), "image/jpeg")})),
+    ]
+
+
+def teacher_actions(client: Client, class_code: str) -> List[tuple]:
+    return [
+        (4, "GET /api/analytics/class-activity", lambda: client.call("GET", f"/api/analytics/class-activity?class_code={class_code}")),
+        (3, "GET /api/analytics/class-summary", lambda: client.call("GET", "/api/analytics/class-summary")),
+        (2, "GET /api/gallery/feed", lambda: client.call("GET", f"/api/gallery/feed?class_code={class_code}")),
+        (1, "GET /api/export/food-entries", lambda: client.call("GET", f"/api/export/food-entries?class_code={class_code}&format=csv")),
+    ]
+
+
+def virtual_user(client: Client, actions: List[tuple], stop: threading.Event):
+    weights = [weight for weight, _, _ in actions]
+    callables = [action for _, _, action in actions]
+    while not stop.is_set():
+        random.choices(callables, weights)[0]()
+        stop.wait(random.uniform(*THINK_TIME_SECONDS))
+
+
+class Soak:
+    def __init__(self, args, budgets: Dict):
+        self.args = args
+        self.budgets = budgets
+        self.recorder = Recorder()
+        self.admin = Client(args.base_url, self.recorder)
+        self.run_id = uuid.uuid4().hex[:4].upper()
+        self.users: List[Dict] = []  # {"id", "username", "password", "class_code", "teacher"}
+        self.memory_samples: List[Dict] = []
+        self.probes: Dict[str, Dict[str, Optional[float]]] = defaultdict(dict)
+
+    def memory(self) -> Dict:
+        response = self.admin.call("GET", "/api/admin/memory?limit=10&full_gc=true")
+        if response is None or response.status_code != 200:
+            raise RuntimeError("GET /api/admin/memory failed; is this an admin account on a server with memory stats?")
+        return response.json()
+
+    def create_users(self):
+        for class_index in range(self.args.classes):
+            class_code = f"SOAK{self.run_id}{class_index}"
+            for index in range(self.args.students + 1):
+                teacher = index == self.args.students
+                user = {
+                    "username": f"soak_{'teacher' if teacher else 'student'}_{class_index}_{index}",
+                    "password": uuid.uuid4().hex, "class_code": class_code, "teacher": teacher,
+                }
+                response = self.admin.call("POST", "/api/admin/create-user", json={
+                    "username": user["username"], "password": user["password"], "class_code": class_code,
+                    "role": "teacher" if teacher else "student_class_1",
+                })
+                if response is None or response.status_code >= 400:
+                    raise RuntimeError(f"Creating {user['username']} failed: {response.text if response is not None else 'no response'}")
+                user["id"] = response.json()["user"]["id"]
+                self.users.append(user)
+        print(f"Created {len(self.users)} users in {self.args.classes} class(es) SOAK{self.run_id}*")
+
+    def delete_users(self):
+        for user in self.users:
+            self.admin.call("DELETE", f"/api/admin/users/{user['id']}")
+
+    def probe(self, label: str, student: Client, teacher: Client):
+        """Per endpoint: requests run alone between two baselines; retained bytes per request."""
+        class_code = self.users[0]["class_code"]
+        actions = {}
+        for _, endpoint, action in student_actions(student, class_code) + teacher_actions(teacher, class_code):
+            actions.setdefault(endpoint, action)
+        for endpoint, action in actions.items():
+            self.admin.call("POST", "/api/admin/memory/baseline")
+            for _ in range(self.args.probe_requests):
+                action()
+            report = self.memory()
+            traced = report.get("tracemalloc", {})
+            # Without tracemalloc only RSS is available, which is much noisier
+            growth = traced.get("traced_growth_bytes") if traced.get("tracing") else report["rss_growth_bytes"]
+            self.probes[endpoint][label] = growth / self.args.probe_requests
+            print(f"  probe {label:6} {endpoint:40} {growth / self.args.probe_requests:10.0f} B/request")
+
+    def start_users(self, clients: List[tuple], stop: threading.Event) -> ThreadPoolExecutor:
+        pool = ThreadPoolExecutor(max_workers=len(clients))
+        for client, user in clients:
+            make = teacher_actions if user["teacher"] else student_actions
+            pool.submit(virtual_user, client, make(client, user["class_code"]), stop)
+        return pool
+
+    def sample_memory(self):
+        sample = {**self.memory(), "t_hours": (time.monotonic() - self.recorder.started) / 3600}
+        self.memory_samples.append(sample)
+        print(f"  {sample['t_hours']:6.2f} h  rss {sample['rss_bytes'] / 2**20:8.1f} MB  caches {json.dumps(sample['caches'])[:120]}")
+
+    def run(self) -> Dict:
+        self.admin.login(self.args.admin_username, self.args.admin_password)
+        self.create_users()
+        clients = []
+        for user in self.users:
+            client = Client(self.args.base_url, self.recorder)
+            client.login(user["username"], user["password"])
+            clients.append((client, user))
+        student = next(client for client, user in clients if not user["teacher"])
+        teacher = next(client for client, user in clients if user["teacher"])
+
+        print(f"Warming up for {self.args.warmup_seconds:g} s")
+        stop = threading.Event()
+        pool = self.start_users(clients, stop)
+        time.sleep(self.args.warmup_seconds)
+        stop.set()
+        pool.shutdown(wait=True)
+        print("Retention probes (before)")
+        self.probe("before", student, teacher)
+
+        print(f"Soaking for {self.args.hours:g} h")
+        self.recorder.reset()  # Latency windows start after warm-up
+        stop = threading.Event()
+        pool = self.start_users(clients, stop)
+        try:
+            deadline = time.monotonic() + self.args.hours * 3600
+            while time.monotonic() < deadline:
+                self.sample_memory()
+                stop.wait(min(self.args.sample_minutes * 60, max(0.0, deadline - time.monotonic())))
+            self.sample_memory()
+        finally:
+            stop.set()
+            pool.shutdown(wait=True)
+
+        print("Retention probes (after)")
+        self.probe("after", student, teacher)
+        if not self.args.keep_users:
+            self.delete_users()
+        return self.verdict()
+
+    def verdict(self) -> Dict:
+        failures = []
+        endpoints = {}
+        total = errors = 0
+        for endpoint, statuses in sorted(self.recorder.statuses.items()):
+            latencies = self.recorder.latencies(endpoint)
+            windows = sorted(window for window, values in self.recorder.windows[endpoint].items() if len(values) >= MIN_WINDOW_SAMPLES)
+            result = {
+                "requests": sum(statuses.values()), "statuses": dict(statuses),
+                "p50_ms": statistics.median(latencies) if latencies else None,
+                "p95_ms": p95(latencies) if latencies else None,
+                "retained_bytes_per_request": self.probes.get(endpoint, {}),
+            }
+            total += result["requests"]
+            errors += statuses.get("error", 0)
+            p95_budget = budget_for(self.budgets, endpoint, "p95_ms")
+            if result["p95_ms"] is not None and p95_budget is not None and result["p95_ms"] > p95_budget:
+                failures.append(f"{endpoint}: p95 {result['p95_ms']:.0f} ms > {p95_budget} ms")
+            if len(windows) >= 2:
+                first, last = p95(self.recorder.windows[endpoint][windows[0]]), p95(self.recorder.windows[endpoint][windows[-1]])
+                result["latency_drift"] = last / first if first else None
+                if result["latency_drift"] and result["latency_drift"] > self.budgets["max_latency_drift"]:
+                    failures.append(f"{endpoint}: p95 drifted from {first:.0f} to {last:.0f} ms")
+            retained_budget = budget_for(self.budgets, endpoint, "retained_bytes_per_request")
+            retained = self.probes.get(endpoint, {}).get("after")
+            if retained is not None and retained_budget is not None and retained > retained_budget:
+                failures.append(f"{endpoint}: retains {retained:.0f} B/request > {retained_budget} B")
+            endpoints[endpoint] = result
+
+        rss_slope = None
+        if len(self.memory_samples) >= 3:
+            hours = [sample["t_hours"] for sample in self.memory_samples]
+            rss_mb = [sample["rss_bytes"] / 2**20 for sample in self.memory_samples]
+            rss_slope = statistics.linear_regression(hours, rss_mb).slope
+            if rss_slope > self.budgets["max_rss_growth_mb_per_hour"]:
+                failures.append(f"RSS grows {rss_slope:.1f} MB/hour > {self.budgets['max_rss_growth_mb_per_hour']} MB/hour")
+        if len({sample["pid"] for sample in self.memory_samples}) > 1:
+            failures.append("Memory samples came from more than one worker process; run the server with --workers 1")
+        error_rate = errors / total if total else 0.0
+        if error_rate > self.budgets["max_error_rate"]:
+            failures.append(f"error rate {error_rate:.2%} > {self.budgets['max_error_rate']:.2%}")
+
+        return {
+            "passed": not failures,
+            "failures": failures,
+            "hours": self.args.hours,
+            "users": len(self.users),
+            "error_rate": error_rate,
+            "rss_growth_mb_per_hour": rss_slope,
+            "endpoints": endpoints,
+            "memory_samples": [
+                {key: sample.get(key) for key in ("t_hours", "pid", "rss_bytes", "caches")}
+                | {"top_growth": sample.get("tracemalloc", {}).get("top_growth", [])[:5]}
+                for sample in self.memory_samples
+            ],
+            "budgets": self.budgets,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak-test a running SnackCheck server against memory and latency budgets.")
+    parser.add_argument("--base-url", default="http://localhost:8001")
+    parser.add_argument("--admin-username", required=True)
+    parser.add_argument("--admin-password", required=True)
+    parser.add_argument("--hours", type=float, default=4.0)
+    parser.add_argument("--classes", type=int, default=2)
+    parser.add_argument("--students", type=int, default=25, help="Students per class (plus one teacher)")
+    parser.add_argument("--sample-minutes", type=float, default=5.0)
+    parser.add_argument("--warmup-seconds", type=float, default=WARMUP_SECONDS)
+    parser.add_argument("--probe-requests", type=int, default=PROBE_REQUESTS)
+    parser.add_argument("--budgets", default=None, help="JSON file overriding DEFAULT_BUDGETS")
+    parser.add_argument("--report", default="soak_report.json")
+    parser.add_argument("--keep-users", action="store_true")
+    args = parser.parse_args()
+
+    overrides = {}
+    if args.budgets:
+        with open(args.budgets) as f:
+            overrides = json.load(f)
+    report = Soak(args, merge_budgets(overrides)).run()
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+
+    print(f"\n{'PASSED' if report['passed'] else 'FAILED'} after {args.hours:g} h; report in {args.report}")
+    for failure in report["failures"]:
+        print(f"  - {failure}")
+    sys.exit(0 if report["passed"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Per-school database shards and the tenant-aware session router.
+
+Each school can get its own SQLite database: its own file, write lock, journal and
+connection pool, so one school's load and lock contention stays there and
+schools use cores and disks in parallel. SHARDS_FILE maps schools to their
+database and class codes to schools:
+
+    {"schools": {"dalton": {"database": "shards/dalton.db",
+                            "class_code_prefixes": ["DAL"], "class_codes": []}}}
+
+Class codes no school claims (and the admin accounts) stay on the default
+database. The default database also keeps every user's login record and acts
+as the directory that tells which school a user belongs to. Without a shards
+file everything runs on the default database, exactly as before.
+
+add_school_shard.py onboards a school: it creates the shard, moves the
+school's rows over and publishes the new map to the running servers.
+"""
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+DEFAULT_SCHOOL = "default"
+SHARDS_FILE = Path(os.environ.get("SNACKCHECK_SHARDS_FILE", Path(__file__).parent / "shards.json"))
+# Per-school connection pool caps, so a busy school can't hold every connection
+SHARD_POOL_SIZE = int(os.environ.get("SNACKCHECK_SHARD_POOL_SIZE", "5"))
+SHARD_MAX_OVERFLOW = int(os.environ.get("SNACKCHECK_SHARD_MAX_OVERFLOW", "5"))
+SHARD_POOL_TIMEOUT_SECONDS = float(os.environ.get("SNACKCHECK_SHARD_POOL_TIMEOUT_SECONDS", "10"))
+
+
+class TenantMap:
+    """Which school a class code belongs to, and where each school's database is."""
+
+    def __init__(self, schools: Optional[Dict[str, Dict]] = None):
+        self.schools: Dict[str, Dict] = {}
+        self._by_class_code: Dict[str, str] = {}
+        self._prefixes: List[tuple] = []
+        for school, config in (schools or {}).items():
+            if school == DEFAULT_SCHOOL:
+                raise ValueError(f"{DEFAULT_SCHOOL!r} is reserved for the default database")
+            self.schools[school] = {
+                "database": config["database"],
+                "class_codes": [code.upper() for code in config.get("class_codes", [])],
+                "class_code_prefixes": [prefix.upper() for prefix in config.get("class_code_prefixes", [])],
+            }
+            for code in self.schools[school]["class_codes"]:
+                self._by_class_code[code] = school
+            self._prefixes += [(prefix, school) for prefix in self.schools[school]["class_code_prefixes"]]
+        self._prefixes.sort(key=lambda item: len(item[0]), reverse=True)  # Longest prefix wins
+
+    @classmethod
+    def load(cls, path: Path = SHARDS_FILE) -> "TenantMap":
+        try:
+            with open(path) as f:
+                return cls(json.load(f).get("schools", {}))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, path: Path = SHARDS_FILE):
+        path = Path(path)
+        tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+        with open(tmp_path, "w") as f:
+            json.dump({"schools": self.schools}, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def with_school(self, school: str, database: str, class_codes: Iterable[str] = (),
+                    class_code_prefixes: Iterable[str] = ()) -> "TenantMap":
+        """A copy with a school added (or its class codes extended); checks that no class code is claimed twice."""
+        schools = {name: dict(config) for name, config in self.schools.items()}
+        current = schools.get(school, {"database": database, "class_codes": [], "class_code_prefixes": []})
+        current["database"] = database
+        current["class_codes"] = sorted(set(current["class_codes"]) | {code.upper() for code in class_codes})
+        current["class_code_prefixes"] = sorted(set(current["class_code_prefixes"]) | {p.upper() for p in class_code_prefixes})
+        for code in current["class_codes"]:
+            owner = self._by_class_code.get(code)
+            if owner not in (None, school):
+                raise ValueError(f"Class code {code} already belongs to {owner}")
+        schools[school] = current
+        return TenantMap(schools)
+
+    def school_for_class_code(self, class_code: Optional[str]) -> str:
+        if not class_code:
+            return DEFAULT_SCHOOL
+        code = class_code.upper()
+        if code in self._by_class_code:
+            return self._by_class_code[code]
+        for prefix, school in self._prefixes:
+            if code.startswith(prefix):
+                return school
+        return DEFAULT_SCHOOL
+
+    def class_code_filter(self, school: str):
+        """(exact codes, prefixes) of a school, for selecting its users in SQL."""
+        config = self.schools[school]
+        return config["class_codes"], config["class_code_prefixes"]
+
+    def database_url(self, school: str) -> str:
+        return f"sqlite+aiosqlite:///{self.schools[school]['database']}"
+
+
+def create_shard_engine(url: str) -> AsyncEngine:
+    return create_async_engine(
+        url, pool_size=SHARD_POOL_SIZE, max_overflow=SHARD_MAX_OVERFLOW, pool_timeout=SHARD_POOL_TIMEOUT_SECONDS
+    )
+
+
+class ShardRouter:
+    """Hands out sessions for a school's database; engines are created on first use."""
+
+    def __init__(self, default_engine: AsyncEngine, tenant_map: Optional[TenantMap] = None,
+                 engine_factory: Callable[[str], AsyncEngine] = create_shard_engine):
+        self.tenant_map = tenant_map or TenantMap()
+        self._engine_factory = engine_factory
+        self._engines: Dict[str, AsyncEngine] = {DEFAULT_SCHOOL: default_engine}
+        self._sessionmakers: Dict[str, async_sessionmaker] = {}
+
+    @property
+    def schools(self) -> List[str]:
+        return [DEFAULT_SCHOOL] + sorted(self.tenant_map.schools)
+
+    @property
+    def sharded(self) -> bool:
+        return bool(self.tenant_map.schools)
+
+    async def reload(self, tenant_map: TenantMap):
+        """Switches to a new map; engines of schools that moved database are closed."""
+        self.tenant_map = tenant_map
+        for school in list(self._engines):
+            if school == DEFAULT_SCHOOL:
+                continue
+            engine = self._engines[school]
+            if school not in tenant_map.schools or str(engine.url) != tenant_map.database_url(school):
+                del self._engines[school]
+                self._sessionmakers.pop(school, None)
+                await engine.dispose()
+
+    def school_for_class_code(self, class_code: Optional[str]) -> str:
+        return self.tenant_map.school_for_class_code(class_code)
+
+    def engine(self, school: str) -> AsyncEngine:
+        if school not in self._engines:
+            if school not in self.tenant_map.schools:
+                raise KeyError(f"Unknown school {school!r}")
+            self._engines[school] = self._engine_factory(self.tenant_map.database_url(school))
+        return self._engines[school]
+
+    def session(self, school: str = DEFAULT_SCHOOL) -> AsyncSession:
+        if school not in self._sessionmakers:
+            self._sessionmakers[school] = async_sessionmaker(bind=self.engine(school), class_=AsyncSession, expire_on_commit=False)
+        session = self._sessionmakers[school]()
+        session.info["school"] = school
+        return session
+
+    async def fan_out(self, fn: Callable[[AsyncSession, str], Awaitable], schools: Optional[Iterable[str]] = None) -> Dict:
+        """
+        Runs fn(session, school) on every shard concurrently (each on its own database)
+        and returns {school: result}. A failing shard is logged and left out.
+        """
+        async def run(school: str):
+            async with self.session(school) as session:
+                return await fn(session, school)
+
+        targets = list(schools) if schools is not None else self.schools
+        results = await asyncio.gather(*(run(school) for school in targets), return_exceptions=True)
+        by_school = {}
+        for school, result in zip(targets, results):
+            if isinstance(result, Exception):
+                logging.error(f"Cross-shard query on {school} failed: {result}")
+                continue
+            by_school[school] = result
+        return by_school
+
+    async def locate(self, fn: Callable[[AsyncSession, str], Awaitable]) -> Optional[str]:
+        """The first school (default first) for which fn(session, school) returns something truthy."""
+        for school in self.schools:
+            async with self.session(school) as session:
+                if await fn(session, school):
+                    return school
+        return None
+
+    def stats(self) -> Dict:
+        shards = {}
+        for school in self.schools:
+            engine = self._engines.get(school)
+            config = self.tenant_map.schools.get(school, {})
+            shards[school] = {
+                "database": config.get("database") or (engine.url.database if engine else None),
+                "class_codes": config.get("class_codes", []),
+                "class_code_prefixes": config.get("class_code_prefixes", []),
+                "pool": engine.pool.status() if engine else "not connected",
+            }
+        return shards
+
+    async def dispose(self):
+        for school, engine in list(self._engines.items()):
+            if school != DEFAULT_SCHOOL:
+                await engine.dispose()
@@ -0,0 +1,49 @@
+import time
+from contextlib import closing
+
+import analysis_queue
+from analysis_queue import JOB_DEAD, JOB_QUEUED, JOB_RUNNING, AnalysisJobQueue
+
+
+def expire_lease(queue: AnalysisJobQueue, job_id: int):
+    with closing(queue._connect()) as conn:
+        conn.execute("UPDATE analysis_jobs SET locked_at = ? WHERE id = ?",
+                     (time.time() - analysis_queue.LEASE_SECONDS - 1, job_id))
+
+
+def test_claim_retries_and_backs_off(tmp_path):
+    queue = AnalysisJobQueue(tmp_path / "jobs.db", max_attempts=3)
+    job_id = queue.enqueue("entry-1")
+    job = queue.claim("worker-a")
+    assert job["id"] == job_id and job["attempts"] == 1
+    assert queue.claim("worker-b") is None  # Leased to worker-a
+
+    assert queue.fail(job_id, job["attempts"], "model timeout") == JOB_QUEUED
+    assert queue.claim("worker-b") is None  # Backing off
+    assert queue.status_for_entry("entry-1")["status"] == JOB_QUEUED
+
+
+def test_expired_lease_is_reclaimed_while_attempts_remain(tmp_path):
+    queue = AnalysisJobQueue(tmp_path / "jobs.db", max_attempts=3)
+    job_id = queue.enqueue("entry-1")
+    queue.claim("worker-a")
+    expire_lease(queue, job_id)
+
+    job = queue.claim("worker-b")
+    assert job["id"] == job_id and job["attempts"] == 2
+    assert queue.status_for_entry("entry-1")["status"] == JOB_RUNNING
+
+
+def test_expired_lease_on_last_attempt_is_dead_lettered(tmp_path):
+    queue = AnalysisJobQueue(tmp_path / "jobs.db", max_attempts=2)
+    job_id = queue.enqueue("entry-1")
+    for worker in ("worker-a", "worker-b"):
+        assert queue.claim(worker)["id"] == job_id
+        expire_lease(queue, job_id)
+
+    assert queue.claim("worker-c") is None
+    status = queue.status_for_entry("entry-1")
+    assert status["status"] == JOB_DEAD and status["attempts"] == 2
+    assert [job["id"] for job in queue.dead_jobs()] == [job_id]
+    assert queue.requeue(job_id)
+    assert queue.claim("worker-c")["attempts"] == 1
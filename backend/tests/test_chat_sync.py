@@ -0,0 +1,35 @@
+from datetime import datetime
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+
+import endpoint_queries as queries
+from db_models import Base, ChatMessageDb, UserDb, USER_ROLES
+
+
+def test_paging_does_not_skip_messages_sharing_a_timestamp():
+    engine = create_engine("sqlite://")
+    same_time = datetime(2026, 3, 2, 12, 0)
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.execute(insert(UserDb), [{
+            "id": "u1", "username": "student", "password_hash": "x", "class_code": "KLAS1",
+            "role": USER_ROLES["STUDENT_CLASS_1"], "points": 0, "level": 1, "badges": [], "streak_days": 0,
+            "created_at": same_time,
+        }])
+        session.execute(insert(ChatMessageDb), [
+            {"id": f"m{i}", "user_id": "u1", "username": "student", "message": f"hi {i}", "is_admin": False,
+             "timestamp": same_time}
+            for i in range(5)
+        ])
+
+        # Pages of two, each continuing from the last message like the sync token does
+        since, after_id, seen = datetime(2026, 3, 2), "", []
+        while True:
+            page = [msg for msg, _ in session.execute(queries.chat_messages_after("KLAS1", since, 2, after_id)).all()]
+            if not page:
+                break
+            seen += [msg.id for msg in page]
+            since, after_id = page[-1].timestamp, page[-1].id
+    engine.dispose()
+    assert seen == [f"m{i}" for i in range(5)]
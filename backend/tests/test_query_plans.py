@@ -0,0 +1,220 @@
+"""
+Query-plan regression tests for the SQLAlchemy models.
+
+Builds a throwaway SQLite database with the app's models, indexes, full-text
+index and two attached school-year archives, seeds it with a synthetic school
+(classes, students, entries, responses), runs ANALYZE and then EXPLAIN QUERY
+PLAN for the queries the endpoints run, built by the same functions
+(endpoint_queries.py, search_index.py). A query fails if it does a full table
+scan, including a walk over a whole index, so a dropped or unusable index is
+caught before it reaches production.
+
+    python -m pytest tests/test_query_plans.py
+"""
+import random
+import re
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, insert
+
+import endpoint_queries as queries
+import school_archive
+from db_models import (
+    Base, UserDb, FoodEntryDb, ChatMessageDb, DailyQuestionDb, FeedbackDb, QuestionResponseDb,
+    GalleryDb, PointsLedgerDb, USER_ROLES
+)
+from gallery_feed import NEWEST_INDEX_SIZE
+from search_index import SEARCH_SOURCES, install_search_index, search_sql, to_match_query
+
+SEED_CLASSES = 12
+SEED_STUDENTS_PER_CLASS = 25
+SEED_ENTRIES_PER_STUDENT = 40
+SEED_QUESTIONS = 30
+ARCHIVE_YEARS = (2023, 2024)
+
+# Queries that must read every row by design, with the reason
+ALLOWED_FULL_SCANS = {
+    "class_summary": "aggregates over all food entries of all classes",
+    "archived_class_summary": "aggregates over all food entries of all classes",
+    "all_chat": "admins read the newest messages of every class; the walk over the timestamp index stops at the limit",
+    "export_food_entries_everything": "an admin export of all classes and all time reads every row",
+    "export_question_responses_everything": "an admin export of all classes and all time reads every row",
+    "export_class_summaries_everything": "an admin export of all classes and all time reads every row",
+}
+
+
+def seed(conn):
+    random.seed(42)
+    now = datetime.utcnow()
+    users, entries, responses, chat, gallery, ledger, feedback = [], [], [], [], [], [], []
+    questions = [
+        {"id": str(uuid.uuid4()), "question": f"Question {i}", "options": ["a", "b"],
+         "date": (now - timedelta(days=i)).strftime("%Y-%m-%d"), "active": i == 0, "points_reward": 5}
+        for i in range(SEED_QUESTIONS)
+    ]
+    for class_index in range(SEED_CLASSES):
+        class_code = f"KLAS{class_index}"
+        for student_index in range(SEED_STUDENTS_PER_CLASS):
+            user_id = str(uuid.uuid4())
+            users.append({
+                "id": user_id, "username": f"student{class_index}_{student_index}", "password_hash": "x",
+                "class_code": class_code, "role": USER_ROLES["STUDENT_CLASS_1"], "points": random.randint(0, 500),
+                "level": 1, "badges": [], "streak_days": 0, "created_at": now,
+            })
+            for entry_index in range(SEED_ENTRIES_PER_STUDENT):
+                timestamp = now - timedelta(hours=random.randint(0, 24 * 90))
+                entries.append({
+                    "id": str(uuid.uuid4()), "user_id": user_id, "food_name": random.choice(["apple", "banana", "crisps"]),
+                    "meal_type": "snack", "quantity": "1", "ai_score": random.randint(1, 10), "calories_estimated": 80.0,
+                    "points_earned": 5, "timestamp": timestamp,
+                })
+                if entry_index % 10 == 0:
+                    gallery.append({"id": str(uuid.uuid4()), "user_id": user_id, "username": "s", "food_name": "apple",
+                                    "image_data": "", "ai_score": 7.0, "likes": 0, "timestamp": timestamp})
+                    chat.append({"id": str(uuid.uuid4()), "user_id": user_id, "username": "s", "message": "hi apple",
+                                 "is_admin": False, "timestamp": timestamp})
+                    ledger.append({"id": str(uuid.uuid4()), "user_id": user_id, "points": 5, "reason": "food_entry",
+                                   "timestamp": timestamp})
+            for question in random.sample(questions, 10):
+                responses.append({"id": str(uuid.uuid4()), "user_id": user_id, "question_id": question["id"],
+                                  "answer": "a", "points_earned": 5,
+                                  "timestamp": now - timedelta(hours=random.randint(0, 24 * 90))})
+            feedback.append({"id": str(uuid.uuid4()), "user_id": user_id, "username": "s",
+                             "feedback_text": "more apple questions", "category": "app", "timestamp": now})
+
+    for model, rows in ((UserDb, users), (DailyQuestionDb, questions), (FoodEntryDb, entries),
+                        (QuestionResponseDb, responses), (ChatMessageDb, chat), (GalleryDb, gallery),
+                        (PointsLedgerDb, ledger), (FeedbackDb, feedback)):
+        conn.execute(insert(model), rows)
+    return users[0], questions[0]
+
+
+@pytest.fixture(scope="module")
+def plan_db(tmp_path_factory):
+    """(connection, sample user, sample question) on a seeded database with attached archives."""
+    tmp_path = tmp_path_factory.mktemp("query_plans")
+    patch = pytest.MonkeyPatch()
+    patch.setattr(school_archive, "ARCHIVE_DIR", tmp_path / "archive")
+    engine = create_engine(f"sqlite:///{tmp_path / 'snackcheck.db'}")
+    with engine.connect() as conn:
+        Base.metadata.create_all(conn)
+        sample_user, sample_question = seed(conn)
+        install_search_index(conn)
+        conn.commit()
+        for year in ARCHIVE_YEARS:
+            school_archive.ensure_archive(conn, year)  # Must run outside a transaction
+        conn.exec_driver_sql("ANALYZE")
+        conn.commit()
+        yield conn, sample_user, sample_question
+    engine.dispose()
+    patch.undo()
+
+
+def endpoint_queries(sample_user, sample_question):
+    """name -> statement, built by the same functions (endpoint_queries.py) the endpoints call."""
+    user_id = sample_user["id"]
+    class_code = sample_user["class_code"]
+    now = datetime.utcnow()
+    week_ago = now - timedelta(days=7)
+    # What archived_source() in server.py returns when a range reaches into archived years
+    archived_entries = queries.with_archives(FoodEntryDb, ARCHIVE_YEARS)
+    archived_responses = queries.with_archives(QuestionResponseDb, ARCHIVE_YEARS)
+    return {
+        "user_by_id": queries.user_by_id(user_id),
+        "user_stats": queries.user_entries(FoodEntryDb, user_id),
+        "leaderboard": queries.leaderboard(class_code),
+        "class_award_update": queries.class_award_update(class_code, {"points": UserDb.points + 1}),
+        "points_ledger": queries.points_ledger(user_id),
+        "question_responses": queries.question_responses(sample_question["id"]),
+        "class_chat": queries.recent_chat_messages(class_code, 100),
+        "class_chat_since": queries.chat_messages_after(class_code, week_ago, 101, str(uuid.uuid4())),
+        "all_chat": queries.recent_chat_messages(None, 100),
+        "gallery_feed_newest": queries.gallery_newest(class_code, NEWEST_INDEX_SIZE),
+        "gallery_feed_top": queries.gallery_top(class_code, week_ago, 500),
+        "class_students": queries.class_students(class_code, UserDb.id, UserDb.username),
+        "class_activity": queries.class_entries(FoodEntryDb, class_code, week_ago, now),
+        "class_nutrition": queries.class_nutrition_rows(class_code, week_ago.date().isoformat(), now.date().isoformat()),
+        "class_summary": queries.class_summary(FoodEntryDb, None, None),
+        "archived_user_stats": queries.user_entries(archived_entries, user_id),
+        "archived_class_activity": queries.class_entries(archived_entries, class_code, week_ago, now),
+        "archived_class_summary": queries.class_summary(archived_entries, None, None),
+        "export_food_entries": queries.export_food_entries(FoodEntryDb, class_code, None, None),
+        "export_food_entries_range": queries.export_food_entries(FoodEntryDb, None, week_ago, now),
+        "export_food_entries_archived": queries.export_food_entries(archived_entries, class_code, week_ago, now),
+        "export_food_entries_everything": queries.export_food_entries(FoodEntryDb, None, None, None),
+        "export_question_responses": queries.export_question_responses(QuestionResponseDb, class_code, None, None),
+        "export_question_responses_range": queries.export_question_responses(QuestionResponseDb, None, week_ago, now),
+        "export_question_responses_archived": queries.export_question_responses(archived_responses, class_code, week_ago, now),
+        "export_question_responses_everything": queries.export_question_responses(QuestionResponseDb, None, None, None),
+        "export_class_summaries": queries.export_class_summaries(FoodEntryDb, class_code, None, None),
+        "export_class_summaries_range": queries.export_class_summaries(FoodEntryDb, None, week_ago, now),
+        "export_class_summaries_archived": queries.export_class_summaries(archived_entries, class_code, week_ago, now),
+        "export_class_summaries_everything": queries.export_class_summaries(FoodEntryDb, None, None, None),
+    }
+
+
+ENDPOINT_QUERY_NAMES = list(endpoint_queries({"id": "", "class_code": ""}, {"id": ""}))
+
+
+def explain(conn, stmt):
+    compiled = stmt.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})  # Expands IN lists
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    return [row[-1] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), params)]
+
+
+def full_scans(plan):
+    """
+    "SCAN x" reads every row, and so does "SCAN x USING [COVERING] INDEX ...", just in index
+    order; only SEARCH narrows down by key. Not tables: subqueries, constant rows, a union
+    materialized earlier in the plan, and FTS5 tables driven by their MATCH constraint
+    (an "M" in the idxStr after the colon).
+    """
+    materialized = {line[len("MATERIALIZE "):] for line in plan if line.startswith("MATERIALIZE ")}
+    scans = []
+    for line in plan:
+        if not line.startswith("SCAN ") or line.startswith(("SCAN (subquery", "SCAN CONSTANT ROW")):
+            continue
+        name, _, detail = line[len("SCAN "):].partition(" ")
+        if name in materialized or re.match(r"VIRTUAL TABLE INDEX \d+:\S*M", detail):
+            continue
+        scans.append(line)
+    return scans
+
+
+@pytest.mark.parametrize("name", ENDPOINT_QUERY_NAMES)
+def test_endpoint_query_uses_indexes(plan_db, name):
+    conn, sample_user, sample_question = plan_db
+    plan = explain(conn, endpoint_queries(sample_user, sample_question)[name])
+    if name not in ALLOWED_FULL_SCANS:
+        assert not full_scans(plan), "\n".join(plan)
+
+
+@pytest.mark.parametrize("scope", ["all", "class", "own"])
+def test_search_uses_full_text_index(plan_db, scope):
+    conn, sample_user, _ = plan_db
+    params = {"query": to_match_query("apple"), "limit": 21, "offset": 0,
+              "class_code": sample_user["class_code"], "user_id": sample_user["id"]}
+    sql = search_sql(list(SEARCH_SOURCES), scope)
+    plan = [row[-1] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql, params)]
+    assert not full_scans(plan), "\n".join(plan)
+    assert all(f"SCAN {fts_table} VIRTUAL TABLE" in "\n".join(plan) for _, fts_table, _ in SEARCH_SOURCES.values())
+    assert conn.exec_driver_sql(sql, params).first() is not None
+
+
+def test_archived_rows_are_read_through_the_union(plan_db):
+    conn, sample_user, _ = plan_db
+    archived_id = str(uuid.uuid4())
+    archived_entry = {"id": archived_id, "user_id": sample_user["id"], "food_name": "pear", "meal_type": "lunch",
+                      "quantity": "1", "ai_score": 6, "calories_estimated": 60.0, "points_earned": 5,
+                      "timestamp": datetime(2023, 10, 2, 12, 0)}
+    conn.execute(insert(queries.archive_table(FoodEntryDb.__table__, 2023)), [archived_entry])
+    try:
+        hot_ids = set(conn.execute(queries.user_entries(FoodEntryDb, sample_user["id"])).scalars())
+        archived = queries.with_archives(FoodEntryDb, ARCHIVE_YEARS)
+        all_ids = set(conn.execute(queries.user_entries(archived, sample_user["id"])).scalars())
+        assert archived_id not in hot_ids
+        assert all_ids == hot_ids | {archived_id}
+    finally:
+        conn.rollback()
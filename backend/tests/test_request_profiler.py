@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+from request_profiler import SlowRequestProfiler
+
+
+def burn_for_apples(seconds: float):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def burn_for_bananas(seconds: float):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+async def profiled_request(profiler: SlowRequestProfiler, burn, path: str):
+    async def handler():
+        # Slices well above the 5 ms GIL switch interval, so the sampler thread gets to run inside them
+        for _ in range(5):
+            burn(0.03)
+            await asyncio.sleep(0)
+
+    request_samples = profiler.begin()
+    started = time.perf_counter()
+    # Spawned like call_next's task: it belongs to the request through the context
+    await asyncio.create_task(handler())
+    duration_ms = (time.perf_counter() - started) * 1000.0
+    return profiler.finish(request_samples, "GET", path, 200, duration_ms)
+
+
+def test_concurrent_requests_get_only_their_own_samples():
+    profiler = SlowRequestProfiler(threshold_ms=0, interval_ms=1)
+
+    async def main():
+        return await asyncio.gather(
+            profiled_request(profiler, burn_for_apples, "/apples"),
+            profiled_request(profiler, burn_for_bananas, "/bananas"),
+        )
+
+    apples_id, bananas_id = asyncio.run(main())
+    apples = profiler.get_collapsed(apples_id)
+    bananas = profiler.get_collapsed(bananas_id)
+    assert "burn_for_apples" in apples and "burn_for_bananas" not in apples
+    assert "burn_for_bananas" in bananas and "burn_for_apples" not in bananas
+
+
+def test_fast_requests_are_not_kept():
+    profiler = SlowRequestProfiler(threshold_ms=10_000, interval_ms=1)
+
+    async def main():
+        return await profiled_request(profiler, burn_for_apples, "/apples")
+
+    assert asyncio.run(main()) is None
+    assert profiler.list_profiles() == []
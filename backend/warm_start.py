@@ -0,0 +1,164 @@
+"""
+Warm-start snapshots for in-memory indexes and caches.
+
+Registered structures (photo hash index, gallery feed indexes, ...) are dumped
+to one compact binary file on shutdown and periodically. Each section records
+the change counters of the tables it was built from; on startup a section is
+only loaded if those counters are unchanged, i.e. nothing wrote to its tables
+while the server was down (migration runs, another deploy, manual fixes).
+Stale sections are rebuilt in the background instead.
+
+Change counters are kept by SQLite triggers in db_change_counters, one row per
+tracked table, bumped by every INSERT/UPDATE/DELETE.
+
+The file is a pickle written by this app only; don't point
+SNACKCHECK_SNAPSHOT_PATH at a location other users can write to.
+"""
+import logging
+import os
+import pickle
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from shared_state import SHARED_STATE_DIR
+
+SNAPSHOT_PATH = Path(os.environ.get("SNACKCHECK_SNAPSHOT_PATH", SHARED_STATE_DIR / "warm_start.snapshot"))
+SNAPSHOT_INTERVAL_SECONDS = float(os.environ.get("SNACKCHECK_SNAPSHOT_INTERVAL_SECONDS", "600"))
+SNAPSHOT_MAGIC = b"SNKWARM1"
+
+
+def install_change_counters(sync_conn, tables: Iterable[str]):
+    sync_conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS db_change_counters (table_name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)"
+    )
+    for table in tables:
+        sync_conn.exec_driver_sql("INSERT OR IGNORE INTO db_change_counters (table_name, version) VALUES (?, 0)", (table,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            sync_conn.exec_driver_sql(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_changes_{event.lower()} AFTER {event} ON {table} "
+                f"BEGIN UPDATE db_change_counters SET version = version + 1 WHERE table_name = '{table}'; END"
+            )
+
+
+def read_change_counters(sync_conn) -> Dict[str, int]:
+    return dict(sync_conn.exec_driver_sql("SELECT table_name, version FROM db_change_counters").fetchall())
+
+
+class _Section:
+    def __init__(self, name: str, tables: Tuple[str, ...], dump: Callable[[], Any],
+                 load: Callable[[Any], None], rebuild: Callable[[Any], Awaitable[None]]):
+        self.name = name
+        self.tables = tables
+        self.dump = dump
+        self.load = load
+        self.rebuild = rebuild
+
+
+class SnapshotStore:
+    def __init__(self, path: Path = SNAPSHOT_PATH):
+        self.path = Path(path)
+        self._sections: Dict[str, _Section] = {}
+        self.last_saved: Optional[float] = None
+        self.last_load: Dict[str, str] = {}
+
+    def register(self, name: str, tables: Iterable[str], dump: Callable[[], Any],
+                 load: Callable[[Any], None], rebuild: Callable[[Any], Awaitable[None]]):
+        """
+        dump() returns picklable data, or None to leave the section out (e.g. not loaded yet);
+        load(data) installs it; rebuild(stale_data) refills the structure from the DB.
+        """
+        self._sections[name] = _Section(name, tuple(tables), dump, load, rebuild)
+
+    @property
+    def tracked_tables(self) -> List[str]:
+        return sorted({table for section in self._sections.values() for table in section.tables})
+
+    def collect(self, counters: Dict[str, int]) -> Dict:
+        """Runs the dump callbacks; call on the event loop so structures aren't mutated mid-dump."""
+        sections = {}
+        for section in self._sections.values():
+            try:
+                data = section.dump()
+            except Exception as e:
+                logging.error(f"Snapshot dump of {section.name} failed: {e}")
+                continue
+            if data is not None:
+                sections[section.name] = {
+                    "counters": {table: counters.get(table, 0) for table in section.tables},
+                    "data": data,
+                }
+        return {"created_at": time.time(), "sections": sections}
+
+    def write(self, snapshot: Dict) -> int:
+        """Blocking: compresses and atomically replaces the snapshot file. Returns its size."""
+        payload = SNAPSHOT_MAGIC + zlib.compress(pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL), 6)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(f".tmp{os.getpid()}")
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.last_saved = snapshot["created_at"]
+        return len(payload)
+
+    def read(self) -> Optional[Dict]:
+        """Blocking: returns the stored snapshot, or None if there is no usable file."""
+        try:
+            payload = self.path.read_bytes()
+        except FileNotFoundError:
+            return None
+        if not payload.startswith(SNAPSHOT_MAGIC):
+            logging.warning(f"Ignoring snapshot {self.path}: unknown format")
+            return None
+        try:
+            return pickle.loads(zlib.decompress(payload[len(SNAPSHOT_MAGIC):]))
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable snapshot {self.path}: {e}")
+            return None
+
+    def restore(self, snapshot: Optional[Dict], counters: Dict[str, int]) -> List[Tuple[_Section, Any]]:
+        """
+        Loads every section whose table counters still match. Returns (section, stale data)
+        for sections that need a background rebuild.
+        """
+        stored = (snapshot or {}).get("sections", {})
+        to_rebuild = []
+        self.last_load = {}
+        for section in self._sections.values():
+            entry = stored.get(section.name)
+            if entry is None:
+                self.last_load[section.name] = "missing"
+                to_rebuild.append((section, None))
+                continue
+            fresh = all(entry["counters"].get(table) == counters.get(table, 0) for table in section.tables)
+            if not fresh:
+                self.last_load[section.name] = "stale"
+                to_rebuild.append((section, entry["data"]))
+                continue
+            try:
+                section.load(entry["data"])
+                self.last_load[section.name] = "loaded"
+            except Exception as e:
+                logging.error(f"Loading snapshot section {section.name} failed: {e}")
+                self.last_load[section.name] = "failed"
+                to_rebuild.append((section, entry["data"]))
+        return to_rebuild
+
+    async def rebuild(self, sections: List[Tuple[_Section, Any]]):
+        for section, stale_data in sections:
+            try:
+                await section.rebuild(stale_data)
+                logging.info(f"Rebuilt {section.name} in the background.")
+            except Exception as e:
+                logging.error(f"Background rebuild of {section.name} failed: {e}")
+
+    def stats(self) -> Dict:
+        return {
+            "path": str(self.path),
+            "sections": list(self._sections),
+            "last_saved": self.last_saved,
+            "last_load": self.last_load,
+        }